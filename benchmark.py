@@ -0,0 +1,161 @@
+"""
+Benchmark the pipeline stages on synthetic data.
+
+Generates left and right tables at the given scale with synthetic.py, in a
+separate data directory, and runs the doit stages there one at a time, in
+pipeline order, so each stage's time doesn't include its dependencies.  For each
+stage, records the seconds, the input rows per second, the peak RSS of the doit
+process and all its workers together, and the output size, as a JSON line in the
+results file, with the git commit, so runs of different commits can be compared:
+
+    python benchmark.py --left-rows 100000 --right-rows 6000
+    python benchmark.py --report
+
+The model is fit on the labeled sample data, since the synthetic data has no labels.
+Nothing needs the network, or the database: the copy_to_db stage is left out.
+"""
+# pylint: disable=too-many-locals
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+import pandas as pd # type:ignore
+import psutil # type:ignore
+import columnar
+import synthetic
+
+RESULTS_FILE = 'benchmark-results.jsonl'
+BENCHMARK_DIR = 'benchmark-data'
+SAMPLE_LABEL_FILE = 'sample-data/sample-labeled-scores.csv'
+# sample the RSS this often
+POLL_SECONDS = 0.1
+
+# (doit task, its input, for the row count, its outputs, for the size), by dodo.py file names
+STAGES: List[Tuple[str, str, List[str]]] = [
+    ('ingest', 'sample-left.csv', ['sample-left.dataset']),
+    ('dedup', 'sample-left.csv', ['sample-left-keys.csv', 'sample-left-key-map.csv']),
+    ('normalize', 'sample-left-keys.csv', ['sample-left-keys.recipient.csv', 'sample-left-keys.clean.csv',
+                                           'sample-right.recipient.csv', 'sample-right.clean.csv']),
+    ('share', 'sample-left-keys.clean.csv', ['sample-left-keys.clean.table', 'sample-right.clean.table']),
+    ('index', 'sample-right.recipient.csv', ['sample-right-index']),
+    ('candidates', 'sample-left-keys.recipient.csv', ['sample-candidates.parquet']),
+    ('fit', 'sample-labeled-scores.csv', ['sample-model.pkl', 'sample-model.npz']),
+    ('rescore', 'sample-candidates.parquet', ['sample-scores.parquet']),
+    ('classify', 'sample-scores.parquet', ['sample-key-predictions.parquet']),
+    ('expand', 'sample-key-predictions.parquet', ['sample-predictions.csv']),
+    ('make_ddl', 'sample-predictions.csv', ['sample-predictions.ddl']),
+]
+
+def _size(path: str) -> int:
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(dirpath, filename))
+                   for dirpath, _, filenames in os.walk(path) for filename in filenames)
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+def _commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def _tree_rss(process: psutil.Process) -> int:
+    """The RSS of the process and its descendants, or 0 if it's gone."""
+    try:
+        processes = [process] + process.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return 0
+    total = 0
+    for proc in processes:
+        try:
+            total += proc.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return total
+
+def run_stage(task: str, data_dir: str) -> Tuple[float, int]:
+    """Run the doit task, without its dependencies, which are already done.
+    Returns the seconds and the peak RSS."""
+    env = dict(os.environ, FUZZY_JOIN_DATA_DIR=data_dir)
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-m', 'doit', '--db-file', os.path.join(data_dir, '.doit.db'),
+                                task], env=env)
+    watched = psutil.Process(process.pid)
+    peak = 0
+    done = threading.Event()
+
+    def poll() -> None:
+        nonlocal peak
+        while not done.wait(POLL_SECONDS):
+            peak = max(peak, _tree_rss(watched))
+
+    poller = threading.Thread(target=poll, daemon=True)
+    poller.start()
+    returncode = process.wait()
+    seconds = time.perf_counter() - start
+    done.set()
+    poller.join()
+    if returncode != 0:
+        raise Exception(f"stage {task} failed with {returncode}") # pylint: disable=broad-exception-raised
+    return seconds, peak
+
+def run(left_rows: int, right_rows: int, results_file: str = RESULTS_FILE,
+        data_dir: str = BENCHMARK_DIR) -> None:
+    """Generate the data, run the stages, and append the results."""
+    shutil.rmtree(data_dir, ignore_errors=True)
+    os.makedirs(data_dir)
+    synthetic.run(os.path.join(data_dir, 'sample-left.csv'), os.path.join(data_dir, 'sample-right.csv'),
+                  left_rows, right_rows)
+    shutil.copy(SAMPLE_LABEL_FILE, os.path.join(data_dir, 'sample-labeled-scores.csv'))
+    commit = _commit()
+    for task, input_name, output_names in STAGES:
+        input_rows = columnar.num_rows(os.path.join(data_dir, input_name))
+        seconds, peak_rss = run_stage(task, data_dir)
+        result: Dict[str, Any] = {
+            'commit': commit,
+            'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'left_rows': left_rows,
+            'right_rows': right_rows,
+            'workers': os.environ.get('FUZZY_JOIN_WORKERS', os.cpu_count()),
+            'stage': task,
+            'seconds': round(seconds, 3),
+            'input_rows': input_rows,
+            'rows_per_sec': round(input_rows / seconds, 1),
+            'peak_rss_gb': round(peak_rss / 1e9, 3),
+            'output_bytes': sum(_size(os.path.join(data_dir, name)) for name in output_names)
+        }
+        print(json.dumps(result))
+        with open(results_file, 'a', encoding='utf8') as results_f:
+            results_f.write(json.dumps(result) + '\n')
+
+def report(results_file: str = RESULTS_FILE) -> None:
+    """Print the rows per second and the peak RSS of each stage, for each commit, at each scale."""
+    results = pd.read_json(results_file, lines=True)
+    # the last run of each commit counts
+    results = results.drop_duplicates(['commit', 'left_rows', 'right_rows', 'stage'], keep='last')
+    commits = list(dict.fromkeys(results['commit']))
+    stages = [task for task, _, _ in STAGES]
+    for (left_rows, right_rows), scale in results.groupby(['left_rows', 'right_rows']):
+        print(f"left rows {left_rows} right rows {right_rows}")
+        for column in ['rows_per_sec', 'peak_rss_gb']:
+            table = scale.pivot(index='stage', columns='commit', values=column)
+            print(table.reindex(index=[s for s in stages if s in table.index],
+                                columns=[c for c in commits if c in table.columns]).to_string())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--left-rows', type=int, default=100000)
+    parser.add_argument('--right-rows', type=int, default=6000)
+    parser.add_argument('--results', default=RESULTS_FILE)
+    parser.add_argument('--data-dir', default=BENCHMARK_DIR)
+    parser.add_argument('--report', action='store_true', help='just print the results so far')
+    args = parser.parse_args()
+    if args.report:
+        report(args.results)
+    else:
+        run(args.left_rows, args.right_rows, args.results, args.data_dir)
@@ -0,0 +1,133 @@
+"""
+Blocking: find the right rows worth comparing with each left row, instead of
+comparing every left row with every right row.
+
+Two kinds of blocks, over the normalized right Partner_Name and DBA together:
+
+* an inverted index of word tokens, leaving out the very common tokens, whose
+  blocks would be most of the table anyway.
+* MinHash LSH over character n-grams, which catches misspellings and run-together
+  words that share no whole token.  The signature is split into bands, and rows
+  with the same band hash share a block.  More bands of fewer rows each find more
+  (weaker) pairs: two strings with jaccard similarity s share at least one block
+  with probability 1 - (1 - s^rows)^bands.
+
+Each left row (Supplier and Invoice_Ship_to_Address) is then compared, by the
+TF-IDF index, only with the right rows it shares a block with, so the scan time
+grows with the block sizes, not the right table size.
+
+The hashes are crc32, not the python hash, so they're the same in every process.
+"""
+# pylint: disable=too-many-arguments
+import pickle
+import zlib
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Set, Tuple
+import numpy as np
+import pandas as pd # type:ignore
+import normalize
+
+PRIME = (1 << 31) - 1
+SEED = 62
+LEFT_COLS = ['Supplier', 'Invoice_Ship_to_Address']
+RIGHT_COLS = ['Partner_Name', 'DBA']
+
+def tokens(text: str) -> Set[str]:
+    """The word tokens."""
+    return set(text.split())
+
+def shingle_hashes(text: str, ngram_size: int) -> np.ndarray:
+    """Hashes of the character n-grams of the words, padded with spaces, like char_wb."""
+    hashes = {zlib.crc32(padded[i:i + ngram_size].encode('utf8'))
+              for padded in (f' {word} ' for word in text.split())
+              for i in range(max(len(padded) - ngram_size + 1, 1))}
+    return np.fromiter(hashes, dtype=np.int64, count=len(hashes))
+
+class BlockingIndex:
+    """The token and LSH blocks of the right table."""
+    def __init__(self, bands: int = 20, rows: int = 4, ngram_size: int = 5,
+                 max_block_size: int = 1000, preprocessor: Optional[Callable[[str], str]] = None) -> None:
+        self.preprocessor = preprocessor
+        self.bands = bands
+        self.rows = rows
+        self.ngram_size = ngram_size
+        self.max_block_size = max_block_size
+        rng = np.random.default_rng(SEED)
+        self.coef_a = rng.integers(1, PRIME, size=bands * rows, dtype=np.int64)
+        self.coef_b = rng.integers(0, PRIME, size=bands * rows, dtype=np.int64)
+        self.token_blocks: Dict[str, np.ndarray] = {}
+        self.lsh_blocks: List[Dict[int, np.ndarray]] = []
+
+    def signature(self, text: str) -> np.ndarray:
+        """The MinHash signature, or empty if there are no n-grams."""
+        hashes = shingle_hashes(text, self.ngram_size)
+        if len(hashes) == 0:
+            return np.zeros(0, dtype=np.int64)
+        # (a * h + b) mod p fits in int64 since a, h < 2^32
+        return np.min((np.outer(self.coef_a, hashes) + self.coef_b[:, None]) % PRIME, axis=1)
+
+    def band_keys(self, text: str) -> List[int]:
+        """One key per band, for the LSH blocks."""
+        signature = self.signature(text)
+        if len(signature) == 0:
+            return []
+        return [zlib.crc32(signature[band * self.rows:(band + 1) * self.rows].tobytes())
+                for band in range(self.bands)]
+
+    def build(self, right_df: pd.DataFrame) -> None:
+        """Fill the blocks with right table row positions."""
+        right_df = self._preprocessed(right_df.fillna(''), RIGHT_COLS)
+        token_blocks: Dict[str, Set[int]] = defaultdict(set)
+        lsh_blocks: List[Dict[int, Set[int]]] = [defaultdict(set) for _ in range(self.bands)]
+        for column in RIGHT_COLS:
+            for position, text in enumerate(right_df[column]):
+                for token in tokens(text):
+                    token_blocks[token].add(position)
+                for band, key in enumerate(self.band_keys(text)):
+                    lsh_blocks[band][key].add(position)
+        def frozen(blocks: Dict) -> Dict:
+            return {key: np.fromiter(sorted(block), dtype=np.int64, count=len(block))
+                    for key, block in blocks.items() if len(block) <= self.max_block_size}
+        self.token_blocks = frozen(token_blocks)
+        self.lsh_blocks = [frozen(band_blocks) for band_blocks in lsh_blocks]
+
+    def _preprocessed(self, df: pd.DataFrame, columns: List[str]) -> pd.DataFrame:
+        if self.preprocessor is None:
+            return df
+        return pd.DataFrame({column: df[column].map(self.preprocessor) for column in columns})
+
+    def pairs(self, left_df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+        """The distinct (left chunk row position, right table row position) pairs that share a block."""
+        left_df = self._preprocessed(left_df.fillna(''), LEFT_COLS)
+        rows: List[np.ndarray] = []
+        cols: List[np.ndarray] = []
+        for position, texts in enumerate(zip(*[left_df[column] for column in LEFT_COLS])):
+            blocks: List[np.ndarray] = []
+            for text in texts:
+                blocks.extend(self.token_blocks[token] for token in tokens(text) if token in self.token_blocks)
+                blocks.extend(self.lsh_blocks[band][key] for band, key in enumerate(self.band_keys(text))
+                              if key in self.lsh_blocks[band])
+            if len(blocks) == 0:
+                continue
+            right_positions = np.unique(np.concatenate(blocks))
+            rows.append(np.full(len(right_positions), position, dtype=np.int64))
+            cols.append(right_positions)
+        if len(rows) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(rows), np.concatenate(cols)
+
+def load(index_file: str) -> BlockingIndex:
+    """Load the pickled index."""
+    with open(index_file, 'rb') as index_f:
+        return pickle.load(index_f)
+
+def run(right_file: str, index_file: str, normalized: bool = False, bands: int = 20, rows: int = 4) -> None:
+    """Read the right file, build the blocks, and save them.  If normalized, the
+    right file is the "recipient" sidecar from normalize.run, otherwise the index
+    normalizes the right and left values itself."""
+    right_df = pd.read_csv(right_file, engine='c', index_col=0, usecols=['Unnamed: 0'] + RIGHT_COLS,
+                           dtype=dict.fromkeys(RIGHT_COLS, 'str'), low_memory=False)
+    index = BlockingIndex(bands, rows, preprocessor=None if normalized else normalize.recipient)
+    index.build(right_df)
+    with open(index_file, 'wb') as index_f:
+        pickle.dump(index, index_f)
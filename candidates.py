@@ -7,120 +7,267 @@ the chunks to workers.
 On my 6-core i5-9400F machine, this scans at ~500 rows/sec, against the broadcast table of 6K rows,
 so the whole 22M row left table scan would take about 12 hours.
 """
-# pylint: disable=line-too-long,fixme,protected-access,invalid-name,global-statement
-import re
+# pylint: disable=line-too-long,fixme,invalid-name,global-statement
 import os
-import time
 import multiprocessing
-from typing import List
+from functools import partial
+from typing import List, Optional
 from warnings import simplefilter
-import psutil # type:ignore
+import numpy as np
 import pandas as pd # type:ignore
 from red_string_grouper import record_linkage # type:ignore
-import usaddress # type:ignore
 import stopwords
-import lib
-
-def extract_recipient(addr_str) -> str:
-    """ Extract useful terms embedded in addresses."""
-    parsed_addr = usaddress.parse(addr_str)
-    output: List[str] = []
-    for token, label in parsed_addr:
-        if len(output) > 0 and label != 'Recipient':
-            break
-        if label == 'Recipient':
-            output.append(token)
-    return " ".join(output)
-
-def preprocessor(text_field: str) -> str:
-    """ Simple field transforms: lower, stopwords, addr parsing."""
-    text_field = text_field.lower()
-    text_field = extract_recipient(text_field) # Removes stuff like "po box 1234 santa monica ca."
-    for stopword in stopwords.STOPWORDS:
-        text_field = re.sub(r'\b' + stopword + r'\b', ' ', text_field)
-    return text_field
+import blocking
+import checkpoint
+import columnar
+import ingest
+import matcher_spec
+import metrics
+import normalize
+import scheduler
+import splits
+import tfidf_index
+
+# see matchers.json
+FUZZY_MATCHERS: List[tfidf_index.Matcher] = matcher_spec.load()
+
+def fuzzy_matchers(normalized: bool) -> List[tfidf_index.Matcher]:
+    """The matchers, without the preprocessor if the input is already normalized."""
+    return matcher_spec.load(normalized=normalized)
 
 # global
 right_df = None
-def worker_init(right_filename) -> None:
-    """ Each worker loads the right file once, i.e. "broadcast join." """
-    global right_df
+right_index: Optional[tfidf_index.TfidfIndex] = None
+right_blocks: Optional[blocking.BlockingIndex] = None
+matchers: List[tfidf_index.Matcher] = FUZZY_MATCHERS
+top_k: Optional[int] = None
+matcher_top_k: Optional[int] = None
+exact_mode: Optional[str] = None
+def worker_init(right_filename: str, index_dir: Optional[str] = None, normalized: bool = False,
+                recipient_cache: Optional[str] = None, blocking_file: Optional[str] = None,
+                best: Optional[int] = None, matcher_best: Optional[int] = None,
+                exact: Optional[str] = None, right_ids: Optional[List[int]] = None) -> None:
+    """ Each worker loads the right file once, i.e. "broadcast join."
+
+    If the prebuilt index is specified, load that instead, and the blocking index,
+    if specified.  If normalized, the input is the "recipient" sidecar from
+    normalize.run.  Otherwise the workers normalize, keeping the recipients in the
+    recipient_cache, if specified.
+
+    If best is specified, keep only the best pairs for each left row, and also the
+    matcher_best for each matcher, if specified.
+
+    If exact is specified, find the exact matches first, see EXACT_MODES.
+
+    If right_ids is specified, with the prebuilt index, match only those right rows."""
+    global right_df, right_index, right_blocks, matchers, top_k, matcher_top_k, exact_mode
+    matchers = fuzzy_matchers(normalized)
+    top_k, matcher_top_k, exact_mode = best, matcher_best, exact
+    normalize.open_store(recipient_cache)
+    if blocking_file is not None:
+        right_blocks = blocking.load(blocking_file)
+    if index_dir is not None:
+        right_index = tfidf_index.TfidfIndex(index_dir)
+        if right_ids is not None:
+            right_index.restrict(right_ids)
+            right_blocks = None # the blocks are positions in the whole table
+        return
     right_df = pd.read_csv(right_filename, engine='c', index_col=0,
                                   usecols=['Unnamed: 0', 'Partner_Name', 'DBA'],
                                   low_memory=False).fillna('')
 
+# the left fields looked up in the right values, for the exact matches.
+EXACT_FIELDS = ['Supplier']
+# 'only': rows with exact matches skip the fuzzy matching; 'first': they're fuzzy matched too.
+EXACT_MODES = ['only', 'first']
+
+def fuzzy_match(left_df: pd.DataFrame) -> pd.DataFrame:
+    """ The scored pairs for the chunk, by whichever matching method the worker has. """
+    if right_index is not None and right_blocks is not None:
+        with metrics.phase('blocking'):
+            rows, cols = right_blocks.pairs(left_df)
+        metrics.count('pairs', len(rows))
+        matches = right_index.match_pairs(left_df, rows, cols, top_k, matcher_top_k)
+    elif right_index is not None:
+        matches = right_index.match(left_df, top_k, matcher_top_k)
+    else:
+        with metrics.phase('record_linkage'):
+            matches = record_linkage(
+                data_frames = [left_df, right_df],
+                fields_2b_matched_fuzzily = matchers,
+                fields_2b_matched_exactly = [],
+                hierarchical=False, # Non-hierarchical output just keeps the scores.
+                stop_words=stopwords.STOPWORDS,
+                binary=False,  # Allow term weighting (by repetition). TODO: actually do that?
+                n_blocks=(1,1) # Don't let the string grouper divide anything up, it doesn't seem to help anyway.
+            )
+        matches = prune(matches, top_k, matcher_top_k)
+    return matches
+
 def worker_fn(left_df: pd.DataFrame, output_filename: str) -> int:
     """ Process the given chunk of the left table.  Returns the number of rows written. """
     simplefilter(action="ignore", category=UserWarning)
     pd.set_option('mode.chained_assignment', None)
 
-    left_df = left_df.fillna('')
-
-    matches = record_linkage(
-        data_frames = [left_df, right_df],
-        fields_2b_matched_fuzzily = [
-            ('Supplier','Partner_Name',1.0, {'min_similarity':0.2,'ngram_size':[1,2],'analyzer':'word', 'preprocessor':preprocessor}),
-            ('Supplier','Partner_Name',0.2, {'min_similarity':0.2,'ngram_size':[5,7],'analyzer':'char_wb', 'preprocessor':preprocessor}),
-            ('Supplier','DBA',0.8, {'min_similarity':0.2,'ngram_size':[1,2],'analyzer':'word', 'preprocessor':preprocessor}),
-            ('Supplier','DBA',0.7, {'min_similarity':0.2,'ngram_size':[5,7],'analyzer':'char_wb', 'preprocessor':preprocessor}),
-            ('Invoice_Ship_to_Address','Partner_Name',0.3, {'min_similarity':0.2,'ngram_size':[1,2],'analyzer':'word', 'preprocessor':preprocessor}),
-            ('Invoice_Ship_to_Address','Partner_Name',0.25, {'min_similarity':0.2,'ngram_size':[5,7],'analyzer':'char_wb', 'preprocessor':preprocessor}),
-            ('Invoice_Ship_to_Address','DBA',0.5, {'min_similarity':0.2,'ngram_size':[1,2],'analyzer':'word', 'preprocessor':preprocessor}),
-            ('Invoice_Ship_to_Address','DBA',0.1, {'min_similarity':0.2,'ngram_size':[5,7],'analyzer':'char_wb', 'preprocessor':preprocessor}),
-        ],
-        fields_2b_matched_exactly = [],
-        hierarchical=False, # Non-hierarchical output just keeps the scores.
-        stop_words=stopwords.STOPWORDS,
-        binary=False,  # Allow term weighting (by repetition). TODO: actually do that?
-        n_blocks=(1,1) # Don't let the string grouper divide anything up, it doesn't seem to help anyway.
-    )
-
-    filtered_df = matches[matches['Weighted Mean Similarity Score']>0.02]
-
-    #filtered_df.to_csv(candidates_file)
-
-    with open(output_filename, 'a', encoding='utf8') as output_f:
-        filtered_df.to_csv(output_f, header=False)
-        output_f.flush()
-
-    print(f"worker {os.getpid()} finished "
-          f"RSS (GB) {psutil.Process(os.getpid()).memory_info().rss/1e9:5.2f} ")
+    with metrics.chunk('candidates'):
+        left_df = left_df.fillna('')
+        metrics.count('rows', len(left_df))
+
+        if right_index is not None and exact_mode is not None:
+            # the hash lookup costs microseconds per row, and scoring the one pair is cheap.
+            with metrics.phase('exact'):
+                rows, cols = right_index.exact_pairs(left_df, EXACT_FIELDS)
+                exact_matches = right_index.match_pairs(left_df, rows, cols)
+            metrics.count('exact_rows', len(np.unique(rows)))
+            if exact_mode == 'only':
+                unmatched = np.ones(len(left_df), dtype=bool)
+                unmatched[rows] = False
+                matches = pd.concat([exact_matches, fuzzy_match(left_df[unmatched])])
+            else:
+                matches = pd.concat([exact_matches, fuzzy_match(left_df)])
+                matches = matches[~matches.index.duplicated()]
+            matches = matches.sort_index()
+        else:
+            matches = fuzzy_match(left_df)
+
+        normalize.flush_store()
+
+        filtered_df = matches[matches['Weighted Mean Similarity Score']>0.02]
+
+        #filtered_df.to_csv(candidates_file)
+
+        with metrics.phase('write'):
+            columnar.write_chunk(filtered_df, output_filename)
+        metrics.count('candidates', len(filtered_df))
 
     return len(filtered_df)
 
-# TODO: do this differently
-CANDIDATE_COLS = ['left_index', 'right_index', 'Weighted Mean Similarity Score',
-       '0:Supplier/Partner_Name', '1:Supplier/Partner_Name', '2:Supplier/DBA',
-       '3:Supplier/DBA', '4:Invoice_Ship_to_Address/Partner_Name',
-       '5:Invoice_Ship_to_Address/Partner_Name',
-       '6:Invoice_Ship_to_Address/DBA', '7:Invoice_Ship_to_Address/DBA']
+def prune(matches: pd.DataFrame, best: Optional[int], matcher_best: Optional[int]) -> pd.DataFrame:
+    """Like the index top_k, for the record_linkage frame: keep the best pairs by
+    weighted score, and the matcher_best by each matcher, for each left row."""
+    if best is None and matcher_best is None:
+        return matches
+    by_left = matches.groupby(level='left_index')
+    keep = pd.Series(False, index=matches.index)
+    if best is not None:
+        keep |= by_left[tfidf_index.SCORE_COL].rank(method='first', ascending=False) <= best
+    if matcher_best is not None:
+        for column in matches.columns.drop(tfidf_index.SCORE_COL):
+            keep |= (by_left[column].rank(method='first', ascending=False) <= matcher_best) & (matches[column] > 0)
+    return matches[keep.values]
 
-def run(left_file: str, right_file: str, candidates_file: str) -> None:
-    """Do everything."""
+# TODO does this need encoding='latin1' or na_filter=False?
+LEFT_READ_ARGS = {'engine': 'c', 'index_col': 0, 'dtype': 'str', 'low_memory': False,
+                  'usecols': ['Unnamed: 0', 'Supplier','Invoice_Ship_to_Address']}
+
+def split_worker_fn(left_file: str, header: List[str], split: splits.Split, output_filename: str) -> int:
+    """ Read and process the given split of the left table.  Returns the number of rows written. """
+    with metrics.chunk('candidates'):
+        with metrics.phase('read'):
+            left_df = splits.read(left_file, header, split, **LEFT_READ_ARGS)
+        return worker_fn(left_df, output_filename)
+
+CANDIDATE_COLS = ['left_index', 'right_index', tfidf_index.SCORE_COL] + tfidf_index.score_cols(FUZZY_MATCHERS)
+
+def build_index(right_file: str, index_dir: str, normalized: bool = False) -> None:
+    """Fit the matchers on the right file once, for all the workers to share."""
+    tfidf_index.run(right_file, fuzzy_matchers(normalized), stopwords.STOPWORDS, index_dir)
+
+def run(left_file: str, right_file: str, candidates_file: str, index_dir: Optional[str] = None,
+        normalized: bool = False, recipient_cache: Optional[str] = None,
+        split_bytes: Optional[int] = None, blocking_file: Optional[str] = None,
+        best: Optional[int] = None, matcher_best: Optional[int] = None,
+        exact: Optional[str] = None, right_ids: Optional[List[int]] = None,
+        fiscal_years: Optional[List[str]] = None) -> None:
+    """Do everything.  If index_dir is specified, use the prebuilt right index from build_index,
+    and if blocking_file is also specified, only compare the pairs that share a block.
+
+    If best is specified, write only the best candidates for each left row, plus the
+    matcher_best by each matcher; check the recall with recall().
+
+    If exact is specified, with the prebuilt index, look up the left rows that
+    exactly match a right value first, see EXACT_MODES.
+
+    If right_ids is specified, with the prebuilt index, match only those right rows,
+    see delta.py.
+
+    The left can be the dataset from ingest.run, which the parent reads, only the
+    partitions of the fiscal_years, if specified.  Otherwise fiscal_years filters
+    the rows of the left CSV after reading.
+    If normalized, the left and right files are "recipient" sidecars from normalize.run,
+    otherwise the workers keep the recipients they extract in the recipient_cache.
+
+    Each chunk is written to its own part file, so a rerun resumes where a crashed
+    run stopped.  The chunk size adapts to the workers, starting at chunksize.
+
+    If split_bytes is specified, the parent doesn't read the left file, it just
+    splits it into byte ranges of about that size, which the workers read."""
     simplefilter(action="ignore", category=pd.errors.PerformanceWarning)
     pd.set_option('mode.chained_assignment', None)
-
-    lib.write_header(candidates_file, CANDIDATE_COLS)
+    if exact is not None and (exact not in EXACT_MODES or index_dir is None):
+        raise ValueError(f"exact must be one of {EXACT_MODES}, with the prebuilt index, not {exact}")
+    if right_ids is not None and index_dir is None:
+        raise ValueError("right_ids requires the prebuilt index")
+    scan = ingest.is_dataset(left_file) or fiscal_years is not None
+    if scan and split_bytes is not None:
+        raise ValueError("split_bytes only applies to a left CSV, without fiscal_years")
 
     chunksize  = 100000
+    parts = checkpoint.Parts(candidates_file + '.parts',
+                             checkpoint.signature([left_file, right_file], chunksize=chunksize,
+                                                  index_dir=index_dir, normalized=normalized,
+                                                  split_bytes=split_bytes, blocking_file=blocking_file,
+                                                  best=best, matcher_best=matcher_best, exact=exact,
+                                                  right_ids=right_ids, fiscal_years=fiscal_years),
+                             os.path.splitext(candidates_file)[1])
+    sizer = scheduler.ChunkSizer(chunksize, parts)
+    metrics.start('candidates')
     ctx = multiprocessing.get_context('spawn')
-    # TODO: read the right file in the pool worker initializer
-    with ctx.Pool(processes = 6, initializer = worker_init, initargs = (right_file, )) as pool:
-        # TODO row filter, e.g. df = df[df['Fiscal_Year']=='2020']
-        # TODO does this need encoding='latin1' or na_filter=False?
-        # TODO skiprows?
+    with ctx.Pool(processes = scheduler.WORKERS, initializer = worker_init, initargs = (right_file, index_dir, normalized, recipient_cache, blocking_file, best, matcher_best, exact, right_ids)) as pool:
+        sched = scheduler.Scheduler(pool, sizer)
+        if split_bytes is not None:
+            header, left_splits = splits.plan(left_file, split_bytes)
+            print(f"parent splits: {len(left_splits):10d}")
+            for split in left_splits:
+                if parts.is_done(*split):
+                    continue
+                sched.submit(split_worker_fn, (left_file, header, split, parts.tmp_file(*split)), 0,
+                             callback=partial(parts.finish, *split),
+                             error_callback=partial(parts.fail, *split))
         rows_read = 0
-        for left_df_chunk in pd.read_csv(left_file, engine='c', index_col=0, dtype='str', chunksize=chunksize, nrows=1000000,
-                                          low_memory=False, usecols=['Unnamed: 0', 'Supplier','Invoice_Ship_to_Address']):
-            rows_read += len(left_df_chunk)
+        for left_df_chunk in ([] if split_bytes is not None else
+                              ingest.scan(left_file, ingest.COLUMNS, chunksize, fiscal_years) if scan else
+                              columnar.read_chunks(left_file, sizer, nrows=1000000, **LEFT_READ_ARGS)):
+            start, rows_read = rows_read, rows_read + len(left_df_chunk)
             print(f"parent rows read: {rows_read:10d}")
-            pool.apply_async(worker_fn, (left_df_chunk, candidates_file),
-                             callback=lambda x: print(f"worker rows written: {x:10d}"),
-                             error_callback=lambda x: print(f"error: {x}"))
-            while pool._taskqueue.qsize() > 3: # type:ignore
-                time.sleep(1)
+            if parts.is_done(start, rows_read):
+                continue
+            sched.submit(worker_fn, (left_df_chunk, parts.tmp_file(start, rows_read)), len(left_df_chunk),
+                         callback=partial(parts.finish, start, rows_read),
+                         error_callback=partial(parts.fail, start, rows_read))
         pool.close()
         pool.join()
+    parts.concat(candidates_file, CANDIDATE_COLS)
+    metrics.summary()
+
+def recall(candidates_file: str, labeled_file: str, key_map_file: Optional[str] = None) -> float:
+    """The fraction of the labeled matches that are among the candidates, to check
+    that pruning didn't lose them.  The labeled left_index is a left row; if the
+    candidates are of the dedup keys, key_map_file maps each left row to its key,
+    and the labeled rows that have no key, e.g. of other fiscal years, are skipped."""
+    pair_cols = ['left_index', 'right_index']
+    candidate_pairs = columnar.read(candidates_file, usecols=pair_cols)[pair_cols]
+    labeled = columnar.read(labeled_file, usecols=pair_cols + ['label'])
+    matches = labeled[labeled['label'] == 1][pair_cols]
+    if key_map_file is not None:
+        key_map = pd.concat([chunk[chunk['left_index'].isin(matches['left_index'])]
+                             for chunk in pd.read_csv(key_map_file, chunksize=1000000)])
+        matches = matches.merge(key_map, on='left_index')[['key_index', 'right_index']].rename(
+            columns={'key_index': 'left_index'})
+    found = matches.merge(candidate_pairs.drop_duplicates(), on=['left_index', 'right_index'], how='inner')
+    result = len(found) / len(matches) if len(matches) > 0 else 1.0
+    print(f"candidate recall {result:.3f} ({len(found)} of {len(matches)} labeled matches)")
+    return result
 
 if __name__ == '__main__':
     run('sample-data/sample-left.csv', 'sample-data/sample-right.csv', 'sample-data/sample-candidates.csv')
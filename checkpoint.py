@@ -0,0 +1,120 @@
+"""
+Checkpointed chunk output, so that a crashed scan can resume.
+
+Each chunk of the driving table is identified by its row range, [start, end),
+and its worker writes it to its own temporary part file.  When the worker
+finishes, the parent renames the part into place, which is atomic, and appends
+the range to the manifest.  A rerun skips the ranges in the manifest.  When the
+scan is done, the parts are concatenated, in order, into the output file.
+The parts have the same format (CSV or Parquet) as the output.
+
+The manifest starts with a signature of the inputs, so that parts from a run
+against different inputs are discarded instead of reused.
+"""
+import json
+import os
+import shutil
+from typing import Any, Dict, List, Set, Tuple
+import columnar
+
+MANIFEST = 'manifest.jsonl'
+
+def _stat(input_file: str) -> List[float]:
+    """Size and mtime, of all the files together for a directory."""
+    if not os.path.isdir(input_file):
+        return [os.path.getsize(input_file), os.path.getmtime(input_file)]
+    stats = [_stat(os.path.join(input_file, filename)) for filename in sorted(os.listdir(input_file))]
+    return [sum(size for size, _ in stats), max((mtime for _, mtime in stats), default=0.0)]
+
+def signature(input_files: List[str], **params: Any) -> Dict[str, Any]:
+    """Identify the inputs by size and mtime, and any other parameters that affect the output."""
+    return {
+        'files': {input_file: _stat(input_file) for input_file in input_files},
+        'params': params
+    }
+
+class Parts:
+    """A directory of part files and the manifest of the completed ones."""
+    def __init__(self, parts_dir: str, sig: Dict[str, Any], suffix: str = '.csv') -> None:
+        self.parts_dir = parts_dir
+        self.suffix = suffix
+        self.manifest_file = os.path.join(parts_dir, MANIFEST)
+        self.completed: Set[Tuple[int, int]] = set()
+        self.failed = 0
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, 'r', encoding='utf8') as manifest_f:
+                lines = manifest_f.read().splitlines()
+            # a partial last line means a crash while appending it, so ignore it.
+            if len(lines) > 0 and json.loads(lines[0]) == json.loads(json.dumps(sig)):
+                for line in lines[1:]:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        break
+                    if os.path.exists(self.part_file(record['start'], record['end'])):
+                        self.completed.add((record['start'], record['end']))
+            else:
+                print(f"discarding parts in {parts_dir} from a different run")
+                shutil.rmtree(parts_dir)
+        os.makedirs(parts_dir, exist_ok=True)
+        # parts from unfinished chunks
+        for filename in os.listdir(parts_dir):
+            if os.path.splitext(filename)[0].endswith('.tmp'):
+                os.remove(os.path.join(parts_dir, filename))
+        if not os.path.exists(self.manifest_file):
+            self._append(sig)
+        elif len(self.completed) > 0:
+            print(f"resuming with {len(self.completed)} chunks already done")
+
+    def _append(self, record: Dict[str, Any]) -> None:
+        with open(self.manifest_file, 'a', encoding='utf8') as manifest_f:
+            manifest_f.write(json.dumps(record) + "\n")
+            manifest_f.flush()
+            os.fsync(manifest_f.fileno())
+
+    def part_file(self, start: int, end: int) -> str:
+        """The finished part for this range."""
+        return os.path.join(self.parts_dir, f'{start:012d}-{end:012d}{self.suffix}')
+
+    def tmp_file(self, start: int, end: int) -> str:
+        """The worker writes (appends) this, which the parent renames when it's done.
+        It ends with the suffix, so the worker writes the part's format."""
+        return os.path.join(self.parts_dir, f'{start:012d}-{end:012d}.tmp{self.suffix}')
+
+    def chunk_size(self, start: int, size: int) -> int:
+        """The size of the chunk starting here: the same as a finished one starting
+        here, if there is one, and otherwise not overlapping the next finished one."""
+        for done_start, done_end in sorted(self.completed):
+            if done_start == start:
+                return done_end - done_start
+            if done_start > start:
+                return min(size, done_start - start)
+        return size
+
+    def is_done(self, start: int, end: int) -> bool:
+        """True if this range was finished in a previous run."""
+        return (start, end) in self.completed
+
+    def finish(self, start: int, end: int, rows: int) -> None:
+        """Move the part into place and record it.  Runs in the parent, in the pool result callback."""
+        tmp_file = self.tmp_file(start, end)
+        if not os.path.exists(tmp_file):
+            # the worker wrote nothing
+            open(tmp_file, 'w', encoding='utf8').close() # pylint: disable=consider-using-with
+        os.replace(tmp_file, self.part_file(start, end))
+        self._append({'start': start, 'end': end, 'rows': rows})
+        self.completed.add((start, end))
+
+    def fail(self, start: int, end: int, error: BaseException) -> None:
+        """Note the failure, so the output isn't concatenated without this part."""
+        print(f"error: rows {start} to {end}: {error}")
+        self.failed += 1
+
+    def concat(self, output_file: str, columns: List[str]) -> None:
+        """Write the header and all the parts, in order, to the output, and remove the parts.
+        If any chunk failed, leave the parts for a rerun to finish."""
+        if self.failed > 0:
+            raise Exception(f"{self.failed} chunks failed, rerun to retry them") # pylint: disable=broad-exception-raised
+        columnar.concat([self.part_file(start, end) for start, end in sorted(self.completed)],
+                        output_file, columns)
+        shutil.rmtree(self.parts_dir)
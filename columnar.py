@@ -0,0 +1,185 @@
+"""
+Columnar (Parquet) intermediate files.
+
+The candidates, scores, and predictions pass between the stages, and at full
+scale they're hundreds of millions of rows, so formatting and parsing them as
+CSV is expensive.  If the filename ends in .parquet, they're written instead as
+compressed Parquet, with floats as float32, one row group per chunk, and read
+back in batches.  Otherwise, they're CSV as before, which is still the export
+format.
+
+pyarrow is only required for the .parquet files.
+
+Parquet files carry their schema.  For a CSV output, the writer can record the
+column types in a small sidecar, so that consumers like make_ddl don't have to
+scan the file to infer them.
+"""
+import json
+import os
+import shutil
+from typing import Any, Callable, Dict, Iterator, List, Optional, Union
+import numpy as np
+import pandas as pd # type:ignore
+try:
+    import pyarrow as pa # type:ignore
+    import pyarrow.parquet as pq # type:ignore
+except ImportError:
+    pa = None # pylint: disable=invalid-name
+    pq = None # pylint: disable=invalid-name
+
+SUFFIX = '.parquet'
+SCHEMA_SUFFIX = '.schema.json'
+COMPRESSION = 'zstd'
+# read this many rows at a time, to assemble chunks of any size
+BATCH_SIZE = 10000
+
+# a fixed size, or a function of the row position of the chunk
+ChunkSize = Union[int, Callable[[int], int]]
+
+def size_at(chunk_size: ChunkSize, position: int) -> int:
+    """The size of the chunk starting at the position."""
+    return chunk_size if isinstance(chunk_size, int) else chunk_size(position)
+
+def is_columnar(filename: str) -> bool:
+    """True if the file is (or should be) Parquet."""
+    return filename.endswith(SUFFIX)
+
+def _check() -> None:
+    if pa is None:
+        raise ImportError("pyarrow is required for .parquet files")
+
+def _to_table(data_frame: pd.DataFrame, index: bool) -> 'pa.Table':
+    """Named indices become columns, the (meaningless) row number index is dropped."""
+    if index and any(name is not None for name in data_frame.index.names):
+        data_frame = data_frame.reset_index()
+    else:
+        data_frame = data_frame.reset_index(drop=True)
+    float_cols = data_frame.select_dtypes(include=[np.float64]).columns
+    data_frame = data_frame.astype(dict.fromkeys(float_cols, np.float32))
+    return pa.Table.from_pandas(data_frame, preserve_index=False)
+
+def write_chunk(data_frame: pd.DataFrame, filename: str, index: bool = True,
+                columns: Optional[List[str]] = None, float_format: Optional[str] = None) -> None:
+    """Append the chunk to the CSV file (without header), or write it as a Parquet file."""
+    if columns is not None:
+        data_frame = data_frame[columns]
+    if is_columnar(filename):
+        _check()
+        pq.write_table(_to_table(data_frame, index), filename, compression=COMPRESSION)
+        return
+    with open(filename, 'a', encoding='utf8') as output_f:
+        data_frame.to_csv(output_f, header=False, index=index, float_format=float_format)
+        output_f.flush()
+
+def concat(part_files: List[str], output_file: str, columns: List[str]) -> None:
+    """Write the header and the parts, in order, to the output.  For Parquet, each
+    part becomes a row group, and the columns are taken from the parts."""
+    if not is_columnar(output_file):
+        with open(output_file, 'w', encoding='utf8') as output_header_f:
+            pd.DataFrame(columns=columns).to_csv(output_header_f, index=False)
+        with open(output_file, 'ab') as output_f:
+            for part_file in part_files:
+                with open(part_file, 'rb') as part_f:
+                    shutil.copyfileobj(part_f, output_f)
+            output_f.flush()
+        return
+    _check()
+    writer: Optional[pq.ParquetWriter] = None
+    try:
+        for part_file in part_files:
+            if os.path.getsize(part_file) == 0:
+                continue # the worker wrote nothing
+            table = pq.read_table(part_file)
+            if writer is None:
+                writer = pq.ParquetWriter(output_file, table.schema, compression=COMPRESSION)
+            elif not table.schema.equals(writer.schema):
+                table = table.cast(writer.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        pq.write_table(pa.table({column: pa.array([], pa.float32()) for column in columns}),
+                       output_file, compression=COMPRESSION)
+
+def read_chunks(filename: str, chunk_size: ChunkSize, nrows: Optional[int] = None,
+                **csv_kwargs: Any) -> Iterator[pd.DataFrame]:
+    """Scan the file in chunks, each of the size given for its position.
+    The csv_kwargs only apply to CSV."""
+    rows_read = 0
+    if not is_columnar(filename):
+        with pd.read_csv(filename, chunksize=size_at(chunk_size, 0), nrows=nrows, **csv_kwargs) as reader:
+            while True:
+                try:
+                    chunk = reader.get_chunk(size_at(chunk_size, rows_read))
+                except StopIteration:
+                    return
+                rows_read += len(chunk)
+                yield chunk
+    _check()
+    pending: Optional[pa.Table] = None
+    batches = pq.ParquetFile(filename).iter_batches(batch_size=BATCH_SIZE)
+    while nrows is None or rows_read < nrows:
+        size = size_at(chunk_size, rows_read)
+        if nrows is not None:
+            size = min(size, nrows - rows_read)
+        while pending is None or pending.num_rows < size:
+            batch = next(batches, None)
+            if batch is None:
+                break
+            batch_table = pa.Table.from_batches([batch])
+            pending = batch_table if pending is None else pa.concat_tables([pending, batch_table])
+        if pending is None or pending.num_rows == 0:
+            return
+        chunk = pending.slice(0, size).to_pandas()
+        pending = pending.slice(size)
+        chunk.index = pd.RangeIndex(rows_read, rows_read + len(chunk))
+        rows_read += len(chunk)
+        yield chunk
+
+def read(filename: str, **csv_kwargs: Any) -> pd.DataFrame:
+    """Read the whole file.  The csv_kwargs only apply to CSV."""
+    if not is_columnar(filename):
+        return pd.read_csv(filename, **csv_kwargs)
+    _check()
+    return pq.read_table(filename).to_pandas()
+
+def columns(filename: str) -> List[str]:
+    """The column names, without reading any rows."""
+    if not is_columnar(filename):
+        return list(pd.read_csv(filename, nrows=0).columns)
+    _check()
+    return list(pq.read_schema(filename).names)
+
+def num_rows(filename: str) -> int:
+    """The number of rows, from the metadata, or by counting CSV lines (which
+    overcounts quoted newlines)."""
+    if is_columnar(filename):
+        _check()
+        return pq.ParquetFile(filename).metadata.num_rows
+    lines = 0
+    with open(filename, 'rb') as input_f:
+        for block in iter(lambda: input_f.read(1 << 20), b''):
+            lines += block.count(b'\n')
+    return max(lines - 1, 0)
+
+def write_schema(filename: str, dtypes: Dict[str, str]) -> None:
+    """Record the column types (numpy dtype names) of the CSV file, after writing it.
+    Parquet files have their own."""
+    if is_columnar(filename):
+        return
+    with open(filename + SCHEMA_SUFFIX, 'w', encoding='utf8') as schema_f:
+        json.dump({'columns': list(dtypes.items())}, schema_f)
+
+def schema(filename: str) -> Optional[Dict[str, str]]:
+    """The column types (numpy dtype names), from the Parquet metadata or the
+    recorded CSV schema, or None if there isn't one, or it's older than the file."""
+    if is_columnar(filename):
+        _check()
+        empty = pq.read_schema(filename).empty_table().to_pandas()
+        return {column: str(dtype) for column, dtype in empty.dtypes.items()}
+    schema_file = filename + SCHEMA_SUFFIX
+    if not os.path.exists(schema_file) or os.path.getmtime(schema_file) < os.path.getmtime(filename):
+        return None
+    with open(schema_file, 'r', encoding='utf8') as schema_f:
+        return dict(json.load(schema_f)['columns'])
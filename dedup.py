@@ -0,0 +1,82 @@
+"""
+Deduplicate the left table keys before matching, and fan the results back out after.
+
+The same (Supplier, Invoice_Ship_to_Address) pair repeats across many left rows,
+so the matching stages only need to see each distinct pair once.
+
+The keys file looks like a left file, with the key id as its index, so the
+candidates and rescore stages can read it in place of the left file.  The key map
+file relates every left row to its key id, and is used to expand the results.
+
+The ids can be stable: a key keeps the id it had in the previous keys file, and
+new keys get new ids, so a delta run can tell the new keys from the old.
+
+The left table can be the dataset from ingest.run, in which case only the key
+columns, and with fiscal_years only those years, are read.
+"""
+import os
+from typing import Dict, List, Optional, Tuple
+import pandas as pd # type:ignore
+import columnar
+import ingest
+import lib
+
+KEY_COLS = ['Supplier', 'Invoice_Ship_to_Address']
+KEY_MAP_COLS = ['left_index', 'key_index']
+
+def normalize_key(text: str) -> str:
+    """Lower case and collapse whitespace, which the matchers ignore anyway."""
+    return " ".join(text.lower().split())
+
+def run(left_file: str, keys_file: str, key_map_file: str, chunk_size: int = 100000,
+        stable: bool = False, fiscal_years: Optional[List[str]] = None) -> None:
+    """Scan the left table, assign an id to each distinct key, write the keys and the key map.
+    If stable, keep the ids of the keys in the existing keys file.  If fiscal_years is
+    specified, only the left rows of those years are keyed, and so matched."""
+    keys: Dict[Tuple[str, str], int] = {}
+    if stable and os.path.exists(keys_file):
+        previous = pd.read_csv(keys_file, index_col=0, dtype=dict.fromkeys(KEY_COLS, 'str')).fillna('')
+        keys = dict(zip(zip(previous['Supplier'], previous['Invoice_Ship_to_Address']), previous.index))
+    next_id = max(keys.values(), default=-1) + 1
+    seen: Dict[Tuple[str, str], int] = {}
+
+    def key_id(key: Tuple[str, str]) -> int:
+        nonlocal next_id
+        if key not in seen:
+            if key not in keys:
+                keys[key], next_id = next_id, next_id + 1
+            seen[key] = keys[key]
+        return seen[key]
+
+    lib.write_header(key_map_file, KEY_MAP_COLS)
+    rows_read = 0
+    with open(key_map_file, 'a', encoding='utf8') as key_map_f:
+        for left_df_chunk in ingest.scan(left_file, KEY_COLS, chunk_size, fiscal_years):
+            key_ids = [key_id(key)
+                       for key in zip(left_df_chunk['Supplier'].map(normalize_key),
+                                      left_df_chunk['Invoice_Ship_to_Address'].map(normalize_key))]
+            pd.DataFrame({'left_index': left_df_chunk.index, 'key_index': key_ids}).to_csv(
+                key_map_f, header=False, index=False)
+            rows_read += len(left_df_chunk)
+        key_map_f.flush()
+    print(f"dedup rows read: {rows_read:10d} distinct keys: {len(seen):10d}")
+    pd.DataFrame(list(seen.keys()), columns=KEY_COLS, index=list(seen.values())).sort_index().to_csv(keys_file)
+
+def expand(input_file: str, key_map_file: str, output_file: str, chunk_size: int = 1000000) -> None:
+    """Replace the key ids in the left_index column of the input with the left rows
+    having that key.  The input (e.g. predictions) is held in RAM, the key map is scanned.
+    The output schema is recorded, for make_ddl."""
+    results = columnar.read(input_file).rename(columns={'left_index': 'key_index'})
+    columns = ['left_index'] + list(results.columns[1:])
+    lib.write_header(output_file, columns)
+    with open(output_file, 'a', encoding='utf8') as output_f:
+        for key_map_chunk in pd.read_csv(key_map_file, chunksize=chunk_size):
+            expanded = key_map_chunk.merge(results, on='key_index')
+            expanded.to_csv(output_f, columns=columns, header=False, index=False)
+        output_f.flush()
+    columnar.write_schema(output_file, {'left_index': 'int64',
+                                        **{column: str(dtype) for column, dtype in results.dtypes.items()
+                                           if column != 'key_index'}})
+
+if __name__ == '__main__':
+    run('sample-data/sample-left.csv', 'sample-data/sample-left-keys.csv', 'sample-data/sample-left-key-map.csv')
@@ -0,0 +1,282 @@
+"""
+Delta runs: recompute only what changed in the inputs since the last run, and
+merge it into the existing output.
+
+Each stage output has a state file next to it, with a content hash of each of
+the inputs it was made from:
+
+* candidates: each left key and each right row.  The new or changed keys are
+  matched against the whole right table, and the other keys against only the new
+  or changed right rows.  The candidates of deleted or changed keys and right
+  rows are retired.  The key ids must be stable, see dedup.run.  With pruning
+  (best, matcher_best) or exact matching, which key gets which candidates depends
+  on all the right rows, so the old keys that got a candidate from a new right
+  row, or lost one to a retired right row, are rerun against the whole table,
+  which gives the same candidates a full run would.
+* rescore and classify: each input pair, with the text of its left and right
+  rows, or the model, mixed into the hash.  The new or changed pairs are scored
+  or classified, and the results of the deleted or changed ones are retired.
+
+The merge streams the old output, without the retired rows, and the new rows
+into the new output, which replaces the old one.  The state is written last, so
+an interrupted delta run just reruns.  Without a state, or an output, the stage
+runs in full.
+
+Note the right index is refit on the whole new right table, so the idf weights
+move a little, and the unchanged candidates keep their old scores; run in full
+now and then.  The pair states are held in RAM, about 16 bytes per pair, keyed
+by both ids packed in one int64, so the ids must be less than 2^31.
+"""
+# pylint: disable=too-many-arguments,too-many-locals
+import hashlib
+import os
+import shutil
+from typing import Any, Callable, List, Optional
+import numpy as np
+import pandas as pd # type:ignore
+import candidates
+import classify
+import columnar
+import rescore
+
+STATE_SUFFIX = '.delta.parquet'
+DELTA_SUFFIX = '.delta'
+CHUNK_SIZE = 1000000
+# a multiplier for mixing hashes
+MIX = np.uint64(0x9E3779B97F4A7C15)
+# the candidates.run arguments that make a key's candidates depend on all the right rows
+PRUNING_ARGS = ['best', 'matcher_best', 'exact']
+
+# the ids that pair_keys can pack without collisions
+MAX_ID = 2**31 - 1
+
+def pair_keys(left_index: np.ndarray, right_index: np.ndarray) -> np.ndarray:
+    """One int64 for each (left_index, right_index) pair; the ids must be from 0 to MAX_ID."""
+    left = np.asarray(left_index, dtype=np.int64)
+    right = np.asarray(right_index, dtype=np.int64)
+    for ids in (left, right):
+        if len(ids) > 0 and (ids.min() < 0 or ids.max() > MAX_ID):
+            raise ValueError(f"ids from {ids.min()} to {ids.max()} don't fit in a pair key, 0 to {MAX_ID}")
+    return (left << 32) | right
+
+def row_hashes(data_frame: pd.DataFrame) -> np.ndarray:
+    """A uint64 hash of the values in each row."""
+    return pd.util.hash_pandas_object(data_frame, index=False).values
+
+def file_hash(filename: str) -> np.uint64:
+    """A uint64 hash of the file content, e.g. the model."""
+    with open(filename, 'rb') as input_f:
+        return np.uint64(int.from_bytes(hashlib.sha1(input_f.read()).digest()[:8], 'little'))
+
+def text_hashes(filename: str, columns: List[str]) -> pd.Series:
+    """The hash of the columns of each row of a left or right file, indexed by its index."""
+    parts = [pd.Series(row_hashes(chunk[columns].fillna('')), index=chunk.index)
+             for chunk in pd.read_csv(filename, engine='c', index_col=0, chunksize=CHUNK_SIZE,
+                                      usecols=['Unnamed: 0'] + columns, dtype=dict.fromkeys(columns, 'str'),
+                                      low_memory=False)]
+    return pd.concat(parts) if len(parts) > 0 else pd.Series([], dtype=np.uint64)
+
+def _read_state(output_file: str) -> Optional[pd.DataFrame]:
+    state_file = output_file + STATE_SUFFIX
+    if not os.path.exists(state_file) or not os.path.exists(output_file):
+        return None
+    return columnar.read(state_file)
+
+def _write_state(output_file: str, state: pd.DataFrame) -> None:
+    columnar.write_chunk(state.reset_index(drop=True), output_file + STATE_SUFFIX + '.tmp' + columnar.SUFFIX,
+                         index=False)
+    os.replace(output_file + STATE_SUFFIX + '.tmp' + columnar.SUFFIX, output_file + STATE_SUFFIX)
+
+def _changed(current: pd.Series, old: pd.Series) -> np.ndarray:
+    """The ids that are new, or whose hash changed."""
+    previous = old.reindex(current.index, fill_value=0)
+    return current.index.values[(previous.values != current.values) | ~current.index.isin(old.index)]
+
+def _gone(current: pd.Series, old: pd.Series) -> np.ndarray:
+    """The ids that were deleted, or whose hash changed."""
+    return _changed(old, current)
+
+def _filter(input_file: str, keep: Callable[[pd.DataFrame], np.ndarray], output_file: str) -> int:
+    """Copy the rows of the input that keep says to.  Returns the number of rows."""
+    parts_dir = output_file + '.filter'
+    shutil.rmtree(parts_dir, ignore_errors=True)
+    os.makedirs(parts_dir)
+    suffix = os.path.splitext(output_file)[1]
+    part_files: List[str] = []
+    rows = 0
+    for chunk in columnar.read_chunks(input_file, CHUNK_SIZE):
+        chunk = chunk[keep(chunk)]
+        part_file = os.path.join(parts_dir, f'{len(part_files)}{suffix}')
+        columnar.write_chunk(chunk, part_file, index=False)
+        part_files.append(part_file)
+        rows += len(chunk)
+    columnar.concat(part_files, output_file, columnar.columns(input_file))
+    shutil.rmtree(parts_dir)
+    return rows
+
+def _merge(old_file: str, new_files: List[str], retired: Callable[[pd.DataFrame], np.ndarray],
+           output_file: str, columns: List[str]) -> None:
+    """The old rows that aren't retired, then the new rows, into the output."""
+    parts_dir = output_file + '.merge'
+    shutil.rmtree(parts_dir, ignore_errors=True)
+    os.makedirs(parts_dir)
+    suffix = os.path.splitext(output_file)[1]
+    part_files: List[str] = []
+    for input_file, keep in [(old_file, lambda chunk: ~retired(chunk))] + [
+            (new_file, lambda chunk: np.ones(len(chunk), dtype=bool)) for new_file in new_files]:
+        if not os.path.exists(input_file):
+            continue
+        for chunk in columnar.read_chunks(input_file, CHUNK_SIZE):
+            part_file = os.path.join(parts_dir, f'{len(part_files)}{suffix}')
+            columnar.write_chunk(chunk[keep(chunk)][columns], part_file, index=False)
+            part_files.append(part_file)
+    columnar.concat(part_files, output_file + '.tmp' + suffix, columns)
+    os.replace(output_file + '.tmp' + suffix, output_file)
+    shutil.rmtree(parts_dir)
+
+def _left_keys(candidates_file: str, right_ids: np.ndarray) -> np.ndarray:
+    """The left keys that have a candidate with any of the right ids."""
+    keys = [chunk['left_index'].values[chunk['right_index'].isin(right_ids).values]
+            for chunk in columnar.read_chunks(candidates_file, CHUNK_SIZE)]
+    return np.unique(np.concatenate(keys)) if len(keys) > 0 else np.zeros(0, dtype=np.int64)
+
+def run_candidates(left_file: str, right_file: str, candidates_file: str, index_dir: str,
+                   **candidates_args: Any) -> None:
+    """Like candidates.run, but only for the new or changed left keys and right rows."""
+    left_hashes = text_hashes(left_file, rescore.LEFT_COLS)
+    right_hashes = text_hashes(right_file, rescore.RIGHT_COLS)
+    state = pd.DataFrame({'side': ['left'] * len(left_hashes) + ['right'] * len(right_hashes),
+                          'id': np.concatenate([left_hashes.index.values, right_hashes.index.values]).astype(np.int64),
+                          'hash': np.concatenate([left_hashes.values, right_hashes.values]).astype(np.uint64)})
+    old = _read_state(candidates_file)
+    if old is None:
+        candidates.run(left_file, right_file, candidates_file, index_dir, **candidates_args)
+        _write_state(candidates_file, state)
+        return
+    old_left = old[old['side'] == 'left'].set_index('id')['hash']
+    old_right = old[old['side'] == 'right'].set_index('id')['hash']
+    changed_left = _changed(left_hashes, old_left)
+    changed_right = _changed(right_hashes, old_right)
+    gone_left = _gone(left_hashes, old_left)
+    gone_right = _gone(right_hashes, old_right)
+    print(f"delta left keys changed {len(changed_left):10d} gone {len(gone_left):10d} "
+          f"right rows changed {len(changed_right):10d} gone {len(gone_right):10d}")
+
+    delta_dir = candidates_file + DELTA_SUFFIX
+    shutil.rmtree(delta_dir, ignore_errors=True)
+    os.makedirs(delta_dir)
+    suffix = os.path.splitext(candidates_file)[1]
+    left_df = pd.read_csv(left_file, index_col=0, dtype=dict.fromkeys(rescore.LEFT_COLS, 'str'))
+
+    def run_keys(name: str, keys: np.ndarray, **args: Any) -> Optional[str]:
+        subset = left_df.index.isin(keys)
+        if not subset.any():
+            return None
+        subset_file = os.path.join(delta_dir, f'{name}-keys.csv')
+        left_df[subset].to_csv(subset_file)
+        new_file = os.path.join(delta_dir, f'{name}-candidates{suffix}')
+        candidates.run(subset_file, right_file, new_file, index_dir, **args)
+        return new_file
+
+    # the old keys against the new right rows, without pruning
+    unchanged = left_df.index.values[~left_df.index.isin(changed_left)]
+    right_file_new = None if len(changed_right) == 0 else run_keys(
+        'right', unchanged, **dict(candidates_args, best=None, matcher_best=None, exact=None,
+                                   right_ids=changed_right.tolist()))
+    rerun = changed_left
+    new_files = []
+    if any(candidates_args.get(arg) is not None for arg in PRUNING_ARGS):
+        # the new right rows, and the retired ones, can change which pairs the
+        # pruning keeps for an old key, so rerun those keys against everything.
+        affected = _left_keys(candidates_file, gone_right)
+        if right_file_new is not None:
+            affected = np.union1d(affected, columnar.read(right_file_new)['left_index'].values)
+        print(f"delta old keys rerun {len(affected):10d}")
+        rerun = np.union1d(changed_left, affected)
+    elif right_file_new is not None:
+        new_files.append(right_file_new)
+    left_file_new = run_keys('left', rerun, **candidates_args)
+    if left_file_new is not None:
+        new_files.append(left_file_new)
+    _merge(candidates_file, new_files,
+           lambda chunk: (chunk['left_index'].isin(gone_left) | chunk['left_index'].isin(rerun) |
+                          chunk['right_index'].isin(gone_right)).values,
+           candidates_file, candidates.CANDIDATE_COLS)
+    _write_state(candidates_file, state)
+    shutil.rmtree(delta_dir)
+
+def _pair_state(input_file: str, salt: Callable[[pd.DataFrame], np.ndarray]) -> pd.DataFrame:
+    """The pair and the hash of each row of the input, mixed with the salt."""
+    parts = []
+    for chunk in columnar.read_chunks(input_file, CHUNK_SIZE):
+        parts.append(pd.DataFrame({'pair': pair_keys(chunk['left_index'].values, chunk['right_index'].values),
+                                   'hash': row_hashes(chunk) * MIX + salt(chunk)}))
+    return pd.concat(parts, ignore_index=True) if len(parts) > 0 else pd.DataFrame(
+        {'pair': np.zeros(0, dtype=np.int64), 'hash': np.zeros(0, dtype=np.uint64)})
+
+def run_pairs(input_file: str, output_file: str, stage: Callable[[str, str], None], columns: List[str],
+              salt: Callable[[pd.DataFrame], np.ndarray]) -> None:
+    """Run the stage on the new or changed pairs of the input, and merge them into the output."""
+    with np.errstate(over='ignore'):
+        state = _pair_state(input_file, salt)
+    old = _read_state(output_file)
+    if old is None:
+        stage(input_file, output_file)
+        _write_state(output_file, state)
+        return
+    current = state.set_index('pair')['hash']
+    previous = old.set_index('pair')['hash']
+    changed = _changed(current, previous)
+    gone = _gone(current, previous)
+    print(f"delta pairs changed {len(changed):10d} gone {len(gone):10d}")
+
+    delta_dir = output_file + DELTA_SUFFIX
+    shutil.rmtree(delta_dir, ignore_errors=True)
+    os.makedirs(delta_dir)
+    suffix = os.path.splitext(output_file)[1]
+    new_files = []
+    if len(changed) > 0:
+        delta_input = os.path.join(delta_dir, 'input' + os.path.splitext(input_file)[1])
+        _filter(input_file, lambda chunk: np.isin(pair_keys(chunk['left_index'].values,
+                                                            chunk['right_index'].values), changed),
+                delta_input)
+        delta_output = os.path.join(delta_dir, 'output' + suffix)
+        stage(delta_input, delta_output)
+        new_files.append(delta_output)
+    _merge(output_file, new_files,
+           lambda chunk: np.isin(pair_keys(chunk['left_index'].values, chunk['right_index'].values), gone),
+           output_file, columns)
+    _write_state(output_file, state)
+    shutil.rmtree(delta_dir)
+
+def run_rescore(candidate_filename: str, chunk_size: int, left_table: str, right_table: str,
+                scores_filename: str, left_text_file: str, right_text_file: str, normalized: bool = False,
+                split_bytes: Optional[int] = None, scoring_threads: int = 1) -> None:
+    """Like rescore.run with shared tables, but only for the new or changed candidates.
+    The text files are the ones the shared tables were built from, for the hashes."""
+    left_hashes = text_hashes(left_text_file, rescore.LEFT_COLS)
+    right_hashes = text_hashes(right_text_file, rescore.RIGHT_COLS)
+
+    def salt(chunk: pd.DataFrame) -> np.ndarray:
+        return (left_hashes.reindex(chunk['left_index'].values, fill_value=0).values * MIX +
+                right_hashes.reindex(chunk['right_index'].values, fill_value=0).values)
+
+    def stage(input_file: str, output_file: str) -> None:
+        rescore.run(input_file, chunk_size, left_table, right_table, output_file, normalized,
+                    shared=True, split_bytes=split_bytes, scoring_threads=scoring_threads)
+
+    run_pairs(candidate_filename, scores_filename, stage,
+              columnar.columns(candidate_filename) + rescore.NEW_SCORE_COLS, salt)
+
+def run_classify(input_file: str, chunk_size: int, model_file: str, threshold: float,
+                 output_file: str, split_bytes: Optional[int] = None) -> None:
+    """Like classify.run, but only for the new or changed scores."""
+    with np.errstate(over='ignore'):
+        model_hash = file_hash(model_file) * MIX + np.uint64(int(threshold * 1e6))
+
+    def stage(stage_input: str, stage_output: str) -> None:
+        classify.run(stage_input, chunk_size, model_file, threshold, stage_output, split_bytes)
+
+    run_pairs(input_file, output_file, stage, classify.PREDICTION_COLS,
+              lambda chunk: np.full(len(chunk), model_hash, dtype=np.uint64))
+    columnar.write_schema(output_file, classify.PREDICTION_DTYPES)
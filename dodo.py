@@ -1,8 +1,9 @@
 """ Run the whole pipeline. """
 # pylint: disable=line-too-long
+import os
 import time
-from typing import Any, Dict
-import candidates, fit, rescore, classify, make_ddl
+from typing import Any, Dict, Iterator, List, Optional
+import blocking, candidates, dedup, delta, fit, ingest, load, matcher_spec, metrics, normalize, rescore, classify, fused, make_ddl, shared_table
 
 DOIT_CONFIG: Dict[str, str] = {
     'backend': 'json',
@@ -10,7 +11,10 @@ DOIT_CONFIG: Dict[str, str] = {
 }
 
 VERSION_KEY: str = 'version'
-DATA_DIR: str = 'sample-data'
+# the benchmark runs the pipeline on synthetic data in another directory
+DATA_DIR: str = os.environ.get('FUZZY_JOIN_DATA_DIR', 'sample-data')
+# per-chunk timings of every stage, see metrics.py
+os.environ.setdefault(metrics.METRICS_ENV, DATA_DIR + '/metrics.jsonl')
 
 def version_unchanged(task, values, version) -> bool: # pylint: disable=unused-argument
     """True if the previous version is the same as the new version"""
@@ -22,17 +26,149 @@ def archive_ts() -> str:
 
 LEFT_FILE = DATA_DIR + '/sample-left.csv'
 RIGHT_FILE = DATA_DIR + '/sample-right.csv'
-CANDIDATES_FILE = DATA_DIR + '/sample-candidates.csv'
+LEFT_DATASET = DATA_DIR + '/sample-left.dataset'
+KEYS_FILE = DATA_DIR + '/sample-left-keys.csv'
+KEY_MAP_FILE = DATA_DIR + '/sample-left-key-map.csv'
+# keep the key ids stable, and recompute only the changed candidates, scores and predictions, see delta.py.
+DELTA = False
+# match only the left rows of these fiscal years, e.g. ['2020'], or all of them if None.
+FISCAL_YEARS: Optional[List[str]] = None
 
-def task_candidates() -> Dict[str, Any]:
-    """Read right and left, generate candidate pairs."""
+def task_ingest() -> Dict[str, Any]:
+    """Read left once, write the columns the stages use to a dataset partitioned by fiscal year."""
+    version: int = 1
+    return {
+        'actions': [
+            (ingest.run, [LEFT_FILE, LEFT_DATASET]),
+            lambda: {VERSION_KEY: version}
+        ],
+        'file_dep': [LEFT_FILE],
+        'targets': [LEFT_DATASET + '/' + ingest.MANIFEST],
+        'uptodate': [ (version_unchanged, [version]) ],
+        'verbosity': 2
+    }
+
+def task_dedup() -> Dict[str, Any]:
+    """Read the left dataset, write the distinct keys and the map from left rows to keys."""
+    version: int = 3
+    return {
+        'actions': [
+            (dedup.run, [LEFT_DATASET, KEYS_FILE, KEY_MAP_FILE, 100000, DELTA, FISCAL_YEARS]),
+            lambda: {VERSION_KEY: version, 'fiscal_years': FISCAL_YEARS}
+        ],
+        'file_dep': [LEFT_DATASET + '/' + ingest.MANIFEST],
+        'targets': [KEYS_FILE, KEY_MAP_FILE],
+        'uptodate': [ (version_unchanged, [version]),
+                      lambda task, values: values.get('fiscal_years') == FISCAL_YEARS ],
+        'verbosity': 2
+    }
+
+LEFT_COLS = ['Supplier', 'Invoice_Ship_to_Address']
+RIGHT_COLS = ['Partner_Name', 'DBA']
+KEYS_RECIPIENT_FILE = DATA_DIR + '/sample-left-keys.recipient.csv'
+KEYS_CLEAN_FILE = DATA_DIR + '/sample-left-keys.clean.csv'
+RIGHT_RECIPIENT_FILE = DATA_DIR + '/sample-right.recipient.csv'
+RIGHT_CLEAN_FILE = DATA_DIR + '/sample-right.clean.csv'
+RECIPIENT_CACHE = DATA_DIR + '/recipient-cache.sqlite'
+
+def task_normalize() -> Iterator[Dict[str, Any]]:
+    """Read left keys and right, write normalized sidecars for candidates and rescore."""
+    version: int = 2
+    for name, input_file, columns, form, output_file in [
+            ('keys_recipient', KEYS_FILE, LEFT_COLS, 'recipient', KEYS_RECIPIENT_FILE),
+            ('keys_clean', KEYS_FILE, LEFT_COLS, 'clean', KEYS_CLEAN_FILE),
+            ('right_recipient', RIGHT_FILE, RIGHT_COLS, 'recipient', RIGHT_RECIPIENT_FILE),
+            ('right_clean', RIGHT_FILE, RIGHT_COLS, 'clean', RIGHT_CLEAN_FILE)]:
+        yield {
+            'name': name,
+            'actions': [
+                (normalize.run, [input_file, columns, form, output_file, RECIPIENT_CACHE]),
+                lambda: {VERSION_KEY: version}
+            ],
+            'file_dep': [input_file],
+            'targets': [output_file],
+            'uptodate': [ (version_unchanged, [version]) ],
+            'verbosity': 2
+        }
+
+KEYS_CLEAN_TABLE = DATA_DIR + '/sample-left-keys.clean.table'
+RIGHT_CLEAN_TABLE = DATA_DIR + '/sample-right.clean.table'
+
+def task_share() -> Iterator[Dict[str, Any]]:
+    """Read normalized left keys and right, write memory-mapped tables for the rescore workers."""
     version: int = 1
+    for name, input_file, columns, table_dir in [
+            ('keys_clean', KEYS_CLEAN_FILE, LEFT_COLS, KEYS_CLEAN_TABLE),
+            ('right_clean', RIGHT_CLEAN_FILE, RIGHT_COLS, RIGHT_CLEAN_TABLE)]:
+        yield {
+            'name': name,
+            'actions': [
+                (shared_table.build, [input_file, columns, table_dir]),
+                lambda: {VERSION_KEY: version}
+            ],
+            'file_dep': [input_file],
+            'targets': [table_dir + '/' + shared_table.MANIFEST],
+            'uptodate': [ (version_unchanged, [version]) ],
+            'verbosity': 2
+        }
+
+CANDIDATES_FILE = DATA_DIR + '/sample-candidates.parquet'
+# the workers read their own splits of the driving tables
+SPLIT_BYTES = 8 * 1024 * 1024
+INDEX_DIR = DATA_DIR + '/sample-right-index'
+INDEX_MANIFEST = INDEX_DIR + '/manifest.json'
+
+def task_index() -> Dict[str, Any]:
+    """Read normalized right, fit the candidate matchers, and save the index and the exact value map."""
+    version: int = 4
     return {
         'actions': [
-            (candidates.run, [LEFT_FILE, RIGHT_FILE, CANDIDATES_FILE]),
+            (candidates.build_index, [RIGHT_RECIPIENT_FILE, INDEX_DIR, True]),
             lambda: {VERSION_KEY: version}
         ],
-        'file_dep': [LEFT_FILE, RIGHT_FILE],
+        'file_dep': [RIGHT_RECIPIENT_FILE, matcher_spec.SPEC_FILE],
+        'targets': [INDEX_MANIFEST],
+        'uptodate': [ (version_unchanged, [version]) ],
+        'verbosity': 2
+    }
+
+BLOCKING_FILE = DATA_DIR + '/sample-right-blocking.pkl'
+# compare only the pairs that share a block, instead of all of them, for a big right table.
+BLOCKING: bool = False
+
+def task_blocking() -> Dict[str, Any]:
+    """Read normalized right, build the token and LSH blocks for candidates."""
+    version: int = 1
+    return {
+        'actions': [
+            (blocking.run, [RIGHT_RECIPIENT_FILE, BLOCKING_FILE, True]),
+            lambda: {VERSION_KEY: version}
+        ],
+        'file_dep': [RIGHT_RECIPIENT_FILE],
+        'targets': [BLOCKING_FILE],
+        'uptodate': [ (version_unchanged, [version]) ],
+        'verbosity': 2
+    }
+
+# keep the best candidates for each left row, and the best for each matcher, see task_candidate_recall.
+CANDIDATES_BEST = 10
+CANDIDATES_MATCHER_BEST = 3
+# left rows with an exact match skip the fuzzy matchers.
+CANDIDATES_EXACT = 'only'
+
+def task_candidates() -> Dict[str, Any]:
+    """Read normalized left keys and the right index, generate candidate pairs."""
+    version: int = 10
+    blocking_file = BLOCKING_FILE if BLOCKING else None
+    args = [KEYS_RECIPIENT_FILE, RIGHT_RECIPIENT_FILE, CANDIDATES_FILE, INDEX_DIR]
+    kwargs = {'normalized': True, 'split_bytes': SPLIT_BYTES, 'blocking_file': blocking_file,
+              'best': CANDIDATES_BEST, 'matcher_best': CANDIDATES_MATCHER_BEST, 'exact': CANDIDATES_EXACT}
+    return {
+        'actions': [
+            (delta.run_candidates if DELTA else candidates.run, args, kwargs),
+            lambda: {VERSION_KEY: version}
+        ],
+        'file_dep': [KEYS_RECIPIENT_FILE, RIGHT_RECIPIENT_FILE, INDEX_MANIFEST] + ([BLOCKING_FILE] if BLOCKING else []),
         'targets': [CANDIDATES_FILE],
         'uptodate': [ (version_unchanged, [version]) ],
         'verbosity': 2
@@ -40,64 +176,126 @@ def task_candidates() -> Dict[str, Any]:
 
 LABEL_FILE = DATA_DIR + '/sample-labeled-scores.csv'
 MODEL_FILE = DATA_DIR + '/sample-model.pkl'
+COMPILED_MODEL_FILE = DATA_DIR + '/sample-model.npz'
+
+def task_candidate_recall() -> Dict[str, Any]:
+    """Read candidates and labeled training, print the fraction of labeled matches found."""
+    return {
+        'actions': [
+            lambda: {'recall': candidates.recall(CANDIDATES_FILE, LABEL_FILE, KEY_MAP_FILE)}
+        ],
+        'file_dep': [CANDIDATES_FILE, LABEL_FILE, KEY_MAP_FILE],
+        'verbosity': 2
+    }
+
+# search the lam grid in parallel, with the spline basis cached, and cross validate with FIT_FOLDS folds, if not None.
+FIT_WORKERS = os.cpu_count() or 1
+FIT_FOLDS = None
+FIT_CACHE_DIR = DATA_DIR + '/fit-basis-cache'
 
 def task_fit() -> Dict[str, Any]:
-    """Read labeled training, fit a model, and save it."""
-    version: int = 1
+    """Read labeled training, fit a model, and save it and its compiled version."""
+    version: int = 3
     return {
         'actions': [
-            (fit.run, [LABEL_FILE, MODEL_FILE]),
+            (fit.run, [LABEL_FILE, MODEL_FILE, COMPILED_MODEL_FILE, FIT_WORKERS, FIT_FOLDS, FIT_CACHE_DIR]),
             lambda: {VERSION_KEY: version}
         ],
         'file_dep': [LABEL_FILE],
-        'targets': [MODEL_FILE],
+        'targets': [MODEL_FILE, COMPILED_MODEL_FILE],
         'uptodate': [ (version_unchanged, [version]) ],
         'verbosity': 2
     }
 
 CHUNK_SIZE = 10000
-SCORE_FILE = DATA_DIR + '/sample-scores.csv'
+SCORE_FILE = DATA_DIR + '/sample-scores.parquet'
+
+# native threads per rescore worker, for the ratios; keep workers times threads near the cores.
+SCORING_THREADS = 1
 
 def task_rescore() -> Dict[str, Any]:
-    """Read candidates, decorate, score again, write all scores."""
-    version: int = 1
+    """Read candidates, score again with shared normalized left keys and right, write all scores."""
+    version: int = 9
     return {
         'actions': [
-            (rescore.run, [CANDIDATES_FILE, CHUNK_SIZE, LEFT_FILE, RIGHT_FILE, SCORE_FILE]),
+            (delta.run_rescore, [CANDIDATES_FILE, CHUNK_SIZE, KEYS_CLEAN_TABLE, RIGHT_CLEAN_TABLE, SCORE_FILE,
+                                 KEYS_CLEAN_FILE, RIGHT_CLEAN_FILE, True, SPLIT_BYTES, SCORING_THREADS]) if DELTA else
+            (rescore.run, [CANDIDATES_FILE, CHUNK_SIZE, KEYS_CLEAN_TABLE, RIGHT_CLEAN_TABLE, SCORE_FILE, True,
+                           False, 100000, True, SPLIT_BYTES, SCORING_THREADS]),
             lambda: {VERSION_KEY: version}
         ],
-        'file_dep': [CANDIDATES_FILE, LEFT_FILE, RIGHT_FILE],
+        'file_dep': [CANDIDATES_FILE, KEYS_CLEAN_TABLE + '/' + shared_table.MANIFEST,
+                     RIGHT_CLEAN_TABLE + '/' + shared_table.MANIFEST],
         'targets': [SCORE_FILE],
         'uptodate': [ (version_unchanged, [version]) ],
         'verbosity': 2
     }
 
-
-SCORE_FILE = DATA_DIR + '/sample-scores.csv'
 THRESHOLD = 0.5
-PREDICTION_FILE = DATA_DIR + '/sample-predictions.csv'
+KEY_PREDICTION_FILE = DATA_DIR + '/sample-key-predictions.parquet'
 
 def task_classify() -> Dict[str, Any]:
-    """Read scores, classify with model, write predictions."""
-    version: int = 1
+    """Read scores, classify with model, write predictions for each left key."""
+    version: int = 6
     return {
         'actions': [
-            (classify.run, [SCORE_FILE, CHUNK_SIZE, MODEL_FILE, THRESHOLD, PREDICTION_FILE]),
+            (delta.run_classify if DELTA else classify.run, [SCORE_FILE, CHUNK_SIZE, COMPILED_MODEL_FILE, THRESHOLD, KEY_PREDICTION_FILE, SPLIT_BYTES]),
             lambda: {VERSION_KEY: version}
         ],
-        'file_dep': [SCORE_FILE, MODEL_FILE],
-        'targets': [PREDICTION_FILE],
+        'file_dep': [SCORE_FILE, COMPILED_MODEL_FILE],
+        'targets': [KEY_PREDICTION_FILE],
         'uptodate': [ (version_unchanged, [version]) ],
         'verbosity': 2
     }
 
+FUSED_KEY_PREDICTION_FILE = DATA_DIR + '/sample-key-predictions-fused.parquet'
+# expand the predictions of rescore_classify, instead of those of rescore and classify.
+FUSED: bool = False
+SAMPLE_SCORE_FILE = DATA_DIR + '/sample-scores-sample.parquet'
+SAMPLE_RATE = 0.001
+
+def task_rescore_classify() -> Dict[str, Any]:
+    """Read candidates, score and classify in one pass, write predictions and a sample of scores."""
+    version: int = 2
+    return {
+        'actions': [
+            (fused.run, [CANDIDATES_FILE, CHUNK_SIZE, KEYS_CLEAN_TABLE, RIGHT_CLEAN_TABLE, COMPILED_MODEL_FILE,
+                         THRESHOLD, FUSED_KEY_PREDICTION_FILE, True, False, 100000, SAMPLE_RATE, SAMPLE_SCORE_FILE,
+                         True, SCORING_THREADS]),
+            lambda: {VERSION_KEY: version}
+        ],
+        'file_dep': [CANDIDATES_FILE, KEYS_CLEAN_TABLE + '/' + shared_table.MANIFEST,
+                     RIGHT_CLEAN_TABLE + '/' + shared_table.MANIFEST, COMPILED_MODEL_FILE],
+        'targets': [FUSED_KEY_PREDICTION_FILE, SAMPLE_SCORE_FILE],
+        'uptodate': [ (version_unchanged, [version]) ],
+        'verbosity': 2
+    }
+
+PREDICTION_FILE = DATA_DIR + '/sample-predictions.csv'
+
+def task_expand() -> Dict[str, Any]:
+    """Read key predictions, classified or fused, fan them out to every left row with that key, and record their schema."""
+    version: int = 4
+    key_prediction_file = FUSED_KEY_PREDICTION_FILE if FUSED else KEY_PREDICTION_FILE
+    return {
+        'actions': [
+            (dedup.expand, [key_prediction_file, KEY_MAP_FILE, PREDICTION_FILE]),
+            lambda: {VERSION_KEY: version, 'fused': FUSED}
+        ],
+        'file_dep': [key_prediction_file, KEY_MAP_FILE],
+        'targets': [PREDICTION_FILE],
+        'uptodate': [ (version_unchanged, [version]),
+                      lambda task, values: values.get('fused') == FUSED ],
+        'verbosity': 2
+    }
+
 PREDICTION_TABLE: str = 'sample_predictions'
 PREDICTION_DDL: str = DATA_DIR + '/sample-predictions.ddl'
 PREDICTION_DDL_TMP: str = DATA_DIR + '/sample-predictions.ddl.tmp'
 
 def task_make_ddl() -> Dict[str, Any]:
-    """Read the dataframe and make a ddl file, archiving the old one."""
-    version: int = 1
+    """Read the recorded schema and make a ddl file, archiving the old one."""
+    version: int = 2
     return {
         'actions': [
             (make_ddl.run, [PREDICTION_FILE, PREDICTION_TABLE, PREDICTION_DDL_TMP]),
@@ -113,18 +311,21 @@ def task_make_ddl() -> Dict[str, Any]:
     }
 
 PSQL = 'psql -p 9700 -d "postgres"'
+DSN = 'port=9700 dbname=postgres'
+LOAD_WORKERS = 4
+PREDICTION_INDEXES = ['left_index', 'right_index']
 
 def task_copy_to_db() -> Dict[str, Any]:
-    """Archive the old table, create and populate the new one."""
-    version: int = 1
+    """Archive the old table, create the new one, stream the predictions in, and index them."""
+    version: int = 2
     return {
         'actions': [
             f'{PSQL} -c "alter table if exists {PREDICTION_TABLE} rename to {PREDICTION_TABLE}{archive_ts()}"',
             f'{PSQL} -f {PREDICTION_DDL}',
-            f'{PSQL} -c "\\copy {PREDICTION_TABLE} from \'{PREDICTION_FILE}\' delimiter \',\' csv header"',
+            (load.run, [PREDICTION_FILE, PREDICTION_TABLE, DSN, None, LOAD_WORKERS, PREDICTION_INDEXES]),
             lambda: {VERSION_KEY: version}
         ],
-        'file_dep': [PREDICTION_DDL],
+        'file_dep': [PREDICTION_DDL, PREDICTION_FILE],
         'uptodate': [ (version_unchanged, [version]) ],
         'verbosity': 2
     }
@@ -1,28 +1,174 @@
 """
 Train and save a GAM model based on the label column.
+
+Optionally also export the model compiled into lookup tables, for classify.
+
+The grid search over the smoothing penalty lam can run in a pool: each grid
+point, or with k-fold cross validation each (grid point, fold), is fit by a
+worker, and its time is printed.  The spline basis (the model matrix) depends on
+the data and the knots, not on lam, so each worker builds it once and reuses it
+for all its grid points, and with a cache_dir, it's also kept on disk for the
+other workers and later runs.
 """
-# pylint: disable=too-many-locals, invalid-name
+# pylint: disable=too-many-locals, invalid-name, too-many-arguments, global-statement
+import hashlib
+import multiprocessing
+import os
 import pickle
-import pandas as pd # type:ignore
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
 from pygam import LogisticGAM # type:ignore
-from sklearn import metrics # type:ignore
-from sklearn.model_selection import train_test_split # type:ignore
+from scipy import sparse # type:ignore
+from sklearn import metrics as sk_metrics # type:ignore
+from sklearn.model_selection import StratifiedKFold, train_test_split # type:ignore
+import columnar
+import compiled_model
+import metrics
+
+# the pygam gridsearch default
+LAMS = np.logspace(-3, 3, 11)
+GAM_ARGS: Dict[str, Any] = {'constraints': None, 'n_splines': 15}
+SEED = 62
+
+# global
+basis_cache: Dict[str, sparse.csc_matrix] = {}
+basis_cache_dir: Optional[str] = None
+
+class CachedLogisticGAM(LogisticGAM):
+    """A LogisticGAM that looks up its model matrix in the basis cache."""
+    def _modelmat(self, X, term=-1):
+        if term != -1:
+            return super()._modelmat(X, term=term)
+        X = np.ascontiguousarray(X, dtype=np.float64)
+        knots = [(type(t).__name__, getattr(t, 'feature', None), getattr(t, 'n_splines', None),
+                  getattr(t, 'spline_order', None), getattr(t, 'basis', None), getattr(t, 'edge_knots_', None))
+                 for t in self.terms]
+        key = hashlib.sha1(X.tobytes() + str(X.shape).encode() + pickle.dumps(knots)).hexdigest()
+        if key not in basis_cache:
+            cache_file = None if basis_cache_dir is None else os.path.join(basis_cache_dir, key + '.npz')
+            with metrics.phase('basis'):
+                if cache_file is not None and os.path.exists(cache_file):
+                    basis_cache[key] = sparse.load_npz(cache_file).tocsc()
+                else:
+                    basis_cache[key] = super()._modelmat(X, term=term)
+                    if cache_file is not None:
+                        _save(cache_file, sparse.csc_matrix(basis_cache[key]))
+        return basis_cache[key]
+
+def _save(cache_file: str, basis: sparse.csc_matrix) -> None:
+    """Write the basis to a temporary file of this worker's own, and rename it into
+    place, since the other workers may be writing the same basis at the same time."""
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(cache_file), suffix='.npz', delete=False) as tmp_f:
+        tmp_file = tmp_f.name
+    try:
+        sparse.save_npz(tmp_file, basis)
+        os.replace(tmp_file, cache_file)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+
+# global
+X_train: Optional[np.ndarray] = None
+y_train: Optional[np.ndarray] = None
+fold_indices: List[Tuple[np.ndarray, np.ndarray]] = []
+def worker_init(X: np.ndarray, y: np.ndarray, folds: List[Tuple[np.ndarray, np.ndarray]],
+                cache_dir: Optional[str] = None) -> None:
+    """Each worker keeps the training, the folds, and its own basis cache."""
+    global X_train, y_train, fold_indices, basis_cache_dir
+    X_train, y_train, fold_indices, basis_cache_dir = X, y, folds, cache_dir
 
-def run(labeled_score_file: str, model_file: str) -> None:
-    """ Read all the training at once (it's small, handmade), train, and save."""
+def worker_fn(lam: float, fold: Optional[int]) -> Dict[str, Any]:
+    """Fit one grid point, on all the training, or on all but the fold.  Returns the
+    time and the score: the UBRE of the fit, or the log loss of the held out fold,
+    lower is better; and the model, or the held out probabilities."""
+    assert X_train is not None and y_train is not None
+    with metrics.chunk('fit'):
+        start = time.perf_counter()
+        if fold is None:
+            with metrics.phase('fit'):
+                model = CachedLogisticGAM(lam=lam, **GAM_ARGS).fit(X_train, y_train)
+            result = {'score': model.statistics_['UBRE'], 'model': _plain(model)}
+        else:
+            train, test = fold_indices[fold]
+            with metrics.phase('fit'):
+                model = CachedLogisticGAM(lam=lam, **GAM_ARGS).fit(X_train[train], y_train[train])
+            with metrics.phase('predict'):
+                proba = model.predict_proba(X_train[test])
+            result = {'score': sk_metrics.log_loss(y_train[test], proba, labels=[0, 1]), 'proba': proba}
+        return dict(result, lam=lam, fold=fold, seconds=time.perf_counter() - start)
 
-    labeled_scores  = pd.read_csv(labeled_score_file, index_col=0)
+def _plain(model: LogisticGAM) -> LogisticGAM:
+    """A plain LogisticGAM with the fitted state of the model, so the pickle doesn't
+    depend on the cache."""
+    plain = LogisticGAM.__new__(LogisticGAM)
+    plain.__dict__.update(model.__dict__)
+    return plain
+
+def gridsearch(X: np.ndarray, y: np.ndarray, workers: int, folds: Optional[int] = None,
+               cache_dir: Optional[str] = None) -> Tuple[LogisticGAM, Optional[np.ndarray]]:
+    """Fit each lam of the grid in the pool, and return the best model.  If folds is
+    specified, choose lam by cross validation, refit it on all the training, and also
+    return the out of fold probabilities of the chosen lam."""
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+    fold_list = [] if folds is None else list(StratifiedKFold(n_splits=folds, shuffle=True, random_state=SEED).split(X, y))
+    tasks = [(lam, fold) for lam in LAMS for fold in ([None] if folds is None else range(folds))]
+    metrics.start('fit')
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(processes=min(workers, len(tasks)), initializer=worker_init,
+                  initargs=(X, y, fold_list, cache_dir)) as pool:
+        results = []
+        for result in pool.starmap(worker_fn, tasks, chunksize=1):
+            fold_name = 'all' if result['fold'] is None else result['fold']
+            print(f"lam {result['lam']:10.4g} fold {fold_name:>3} score {result['score']:.4f} "
+                  f"seconds {result['seconds']:.2f}")
+            results.append(result)
+    metrics.summary()
+    scores: Dict[float, List[float]] = {}
+    for result in results:
+        scores.setdefault(result['lam'], []).append(result['score'])
+    best_lam = min(scores, key=lambda lam: np.mean(scores[lam]))
+    print(f"best lam {best_lam:.4g}")
+    if folds is None:
+        return next(result['model'] for result in results if result['lam'] == best_lam), None
+    oof = np.zeros(len(y))
+    for result in results:
+        if result['lam'] == best_lam:
+            oof[fold_list[result['fold']][1]] = result['proba']
+    worker_init(X, y, [], cache_dir)
+    return _plain(CachedLogisticGAM(lam=best_lam, **GAM_ARGS).fit(X, y)), oof
+
+def run(labeled_score_file: str, model_file: str, compiled_model_file: Optional[str] = None,
+        workers: Optional[int] = None, folds: Optional[int] = None, cache_dir: Optional[str] = None) -> None:
+    """ Read all the training at once (it's small, handmade), train, and save.
+    If compiled_model_file is specified, also export the compiled model there.
+
+    If workers is specified, search the grid in a pool of that many workers, with
+    the basis cached in cache_dir, if specified.  If folds is specified,
+    choose by k-fold cross validation on all the training, and report the out of
+    fold predictions, instead of holding out a test set."""
+
+    labeled_scores  = columnar.read(labeled_score_file, index_col=0)
     X = labeled_scores.drop(columns=labeled_scores.columns[0:3]) # pylint:disable=no-member
     y = labeled_scores['label'] # pylint:disable=unsubscriptable-object
 
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.1, random_state=62)
-
-    model = LogisticGAM(constraints=None, n_splines=15).gridsearch(X_train.values, y_train.values)
+    if folds is not None:
+        model, oof = gridsearch(X.values, y.values, workers or 1, folds, cache_dir)
+        assert oof is not None # with folds, there are out of fold predictions
+        y_test, predictions = y.values, (oof > 0.5).astype(int)
+    else:
+        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.1, random_state=SEED)
+        if workers is not None:
+            model, _ = gridsearch(X_train.values, y_train.values, workers, None, cache_dir)
+        else:
+            model = LogisticGAM(**GAM_ARGS).gridsearch(X_train.values, y_train.values)
+        y_test, predictions = y_test.values, model.predict(X_test.values)
 
-    predictions = model.predict(X_test.values)
-    print(f"Accuracy {metrics.accuracy_score(y_test.values, predictions):.3f}")
+    print(f"Accuracy {sk_metrics.accuracy_score(y_test, predictions):.3f}")
 
-    cm = metrics.confusion_matrix(y_test.values, predictions)
+    cm = sk_metrics.confusion_matrix(y_test, predictions)
     print("confusion matrix")
     print("  TN   FP")
     print("  FN   TP")
@@ -37,5 +183,11 @@ def run(labeled_score_file: str, model_file: str) -> None:
     with open(model_file, 'wb') as model_f:
         pickle.dump(model, model_f)
 
+    if compiled_model_file is not None:
+        compiled_model.export(model, compiled_model_file)
+        compiled = compiled_model.CompiledModel(compiled_model_file)
+        error = np.max(np.abs(compiled.predict_proba(X.values) - model.predict_proba(X.values)))
+        print(f"compiled model max error {error:.6f}")
+
 if __name__ == '__main__':
-    run('sample-data/sample-labeled-scores.csv', 'sample-data/sample-model.pkl')
+    run('sample-data/sample-labeled-scores.csv', 'sample-data/sample-model.pkl', 'sample-data/sample-model.npz')
@@ -0,0 +1,120 @@
+"""
+Rescore and classify in one pass.
+
+Writing all the scores just for classify to read them back and keep the few
+above the threshold is the biggest intermediate file in the pipeline.  Instead,
+each worker scores its chunk, classifies it in memory, and writes only the
+predictions.  Optionally, a random sample of the scored rows is also written,
+for labeling.
+"""
+# pylint: disable=too-many-arguments,too-many-locals
+import os
+from warnings import simplefilter
+import multiprocessing
+from functools import partial
+from typing import List, Optional
+import numpy as np
+import pandas as pd # type:ignore
+import checkpoint
+import classify
+import columnar
+import metrics
+import rescore
+import scheduler
+
+SAMPLE_SEED = 62
+
+def worker_init(model_file: str, left_dir: Optional[str] = None, right_dir: Optional[str] = None,
+                threads: int = 1) -> None:
+    """Load the model and maybe map the shared tables, once per worker, and score
+    with that many threads, like rescore."""
+    classify.worker_init(model_file)
+    rescore.worker_init(left_dir, right_dir, threads)
+
+def worker_fn(chunk: pd.DataFrame, scores_columns: List[str], threshold: float,
+              predictions_filename: str, normalized: bool = False,
+              sample_rate: float = 0.0, sample_filename: Optional[str] = None, start: int = 0) -> int:
+    """Score the chunk, classify it, and write the predictions, and maybe a sample of the scores.
+    Each row is sampled independently, seeded by the chunk's start row, so the sample
+    is the same on a rerun, but different chunks sample different rows, and small
+    chunks contribute too.  Returns the number of predictions written."""
+    with metrics.chunk('rescore_classify'):
+        metrics.count('rows', len(chunk))
+        with metrics.phase('decorate'):
+            chunk = rescore.decorate(chunk)
+        rescore.add_scores(chunk, normalized)
+        scores = chunk[scores_columns]
+        del chunk
+        with metrics.phase('predict'):
+            predictions = classify.predict(scores, threshold)
+        with metrics.phase('write'):
+            columnar.write_chunk(predictions, predictions_filename, index=False, float_format='%.4f')
+            if sample_filename is not None:
+                sampled = np.random.default_rng((SAMPLE_SEED, start)).random(len(scores)) < sample_rate
+                columnar.write_chunk(scores[sampled], sample_filename, index=False)
+        metrics.count('predictions', len(predictions))
+    return len(predictions)
+
+def run(candidate_filename: str, chunk_size: int, left_filename: str, right_filename: str,
+        model_file: str, threshold: float, predictions_filename: str,
+        normalized: bool = False, sort_merge: bool = False, bucket_width: int = 100000,
+        sample_rate: float = 0.0, sample_filename: Optional[str] = None, shared: bool = False,
+        scoring_threads: int = 1) -> None:
+    """Like rescore.run followed by classify.run, without the scores in between.
+    If sample_filename is specified, write the scores of a sample_rate fraction of
+    the candidates there.  The chunk size adapts to the workers, starting at chunk_size.
+    Each worker computes the ratios with scoring_threads native threads, as in rescore.run."""
+    simplefilter(action="ignore", category=pd.errors.PerformanceWarning)
+    candidate_columns: List[str] = columnar.columns(candidate_filename)
+    scores_columns: List[str] = candidate_columns + rescore.NEW_SCORE_COLS
+    sig = checkpoint.signature([candidate_filename, left_filename, right_filename, model_file],
+                               chunk_size=chunk_size, threshold=threshold, normalized=normalized,
+                               sort_merge=sort_merge, bucket_width=bucket_width, sample_rate=sample_rate,
+                               shared=shared)
+    parts = checkpoint.Parts(predictions_filename + '.parts', sig,
+                             os.path.splitext(predictions_filename)[1])
+    sample_parts: Optional[checkpoint.Parts] = None
+    if sample_filename is not None:
+        sample_parts = checkpoint.Parts(sample_filename + '.parts', sig,
+                                        os.path.splitext(sample_filename)[1])
+
+    def finish(start: int, end: int, rows: int) -> None:
+        if sample_parts is not None:
+            sample_parts.finish(start, end, rows)
+        parts.finish(start, end, rows)
+
+    def fail(start: int, end: int, error: BaseException) -> None:
+        if sample_parts is not None:
+            sample_parts.fail(start, end, error)
+        parts.fail(start, end, error)
+
+    sizer = scheduler.ChunkSizer(chunk_size, parts)
+
+    metrics.start('rescore_classify')
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(processes = scheduler.WORKERS, initializer = worker_init,
+                  initargs = (model_file, left_filename, right_filename, scoring_threads) if shared else
+                             (model_file, None, None, scoring_threads)) as pool:
+        sched = scheduler.Scheduler(pool, sizer)
+        rows_read = 0
+        for chunk in rescore.decorated_chunks(candidate_filename, sizer, left_filename, right_filename,
+                                              predictions_filename + '.buckets', sort_merge, bucket_width,
+                                              shared):
+            start, rows_read = rows_read, rows_read + len(chunk)
+            print(f"parent rows {rows_read:10d}")
+            if parts.is_done(start, rows_read) and (sample_parts is None or sample_parts.is_done(start, rows_read)):
+                continue
+            sched.submit(worker_fn, (chunk, scores_columns, threshold, parts.tmp_file(start, rows_read),
+                                     normalized, sample_rate,
+                                     None if sample_parts is None else sample_parts.tmp_file(start, rows_read),
+                                     start),
+                         len(chunk),
+                         callback=partial(finish, start, rows_read),
+                         error_callback=partial(fail, start, rows_read))
+        pool.close()
+        pool.join()
+    if sample_parts is not None and sample_filename is not None:
+        sample_parts.concat(sample_filename, scores_columns)
+    parts.concat(predictions_filename, classify.PREDICTION_COLS)
+    columnar.write_schema(predictions_filename, classify.PREDICTION_DTYPES)
+    metrics.summary()
@@ -0,0 +1,116 @@
+"""
+Ingest the left table once, into a partitioned Parquet dataset.
+
+The left table is a 22M row CSV, and every stage that reads it parses all of its
+rows as text.  run() converts it in one streaming pass into a directory of
+Parquet files, partitioned by Fiscal_Year, hive style (Fiscal_Year=2020/...),
+with only the columns the stages use, and the row index as the left_index column.
+
+scan() reads the left table in either form.  From the dataset, only the requested
+columns are read, and with fiscal_years, only the files of those years: the
+filter is pushed down to pyarrow, which prunes the other partitions without
+opening them.  From a CSV, every row is parsed and filtered after, as before.
+
+pyarrow is required for the dataset.
+"""
+import json
+import os
+import shutil
+from typing import Any, Dict, Iterator, List, Optional
+import numpy as np
+import pandas as pd # type:ignore
+try:
+    import pyarrow as pa # type:ignore
+    import pyarrow.dataset as ds # type:ignore
+except ImportError:
+    pa = None # pylint: disable=invalid-name
+    ds = None # pylint: disable=invalid-name
+import columnar
+
+PARTITION_COL = 'Fiscal_Year'
+INDEX_COL = 'left_index'
+# the columns of the left table that the stages read
+COLUMNS = ['Supplier', 'Invoice_Ship_to_Address']
+# the leading underscore keeps pyarrow from reading it as data
+MANIFEST = '_manifest.json'
+
+def _check() -> None:
+    if pa is None:
+        raise ImportError("pyarrow is required for the left dataset")
+
+def is_dataset(path: str) -> bool:
+    """True if the path is a dataset directory from run(), rather than a CSV file."""
+    return os.path.isdir(path)
+
+def _manifest(dataset_dir: str) -> Dict[str, Any]:
+    with open(os.path.join(dataset_dir, MANIFEST), 'r', encoding='utf8') as manifest_f:
+        return json.load(manifest_f)
+
+def columns(dataset_dir: str) -> List[str]:
+    """The columns of the left table that the dataset has, without the index and the partition."""
+    return _manifest(dataset_dir)['columns']
+
+def run(left_file: str, dataset_dir: str, columns: Optional[List[str]] = None,
+        chunk_size: int = 1000000) -> None:
+    """Scan the left CSV and write the columns to the dataset, partitioned by
+    PARTITION_COL if the left has it.  The manifest is written last."""
+    _check()
+    columns = COLUMNS if columns is None else columns
+    partitioned = PARTITION_COL in columnar.columns(left_file)
+    text_cols = columns + ([PARTITION_COL] if partitioned else [])
+    tmp_dir = dataset_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    rows = 0
+    partitions = set()
+    for idx, chunk in enumerate(pd.read_csv(left_file, engine='c', index_col=0, chunksize=chunk_size,
+                                            usecols=['Unnamed: 0'] + text_cols,
+                                            dtype=dict.fromkeys(text_cols, 'str'), low_memory=False)):
+        chunk = chunk.fillna('')
+        chunk.index = chunk.index.astype(np.int64).rename(INDEX_COL)
+        if partitioned:
+            partitions.update(chunk[PARTITION_COL].unique())
+        ds.write_dataset(pa.Table.from_pandas(chunk.reset_index(), preserve_index=False), tmp_dir,
+                         format='parquet', basename_template=f'part-{idx:06d}-{{i}}.parquet',
+                         partitioning=[PARTITION_COL] if partitioned else None, partitioning_flavor='hive',
+                         existing_data_behavior='overwrite_or_ignore',
+                         file_options=ds.ParquetFileFormat().make_write_options(compression=columnar.COMPRESSION))
+        rows += len(chunk)
+        print(f"ingest rows: {rows:10d}")
+    with open(os.path.join(tmp_dir, MANIFEST), 'w', encoding='utf8') as manifest_f:
+        json.dump({'columns': columns, 'partitioned': partitioned, 'partitions': sorted(partitions),
+                   'rows': rows}, manifest_f)
+    shutil.rmtree(dataset_dir, ignore_errors=True)
+    os.rename(tmp_dir, dataset_dir)
+
+def scan(left_file: str, columns: List[str], chunk_size: int = 100000,
+         fiscal_years: Optional[List[str]] = None) -> Iterator[pd.DataFrame]:
+    """Chunks of the columns of the left table, a CSV or a dataset, indexed by the
+    left index, with empty strings for nulls.  If fiscal_years is specified, only
+    the rows of those years."""
+    if not is_dataset(left_file):
+        text_cols = columns + ([PARTITION_COL] if fiscal_years is not None else [])
+        for chunk in pd.read_csv(left_file, engine='c', index_col=0, chunksize=chunk_size,
+                                 usecols=['Unnamed: 0'] + text_cols, dtype=dict.fromkeys(text_cols, 'str'),
+                                 low_memory=False):
+            if fiscal_years is not None:
+                chunk = chunk[chunk[PARTITION_COL].isin(fiscal_years)]
+            yield chunk[columns].fillna('')
+        return
+    _check()
+    manifest = _manifest(left_file)
+    if fiscal_years is not None and not manifest['partitioned']:
+        raise ValueError(f"{left_file} has no {PARTITION_COL} to filter on")
+    dataset = ds.dataset(left_file, format='parquet',
+                         partitioning=ds.partitioning(pa.schema([(PARTITION_COL, pa.string())]), flavor='hive')
+                         if manifest['partitioned'] else None)
+    batches = dataset.to_batches(columns=[INDEX_COL] + columns, batch_size=chunk_size,
+                                 filter=None if fiscal_years is None else
+                                 ds.field(PARTITION_COL).isin([str(year) for year in fiscal_years]))
+    for batch in batches:
+        if batch.num_rows == 0:
+            continue
+        yield batch.to_pandas().set_index(INDEX_COL).rename_axis(None).fillna('')
+
+if __name__ == '__main__':
+    run('sample-data/sample-left.csv', 'sample-data/sample-left.dataset')
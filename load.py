@@ -0,0 +1,141 @@
+"""
+Stream a CSV or Parquet file into a Postgres table with binary COPY.
+
+psql \\copy parses the CSV in one stream, on the server.  Instead, read the file in
+chunks, encode them in the binary COPY format, and stream them: the BIGINT and
+DOUBLE PRECISION columns of a chunk without nulls are encoded all at once with
+numpy, as fixed-width records.  With more than one worker, each loads its own
+split of the file, on its own connection, into a staging table, which replaces
+the (empty) table only when all the splits are loaded, so a failed load leaves
+the table as it was.  Indexes are created after the load, which is much faster
+than maintaining them during it.
+
+The column types are the ones make_ddl uses, from the recorded schema if there is
+one.  Without a database, the stream can be written to a file instead, which
+psql can load with \\copy ... (format binary).
+
+psycopg (3) is only required to load into a database.
+"""
+# pylint: disable=too-many-arguments
+import multiprocessing
+import struct
+from typing import Any, Iterator, List, Optional, Sequence
+import numpy as np
+import pandas as pd # type:ignore
+try:
+    import psycopg # type:ignore
+    from psycopg import sql # type:ignore
+except ImportError:
+    psycopg = None # pylint: disable=invalid-name
+    sql = None # pylint: disable=invalid-name
+import columnar
+import make_ddl
+import splits
+
+HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+TRAILER = struct.pack('>h', -1)
+# the binary format of the fixed width types, for numpy, and for struct
+FORMATS = {'BIGINT': '>i8', 'DOUBLE PRECISION': '>f8'}
+STRUCT_FORMATS = {'BIGINT': '>q', 'DOUBLE PRECISION': '>d'}
+STAGING_SUFFIX = '_loading'
+SPLIT_BYTES = 64 * 1024 * 1024
+
+def _check() -> None:
+    if psycopg is None:
+        raise ImportError("psycopg is required to load into the database")
+
+def _value(value: Any, coltype: str) -> bytes:
+    if pd.isna(value):
+        return struct.pack('>i', -1)
+    if coltype == 'TEXT':
+        data = str(value).encode('utf8')
+        return struct.pack('>i', len(data)) + data
+    return struct.pack('>i', 8) + struct.pack(STRUCT_FORMATS[coltype], int(value) if coltype == 'BIGINT' else float(value))
+
+def encode(chunk: pd.DataFrame, coltypes: Sequence[str]) -> bytes:
+    """The rows of the chunk in the binary COPY format, without the header and trailer."""
+    if all(coltype in FORMATS for coltype in coltypes) and not chunk.isna().any().any():
+        record = np.dtype([('count', '>i2')] +
+                          [field for idx, coltype in enumerate(coltypes)
+                           for field in [(f'length{idx}', '>i4'), (f'value{idx}', FORMATS[coltype])]])
+        records = np.empty(len(chunk), dtype=record)
+        records['count'] = len(coltypes)
+        for idx, column in enumerate(chunk.columns):
+            records[f'length{idx}'] = 8
+            records[f'value{idx}'] = chunk[column].values
+        return records.tobytes()
+    count = struct.pack('>h', len(coltypes))
+    return b''.join(count + b''.join(_value(value, coltype) for value, coltype in zip(row, coltypes))
+                    for row in chunk.itertuples(index=False))
+
+def _copy(table: str, dsn: str, chunks: Iterator[pd.DataFrame], coltypes: Sequence[str]) -> int:
+    """One COPY of the chunks, in one transaction.  Returns the rows copied."""
+    rows = 0
+    with psycopg.connect(dsn) as conn:
+        with conn.cursor() as cursor:
+            with cursor.copy(sql.SQL('COPY {} FROM STDIN (FORMAT BINARY)').format(sql.Identifier(table))) as copy:
+                copy.write(HEADER)
+                for chunk in chunks:
+                    copy.write(encode(chunk, coltypes))
+                    rows += len(chunk)
+                copy.write(TRAILER)
+    return rows
+
+def split_worker_fn(input_file: str, header: List[str], split: splits.Split, table: str, dsn: str,
+                    coltypes: List[str]) -> int:
+    """Load the split of the input.  Returns the rows copied."""
+    return _copy(table, dsn, iter([splits.read(input_file, header, split)]), coltypes)
+
+def _parallel_copy(input_file: str, table: str, dsn: str, workers: int, coltypes: List[str]) -> int:
+    """Load the splits into a staging table in parallel, then swap it in for the
+    table, which must be empty, in one transaction.  Returns the rows copied."""
+    staging = table + STAGING_SUFFIX
+    with psycopg.connect(dsn) as conn:
+        if conn.execute(sql.SQL('SELECT EXISTS (SELECT 1 FROM {})').format(sql.Identifier(table))).fetchone()[0]:
+            raise ValueError(f"the parallel load needs an empty table, and {table} has rows")
+        conn.execute(sql.SQL('DROP TABLE IF EXISTS {}').format(sql.Identifier(staging)))
+        conn.execute(sql.SQL('CREATE TABLE {} (LIKE {} INCLUDING ALL)').format(sql.Identifier(staging),
+                                                                              sql.Identifier(table)))
+    try:
+        header, input_splits = splits.plan(input_file, SPLIT_BYTES)
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(processes=workers) as pool:
+            rows = sum(pool.starmap(split_worker_fn, [(input_file, header, split, staging, dsn, coltypes)
+                                                      for split in input_splits]))
+    except BaseException:
+        with psycopg.connect(dsn) as conn:
+            conn.execute(sql.SQL('DROP TABLE IF EXISTS {}').format(sql.Identifier(staging)))
+        raise
+    with psycopg.connect(dsn) as conn:
+        conn.execute(sql.SQL('DROP TABLE {}').format(sql.Identifier(table)))
+        conn.execute(sql.SQL('ALTER TABLE {} RENAME TO {}').format(sql.Identifier(staging), sql.Identifier(table)))
+    return rows
+
+def run(input_file: str, table: str, dsn: Optional[str] = None, output_file: Optional[str] = None,
+        workers: int = 1, indexes: Sequence[str] = (), chunk_size: int = 100000) -> None:
+    """Load the input into the existing table, then create the indexes on the given columns.
+    With more than one worker, the table must be empty.  Either way, the load is
+    all or nothing.  If output_file is specified instead of dsn, write the COPY stream there."""
+    _, coltypes = make_ddl.column_types(input_file)
+    if dsn is None:
+        if output_file is None:
+            raise ValueError("either dsn or output_file is required")
+        with open(output_file, 'wb') as output_f:
+            output_f.write(HEADER)
+            for chunk in columnar.read_chunks(input_file, chunk_size):
+                output_f.write(encode(chunk, coltypes))
+            output_f.write(TRAILER)
+        return
+    _check()
+    if workers == 1:
+        rows = _copy(table, dsn, columnar.read_chunks(input_file, chunk_size), coltypes)
+    else:
+        rows = _parallel_copy(input_file, table, dsn, workers, coltypes)
+    print(f"loaded rows: {rows:10d}")
+    with psycopg.connect(dsn) as conn:
+        for column in indexes:
+            conn.execute(sql.SQL('CREATE INDEX ON {} ({})').format(sql.Identifier(table), sql.Identifier(column)))
+        conn.execute(sql.SQL('ANALYZE {}').format(sql.Identifier(table)))
+
+if __name__ == '__main__':
+    run('sample-data/sample-predictions.csv', 'sample_predictions', output_file='sample-data/sample-predictions.copy')
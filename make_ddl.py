@@ -1,34 +1,52 @@
-"""Read a dataframe from csv and make a corresponding create table ddl file."""
+"""Read a dataframe from csv and make a corresponding create table ddl file.
+
+If the file has a schema, Parquet or a CSV with a recorded schema, the types come
+from that, without reading any rows.  Otherwise the whole file is scanned."""
 # pylint: disable=line-too-long
-from typing import List
+from typing import List, Tuple
 import numpy as np
 import pandas as pd # type:ignore
+import columnar
+
+# a column with different types in different chunks gets the wider one
+WIDER = ['BIGINT', 'DOUBLE PRECISION', 'TEXT']
 
 def dtypes_reduce(data_frame, coltypes: List[str]) -> List[str]:
     """Map dataframe types to postgres types"""
     if len(coltypes) == 0:
         coltypes = [''] * len(data_frame.dtypes)
     for idx, dtype in enumerate(data_frame.dtypes):
-        if coltypes[idx] == 'TEXT':
-            continue
         if dtype == object:
-            coltypes[idx] = 'TEXT'
-        elif dtype in (np.float64, np.int64):
-            coltypes[idx] = 'NUMERIC'
+            coltype = 'TEXT'
+        elif dtype in (np.float32, np.float64):
+            coltype = 'DOUBLE PRECISION'
+        elif dtype in (np.int32, np.int64):
+            coltype = 'BIGINT'
         else:
             raise ValueError(f"weird type: {dtype}")
+        if coltypes[idx] == '' or WIDER.index(coltype) > WIDER.index(coltypes[idx]):
+            coltypes[idx] = coltype
     return coltypes
 
-def run(input_filename: str, tablename: str, output_filename: str) -> None:
-    """Read the csv, write the ddl."""
+def column_types(input_filename: str, chunk_size: int = 100000) -> Tuple[pd.DataFrame, List[str]]:
+    """An empty frame with the columns, and their postgres types."""
+    dtypes = columnar.schema(input_filename)
+    if dtypes is not None:
+        df_sample = pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in dtypes.items()})
+        return df_sample, dtypes_reduce(df_sample, [])
     coltypes: List[str] = []
     df_sample = None
-    for df_chunk in pd.read_csv(input_filename, chunksize=10):
+    for df_chunk in columnar.read_chunks(input_filename, chunk_size):
         if df_sample is None:
-            df_sample = df_chunk
+            df_sample = df_chunk.iloc[0:0]
         coltypes = dtypes_reduce(df_chunk, coltypes)
     if df_sample is None:
         raise Exception(f"No data found in {input_filename}")
+    return df_sample, coltypes
+
+def run(input_filename: str, tablename: str, output_filename: str) -> None:
+    """Read the csv, write the ddl."""
+    df_sample, coltypes = column_types(input_filename)
     with open(output_filename, 'w', encoding='utf8') as output_file:
         output_file.write(pd.io.sql.get_schema(df_sample,
                                                tablename,
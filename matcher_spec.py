@@ -0,0 +1,41 @@
+"""
+The fuzzy matchers, declared in matchers.json instead of in code.
+
+Each matcher compares a left field with a right field by the cosine similarity of
+their TF-IDF vectors under a named analyzer, and their weights make the weighted
+mean score.  The analyzers are declared once, by name, and the matchers that use
+the same field and analyzer share its vectorization, see tfidf_index.plan.
+
+The preprocessor of an analyzer is one of PREPROCESSORS, by name.
+"""
+import json
+import os
+from typing import Any, Callable, Dict, List
+import normalize
+import tfidf_index
+
+SPEC_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'matchers.json')
+PREPROCESSORS: Dict[str, Callable[[str], str]] = {'recipient': normalize.recipient}
+
+def _config(analyzer: Dict[str, Any], min_similarity: float, normalized: bool) -> Dict[str, Any]:
+    config = {'min_similarity': min_similarity, 'ngram_size': analyzer['ngram_size'],
+              'analyzer': analyzer['analyzer']}
+    if analyzer.get('preprocessor') is not None and not normalized:
+        if analyzer['preprocessor'] not in PREPROCESSORS:
+            raise ValueError(f"unknown preprocessor {analyzer['preprocessor']}, not one of {list(PREPROCESSORS)}")
+        config['preprocessor'] = PREPROCESSORS[analyzer['preprocessor']]
+    return config
+
+def load(spec_file: str = SPEC_FILE, normalized: bool = False) -> List[tfidf_index.Matcher]:
+    """The matchers, as record_linkage takes them.  If normalized, the input is
+    already preprocessed, so the analyzers don't have preprocessors."""
+    with open(spec_file, 'r', encoding='utf8') as spec_f:
+        spec = json.load(spec_f)
+    matchers: List[tfidf_index.Matcher] = []
+    for matcher in spec['matchers']:
+        if matcher['analyzer'] not in spec['analyzers']:
+            raise ValueError(f"unknown analyzer {matcher['analyzer']}, not one of {list(spec['analyzers'])}")
+        matchers.append((matcher['left'], matcher['right'], matcher['weight'],
+                         _config(spec['analyzers'][matcher['analyzer']], matcher.get('min_similarity', 0.8),
+                                 normalized)))
+    return matchers
@@ -0,0 +1,164 @@
+"""
+Per-chunk timings and counts, as JSON lines, instead of print statements.
+
+The parent of a stage calls start(), before it makes the pool, so the workers
+inherit the run id in the environment.  Each worker wraps a chunk in chunk(),
+and the hot spots inside in phase(), which adds up the time spent in each named
+phase of the current chunk, wherever it's called from.  At the end of the chunk,
+one line with the phase seconds, the counts, and the RSS is appended to the
+metrics file; the lines are small, so appends from different workers don't
+interleave.  At the end of the stage, summary() prints the totals for the run.
+
+The metrics file is set with FUZZY_JOIN_METRICS; without it, nothing is written,
+and the timers are almost free.
+
+Setting FUZZY_JOIN_PROFILE to a filename also profiles one chunk, the first one
+any worker starts, with a sampling profiler: a timer signal records the stack
+every PROFILE_INTERVAL of CPU time, and the stacks are written to the file in the
+"folded" format that flame graph tools read.
+"""
+# pylint: disable=global-statement
+import json
+import os
+import signal
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from types import FrameType
+from typing import Any, Dict, Iterator, Optional
+import psutil # type:ignore
+
+METRICS_ENV = 'FUZZY_JOIN_METRICS'
+RUN_ENV = 'FUZZY_JOIN_RUN'
+PROFILE_ENV = 'FUZZY_JOIN_PROFILE'
+PROFILE_INTERVAL = 0.005
+
+class Chunk:
+    """The measurements of one chunk."""
+    def __init__(self, stage: str) -> None:
+        self.stage = stage
+        self.start = time.time()
+        self.phases: Dict[str, float] = defaultdict(float)
+        self.counts: Dict[str, int] = defaultdict(int)
+
+    def record(self) -> Dict[str, Any]:
+        """The JSON line."""
+        return {'run': os.environ.get(RUN_ENV), 'stage': self.stage, 'pid': os.getpid(),
+                'start': round(self.start, 3), 'seconds': round(time.time() - self.start, 4),
+                'phases': {name: round(seconds, 4) for name, seconds in self.phases.items()},
+                'counts': dict(self.counts),
+                'rss_gb': round(psutil.Process(os.getpid()).memory_info().rss / 1e9, 3)}
+
+# the chunk this process is working on
+current: Optional[Chunk] = None
+
+def start(stage: str) -> None:
+    """In the parent, before the pool: a new run id, for the workers to inherit."""
+    os.environ[RUN_ENV] = f'{stage}-{os.getpid()}-{time.time():.0f}'
+
+@contextmanager
+def chunk(stage: str) -> Iterator[Optional[Chunk]]:
+    """Measure the chunk and write its line at the end.  Nested calls are the same chunk."""
+    global current
+    if current is not None:
+        yield current
+        return
+    current = Chunk(stage)
+    profiler = _Profiler.claim()
+    try:
+        yield current
+    finally:
+        if profiler is not None:
+            profiler.stop()
+        metrics_file = os.environ.get(METRICS_ENV)
+        if metrics_file is not None:
+            with open(metrics_file, 'a', encoding='utf8') as metrics_f:
+                metrics_f.write(json.dumps(current.record()) + '\n')
+        current = None
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """Add the time in the block to the named phase of the current chunk, if any."""
+    if current is None:
+        yield
+        return
+    began = time.perf_counter()
+    try:
+        yield
+    finally:
+        if current is not None:
+            current.phases[name] += time.perf_counter() - began
+
+def count(name: str, value: int) -> None:
+    """Add to the named count of the current chunk, if any."""
+    if current is not None:
+        current.counts[name] += value
+
+class _Profiler:
+    """Samples the stack on a CPU timer signal.  Only works in the main thread, as pool workers are."""
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self.stacks: Counter = Counter()
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, PROFILE_INTERVAL, PROFILE_INTERVAL)
+
+    @staticmethod
+    def claim() -> Optional['_Profiler']:
+        """A profiler, if profiling is on and no other chunk has claimed the file."""
+        filename = os.environ.get(PROFILE_ENV)
+        if filename is None:
+            return None
+        try:
+            os.close(os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return None
+        return _Profiler(filename)
+
+    def _sample(self, _signum: int, frame: Optional[FrameType]) -> None:
+        names = []
+        while frame is not None:
+            names.append(f'{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})')
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(names))] += 1
+
+    def stop(self) -> None:
+        """Stop sampling and write the folded stacks."""
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+        with open(self.filename, 'w', encoding='utf8') as profile_f:
+            for stack, samples in self.stacks.most_common():
+                profile_f.write(f'{stack} {samples}\n')
+
+def summary() -> None:
+    """In the parent, after the pool: print the totals of this run's chunks."""
+    metrics_file = os.environ.get(METRICS_ENV)
+    run = os.environ.get(RUN_ENV)
+    if metrics_file is None or not os.path.exists(metrics_file):
+        return
+    chunks = 0
+    seconds = 0.0
+    max_seconds = 0.0
+    max_rss = 0.0
+    phases: Dict[str, float] = defaultdict(float)
+    counts: Dict[str, int] = defaultdict(int)
+    with open(metrics_file, 'r', encoding='utf8') as metrics_f:
+        for line in metrics_f:
+            record = json.loads(line)
+            if record['run'] != run:
+                continue
+            chunks += 1
+            seconds += record['seconds']
+            max_seconds = max(max_seconds, record['seconds'])
+            max_rss = max(max_rss, record['rss_gb'])
+            for name, value in record['phases'].items():
+                phases[name] += value
+            for name, value in record['counts'].items():
+                counts[name] += value
+    if chunks == 0:
+        return
+    print(f"run {run}: {chunks} chunks, worker seconds {seconds:.1f} "
+          f"(mean {seconds / chunks:.2f}, max {max_seconds:.2f}), max RSS (GB) {max_rss:5.2f}")
+    for name, value in sorted(phases.items(), key=lambda item: -item[1]):
+        print(f"  {name:20s} {value:10.1f} s {100 * value / max(seconds, 1e-9):5.1f}%")
+    for name, total in sorted(counts.items()):
+        print(f"  {name:20s} {total:10d} {total / max(seconds, 1e-9):10.1f} per worker second")
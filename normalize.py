@@ -0,0 +1,182 @@
+"""
+Text normalization shared by the candidates and rescore stages.
+
+Both forms lower case and remove stopwords, in a single pass of one compiled
+pattern.  The "recipient" form, used for candidate generation, also keeps only
+the recipient part of address-like fields; the "clean" form, used for rescoring,
+doesn't.
+
+The same strings come up over and over, so both forms are memoized in a
+bounded cache.  Address parsing is the slowest part, so the extracted recipients
+can also be kept in an on-disk store (sqlite), shared by the pool workers and
+across runs.  The batch path parses each distinct uncached value once, and
+reads and writes the store in bulk.
+
+The run() function writes the normalized columns of a table to a sidecar file
+shaped like the table, so the downstream stages can read normalized text instead
+of recomputing it.
+"""
+# pylint: disable=line-too-long
+import re
+import sqlite3
+from functools import lru_cache
+from typing import Callable, Dict, Iterable, List, Optional
+import pandas as pd # type:ignore
+import usaddress # type:ignore
+import metrics
+import stopwords
+
+CACHE_SIZE = 1 << 18
+
+# Removing stopwords one at a time can join the words of a multi-word stopword,
+# e.g. "north&america", so in a single pass, those are separated by a space or a
+# non-word stopword.
+_SEPARATOR = '(?:' + '|'.join([' '] + [word for word in stopwords.STOPWORDS if not re.search(r'\w', word)]) + ')'
+# longest first, so that alternatives sharing a prefix prefer the longer one.
+STOPWORD_PATTERN = re.compile(r'\b(?:' + '|'.join(word.replace(' ', _SEPARATOR)
+                                                  for word in sorted(stopwords.STOPWORDS, key=len, reverse=True)) + r')\b')
+
+def remove_stopwords(text_field: str) -> str:
+    """Replace each stopword with a space."""
+    return STOPWORD_PATTERN.sub(' ', text_field)
+
+def parse_recipient(addr_str: str) -> str:
+    """ Extract useful terms embedded in addresses."""
+    parsed_addr = usaddress.parse(addr_str)
+    output: List[str] = []
+    for token, label in parsed_addr:
+        if len(output) > 0 and label != 'Recipient':
+            break
+        if label == 'Recipient':
+            output.append(token)
+    return " ".join(output)
+
+class RecipientStore:
+    """On-disk recipients, keyed by the address string.
+
+    Writes are buffered, call flush() to make sure they're saved."""
+    BATCH_SIZE = 500 # stay under the sqlite variable limit
+    FLUSH_SIZE = 10000
+
+    def __init__(self, filename: str) -> None:
+        self.conn = sqlite3.connect(filename, timeout=60)
+        # several workers share the file
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS recipient (addr TEXT PRIMARY KEY, recipient TEXT NOT NULL)')
+        self.conn.commit()
+        self.pending: Dict[str, str] = {}
+
+    def get_many(self, addrs: List[str]) -> Dict[str, str]:
+        """The stored recipients for any of the addrs."""
+        found: Dict[str, str] = {addr: self.pending[addr] for addr in addrs if addr in self.pending}
+        for start in range(0, len(addrs), self.BATCH_SIZE):
+            batch = addrs[start:start + self.BATCH_SIZE]
+            found.update(self.conn.execute(
+                'SELECT addr, recipient FROM recipient WHERE addr IN (' + ','.join('?' * len(batch)) + ')',
+                batch).fetchall())
+        return found
+
+    def put_many(self, recipients: Dict[str, str]) -> None:
+        """Remember these, writing them out if enough are pending."""
+        self.pending.update(recipients)
+        if len(self.pending) >= self.FLUSH_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the pending recipients."""
+        if len(self.pending) == 0:
+            return
+        with self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO recipient VALUES (?, ?)', self.pending.items())
+        self.pending = {}
+
+# global, per process
+store: Optional[RecipientStore] = None
+
+def open_store(filename: Optional[str]) -> None:
+    """Use the on-disk recipient store in this process, or stop using it if filename is None."""
+    global store # pylint: disable=global-statement
+    if store is not None:
+        store.flush()
+    store = None if filename is None else RecipientStore(filename)
+
+def flush_store() -> None:
+    """Write the pending recipients, if there's a store."""
+    if store is not None:
+        store.flush()
+
+@lru_cache(maxsize=CACHE_SIZE)
+def extract_recipient(addr_str: str) -> str:
+    """The recipient part of the address, from the store if it's there."""
+    if store is None:
+        return parse_recipient(addr_str)
+    found = store.get_many([addr_str])
+    if addr_str in found:
+        return found[addr_str]
+    result = parse_recipient(addr_str)
+    store.put_many({addr_str: result})
+    return result
+
+def extract_recipients(addr_strs: Iterable[str]) -> Dict[str, str]:
+    """The batch version of extract_recipient: parse each distinct value once,
+    and read and write the store in bulk.  Returns a map from address to recipient."""
+    distinct = list(set(addr_strs))
+    found = {} if store is None else store.get_many(distinct)
+    parsed = {addr: parse_recipient(addr) for addr in distinct if addr not in found}
+    if store is not None:
+        store.put_many(parsed)
+    found.update(parsed)
+    return found
+
+@lru_cache(maxsize=CACHE_SIZE)
+def clean(text_field: str) -> str:
+    """Lower case and remove stopwords."""
+    return remove_stopwords(text_field.lower())
+
+@lru_cache(maxsize=CACHE_SIZE)
+def recipient(text_field: str) -> str:
+    """Lower case, addr parsing, and remove stopwords."""
+    text_field = text_field.lower()
+    text_field = extract_recipient(text_field) # Removes stuff like "po box 1234 santa monica ca."
+    return remove_stopwords(text_field)
+
+FORMS: Dict[str, Callable[[str], str]] = {
+    'clean': clean,
+    'recipient': recipient
+}
+
+def recipients(values: pd.Series) -> pd.Series:
+    """The batch version of recipient."""
+    lowered = values.str.lower()
+    with metrics.phase('usaddress'):
+        extracted = extract_recipients(lowered)
+    with metrics.phase('stopwords'):
+        return lowered.map(lambda text_field: remove_stopwords(extracted[text_field]))
+
+def run(input_filename: str, columns: List[str], form: str, output_filename: str,
+        recipient_cache: Optional[str] = None, chunk_size: int = 100000) -> None:
+    """Write the index and the normalized columns of the input to the sidecar output.
+    If recipient_cache is specified, keep the extracted recipients there."""
+    open_store(recipient_cache)
+    metrics.start('normalize')
+    with open(output_filename, 'w', encoding='utf8') as output_f:
+        header = True
+        for df_chunk in pd.read_csv(input_filename, engine='c', index_col=0, chunksize=chunk_size,
+                                    usecols=['Unnamed: 0'] + columns, dtype=dict.fromkeys(columns, 'str'),
+                                    low_memory=False):
+            with metrics.chunk('normalize'):
+                metrics.count('rows', len(df_chunk))
+                df_chunk = df_chunk[columns].fillna('')
+                for column in columns:
+                    if form == 'recipient':
+                        df_chunk[column] = recipients(df_chunk[column])
+                    else:
+                        with metrics.phase('clean'):
+                            df_chunk[column] = df_chunk[column].map(FORMS[form])
+                with metrics.phase('write'):
+                    df_chunk.to_csv(output_f, header=header)
+            header = False
+        output_f.flush()
+    flush_store()
+    metrics.summary()
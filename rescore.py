@@ -1,41 +1,67 @@
 """
 Rescore candidates in parallel.
 
-Loads candidates and left and right documents, all in RAM.
+Loads the left and right documents in RAM.
 
 Scans the candidates, does lookup joins on the left and right,
-and sends batches of joined rows to the workers.
+and sends batches of joined rows to the workers, which score whole
+columns at once (see scoring).
 
-TODO: sort and parallel scan the left table and the candidates to avoid
-loading the whole left table for lookups.
+The left table may not fit in RAM, so there's also a sort-merge mode: the
+candidates are partitioned into bucket files by left_index range, i.e. an
+external bucket sort, and then each bucket, sorted, is merge-joined with the
+corresponding rows of a scan of the left table, which must be sorted by its
+index (the left file and the keys file both are).  The parent then holds only
+one bucket and its left rows at a time.
+
+Or the left and right tables can be shared, memory-mapped, by the workers (see
+shared_table), in which case the parent sends only the candidates, and the
+workers look up the text themselves.
 """
-# pylint: disable=fixme,too-many-arguments,protected-access
+# pylint: disable=fixme,too-many-arguments,global-statement,invalid-name
 import os
-import re
-import time
+import shutil
 from warnings import simplefilter
 import multiprocessing
-from typing import Callable, List, Optional
+from functools import partial
+from typing import Callable, Dict, Iterator, List, Optional
 import pandas as pd # type:ignore
-import psutil # type:ignore
-from strsimpy.overlap_coefficient import OverlapCoefficient # type:ignore
-from thefuzz import fuzz # type:ignore
-import stopwords
+import checkpoint
+import columnar
+import ingest
 import lib
-
-def preprocessor(span: str) -> str:
-    """Lower case and remove stopwords, since ngrams don't use stopwords."""
-    span = span.lower()
-    for stopword in stopwords.STOPWORDS:
-        span = re.sub(r'\b' + stopword + r'\b', ' ', span)
-    return span
+import metrics
+import normalize
+import scheduler
+import scoring
+import shared_table
+import splits
 
 def filtered_read(left_filename: str, column_filter: Optional[List[str]] = None,
                   nrows: Optional[int] = None, skiprows: Optional[int] = None,
                   row_filter_cols: Optional[List[str]] = None,
-                  row_filter: Optional[Callable[[pd.DataFrame], bool]] = None) -> pd.DataFrame:
-    """ Read the entire table into RAM in the parent, but only the columns and rows specified."""
-    left_df = pd.DataFrame()
+                  row_filter: Optional[Callable[[pd.DataFrame], bool]] = None,
+                  fiscal_years: Optional[List[str]] = None) -> pd.DataFrame:
+    """ Read the entire table into RAM in the parent, but only the columns and rows specified.
+    The left can be the dataset from ingest.run, which reads only the columns, and
+    only the partitions of the fiscal_years, if specified."""
+    left_dfs: List[pd.DataFrame] = []
+    if ingest.is_dataset(left_filename):
+        if nrows is not None or skiprows is not None:
+            raise ValueError("nrows and skiprows only apply to CSV")
+        columns = ingest.columns(left_filename) if column_filter is None else column_filter
+        for left_df_chunk in ingest.scan(left_filename, columns + [col for col in row_filter_cols or []
+                                                                   if col not in columns],
+                                         fiscal_years=fiscal_years):
+            left_df_chunk = left_df_chunk.fillna('')
+            if row_filter is not None:
+                left_df_chunk = left_df_chunk[row_filter]
+            left_dfs.append(left_df_chunk[columns])
+        if len(left_dfs) == 0:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(left_dfs)
+    if fiscal_years is not None:
+        row_filter_cols = list(set(row_filter_cols or []) | {ingest.PARTITION_COL})
 
     usecols: Optional[List[str]] = None
     if column_filter is not None:
@@ -53,44 +79,152 @@ def filtered_read(left_filename: str, column_filter: Optional[List[str]] = None,
         left_df_chunk = left_df_chunk.fillna('')
         if row_filter is not None:
             left_df_chunk = left_df_chunk[row_filter]
-        left_df_chunk = left_df_chunk[column_filter]
-        left_df = pd.concat([left_df, left_df_chunk])
-    return left_df
+        if fiscal_years is not None:
+            left_df_chunk = left_df_chunk[left_df_chunk[ingest.PARTITION_COL].isin(fiscal_years)]
+        if column_filter is not None:
+            left_df_chunk = left_df_chunk[column_filter]
+        left_dfs.append(left_df_chunk)
+    # concat once at the end, concatenating as we go copies everything over and over.
+    if len(left_dfs) == 0:
+        return pd.DataFrame(columns=column_filter)
+    return pd.concat(left_dfs)
+
+def partition(candidate_filename: str, bucket_dir: str, bucket_width: int,
+              chunk_size: int = 1000000) -> Dict[int, str]:
+    """Split the candidates into files by left_index // bucket_width, the first pass
+    of an external bucket sort.  Returns the bucket files, by bucket."""
+    if os.path.exists(bucket_dir):
+        shutil.rmtree(bucket_dir) # left over from a crash
+    os.makedirs(bucket_dir)
+    candidate_columns = columnar.columns(candidate_filename)
+    bucket_files: Dict[int, str] = {}
+    for chunk in columnar.read_chunks(candidate_filename, chunk_size):
+        for bucket, bucket_chunk in chunk.groupby(chunk['left_index'] // bucket_width):
+            if bucket not in bucket_files:
+                bucket_files[bucket] = os.path.join(bucket_dir, f'{bucket:012d}.csv')
+                lib.write_header(bucket_files[bucket], candidate_columns)
+            bucket_chunk.to_csv(bucket_files[bucket], mode='a', columns=candidate_columns,
+                                header=False, index=False)
+    return bucket_files
+
+class SortedScan:
+    """Scans a table sorted by its index, handing out the rows in order.  The table
+    is a CSV, or an unpartitioned dataset from ingest.run: the partitions of a
+    partitioned one aren't in index order."""
+    def __init__(self, filename: str, columns: List[str], chunk_size: int = 100000) -> None:
+        self.chunks = ingest.scan(filename, columns, chunk_size)
+        self.columns = columns
+        self.buffer: List[pd.DataFrame] = []
+        self.last: Optional[int] = None
+        self.done = False
+
+    def below(self, bound: int) -> pd.DataFrame:
+        """The rows with index below the bound, that haven't been handed out yet."""
+        while not self.done and (self.last is None or self.last < bound):
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                self.done = True
+                break
+            if len(chunk) == 0:
+                continue
+            if not chunk.index.is_monotonic_increasing or (self.last is not None and chunk.index[0] <= self.last):
+                raise ValueError("the left table must be sorted by its index for the merge join, "
+                                 "and a dataset must not be partitioned")
+            self.buffer.append(chunk)
+            self.last = chunk.index[-1]
+        if len(self.buffer) == 0:
+            return pd.DataFrame(columns=self.columns)
+        rows = pd.concat(self.buffer) if len(self.buffer) > 1 else self.buffer[0]
+        split = rows.index.searchsorted(bound)
+        self.buffer = [rows.iloc[split:]] if split < len(rows) else []
+        return rows.iloc[:split]
+
+def hash_join(candidate_filename: str, chunk_size: columnar.ChunkSize, left_filename: str) -> Iterator[pd.DataFrame]:
+    """Candidate chunks, decorated by lookup in the whole left table, in RAM."""
+    # the dataset is read whole, the CSV only its first rows
+    left_table: pd.DataFrame = filtered_read(left_filename, column_filter=LEFT_COLS,
+                                             nrows=None if ingest.is_dataset(left_filename) else 100000,
+                                             skiprows=None, row_filter_cols=None,
+                                             #fiscal_years=['2020'])
+                                             row_filter=None)
+    for chunk in columnar.read_chunks(candidate_filename, chunk_size, nrows=2000000):
+        yield chunk.merge(left_table, left_on='left_index', right_index=True, how='left')
+
+def merge_join(candidate_filename: str, chunk_size: columnar.ChunkSize, left_filename: str,
+               bucket_dir: str, bucket_width: int) -> Iterator[pd.DataFrame]:
+    """Candidate chunks, sorted by left_index, decorated by merging with a scan of the left table."""
+    bucket_files = partition(candidate_filename, bucket_dir, bucket_width)
+    left_scan = SortedScan(left_filename, LEFT_COLS)
+    position = 0
+    for bucket in sorted(bucket_files):
+        candidates = pd.read_csv(bucket_files[bucket]).sort_values('left_index', kind='stable',
+                                                                   ignore_index=True)
+        left_rows = left_scan.below((bucket + 1) * bucket_width)
+        candidates = candidates.merge(left_rows, left_on='left_index', right_index=True, how='left')
+        start = 0
+        while start < len(candidates):
+            end = start + columnar.size_at(chunk_size, position)
+            yield candidates.iloc[start:end]
+            position += len(candidates.iloc[start:end])
+            start = end
+        os.remove(bucket_files[bucket])
+    os.rmdir(bucket_dir)
+
+# global
+shared_left: Optional[shared_table.SharedTable] = None
+shared_right: Optional[shared_table.SharedTable] = None
+scoring_threads: int = 1
+def worker_init(left_dir: Optional[str] = None, right_dir: Optional[str] = None, threads: int = 1) -> None:
+    """If the tables are shared, each worker maps them once.  Each worker scores
+    with that many threads."""
+    global shared_left, shared_right, scoring_threads
+    scoring_threads = threads
+    if left_dir is not None and right_dir is not None:
+        shared_left = shared_table.SharedTable(left_dir)
+        shared_right = shared_table.SharedTable(right_dir)
+
+def decorate(chunk: pd.DataFrame) -> pd.DataFrame:
+    """Look up the left and right text for the candidate chunk, in the shared tables."""
+    if shared_left is None or shared_right is None:
+        return chunk # the parent did it
+    left = shared_left.lookup(chunk['left_index'].values)[LEFT_COLS].set_axis(chunk.index)
+    right = shared_right.lookup(chunk['right_index'].values)[RIGHT_COLS].set_axis(chunk.index)
+    return pd.concat([left, right, chunk], axis=1)
+
+def add_scores(chunk: pd.DataFrame, normalized: bool = False) -> None:
+    """Add the score columns to the chunk.
+    If normalized, the text is already in the "clean" form, so use it as is."""
+    # ngrams don't use stopwords
+    preprocessor: Callable[[str], str] = str if normalized else normalize.clean
+    with metrics.phase('normalize'):
+        lefts = [chunk[column].astype(str).map(preprocessor).tolist() for column in LEFT_COLS]
+        rights = [chunk[column].astype(str).map(preprocessor).tolist() for column in RIGHT_COLS]
+    for column, values in scoring.score(lefts, rights, workers=scoring_threads).items():
+        chunk[column] = values
 
 def worker_fn(chunk: pd.DataFrame,
               scores_columns: List[str],
-              scores_filename: str) -> int:
+              scores_filename: str,
+              normalized: bool = False) -> int:
     """Add some columns to the chunk and then write the specified columns."""
-    #TODO: DRY scores_columns somehow, e.g. with a dictionary of callables or something?
-    # maybe since this is just the cartesian product i can just use lists.
-    # methods = List[Callable[[str, str], float]
-    # left_fields = List[str]
-    # right_fields = List[str]
-    # or something like that?  maybe it's ok as is though.
-    overlap = OverlapCoefficient(k=3)
-    for idx, row in chunk.iterrows():
-        left_1 = preprocessor(str(row['Supplier']))
-        left_2 = preprocessor(str(row['Invoice_Ship_to_Address']))
-        right_1 = preprocessor(str(row['Partner_Name']))
-        right_2 = preprocessor(str(row['DBA']))
-
-        chunk.at[idx, 'overlap11'] = overlap.similarity(left_1, right_1)
-        chunk.at[idx, 'ratio11'] = fuzz.token_set_ratio(left_1, right_1)/100
-        chunk.at[idx, 'overlap12'] = overlap.similarity(left_1, right_2)
-        chunk.at[idx, 'ratio12'] = fuzz.token_set_ratio(left_1, right_2)/100
-        chunk.at[idx, 'overlap21'] = overlap.similarity(left_2, right_1)
-        chunk.at[idx, 'ratio21'] = fuzz.token_set_ratio(left_2, right_1)/100
-        chunk.at[idx, 'overlap22'] = overlap.similarity(left_2, right_2)
-        chunk.at[idx, 'ratio22'] = fuzz.token_set_ratio(left_2, right_2)/100
-
-    with open(scores_filename, 'a', encoding='utf8') as scores_f:
-        chunk.to_csv(scores_f, columns=scores_columns, header=False)
-        scores_f.flush()
-    print(f"worker {os.getpid()} finished "
-          f"RSS (GB) {psutil.Process(os.getpid()).memory_info().rss/1e9:5.2f} "
-          f"start {min(chunk.index):10d} end {max(chunk.index):10d}")
+    with metrics.chunk('rescore'):
+        metrics.count('rows', len(chunk))
+        with metrics.phase('decorate'):
+            chunk = decorate(chunk)
+        add_scores(chunk, normalized)
+        with metrics.phase('write'):
+            columnar.write_chunk(chunk, scores_filename, columns=scores_columns)
     return len(chunk)
 
+def split_worker_fn(candidate_filename: str, header: List[str], split: splits.Split,
+                    scores_columns: List[str], scores_filename: str, normalized: bool = False) -> int:
+    """Read the split of the candidates, and score it like worker_fn.  The tables must be shared."""
+    with metrics.chunk('rescore'):
+        with metrics.phase('read'):
+            chunk = splits.read(candidate_filename, header, split)
+        return worker_fn(chunk, scores_columns, scores_filename, normalized)
+
 # TODO: externalize these
 LEFT_COLS = ['Supplier', 'Invoice_Ship_to_Address']
 RIGHT_COLS = ['Partner_Name', 'DBA']
@@ -105,42 +239,85 @@ NEW_SCORE_COLS = [
         'ratio22'
     ]
 
+def decorated_chunks(candidate_filename: str, chunk_size: columnar.ChunkSize, left_filename: str, right_filename: str,
+                     bucket_dir: str, sort_merge: bool = False,
+                     bucket_width: int = 100000, shared: bool = False) -> Iterator[pd.DataFrame]:
+    """Candidate chunks, with the left and right text columns, unless the tables
+    are shared, in which case the workers look them up."""
+    if shared:
+        yield from columnar.read_chunks(candidate_filename, chunk_size)
+        return
+    right_table: pd.DataFrame = filtered_read(right_filename, column_filter=RIGHT_COLS)
+    candidate_columns: List[str] = columnar.columns(candidate_filename)
+    # candidates is the driving table
+    chunks: Iterator[pd.DataFrame] = (
+        merge_join(candidate_filename, chunk_size, left_filename, bucket_dir, bucket_width)
+        if sort_merge else hash_join(candidate_filename, chunk_size, left_filename))
+    for chunk in chunks:
+        # the left is already there
+        chunk = chunk.merge(right_table, left_on='right_index', right_index=True, how='left')
+        yield chunk[LEFT_COLS + RIGHT_COLS + candidate_columns]
+
 def run(candidate_filename: str, chunk_size: int, left_filename: str, right_filename: str,
-        scores_filename: str) -> None:
+        scores_filename: str, normalized: bool = False, sort_merge: bool = False,
+        bucket_width: int = 100000, shared: bool = False, split_bytes: Optional[int] = None,
+        scoring_threads: int = 1) -> None:
     """Load the decorators in RAM, scan the matches in chunks, decorate the chunks,
-    and hand them to the workers for processing."""
-    simplefilter(action="ignore", category=pd.errors.PerformanceWarning)
-    left_table: pd.DataFrame = filtered_read(left_filename, column_filter=LEFT_COLS, nrows=100000,
-                                             skiprows=None, row_filter_cols=None,
-                                             #skiprows=None, row_filter_cols=['Fiscal_Year'],
-                                             #row_filter=lambda x: x['Fiscal_Year']=='2020')
-                                             row_filter=None)
-    right_table: pd.DataFrame = filtered_read(right_filename, column_filter=RIGHT_COLS)
+    and hand them to the workers for processing.  If normalized, the left and right
+    files are "clean" sidecars from normalize.run.  If sort_merge, the left table
+    isn't loaded, it's merge-joined with the candidates in buckets of bucket_width
+    left rows.  If shared, the left and right are shared table directories from
+    shared_table.build, which the workers map, and the parent doesn't load either.
+    And if split_bytes is also specified, the workers read the candidates too, in
+    splits of about that size, or by row group for Parquet.
+
+    Each chunk is written to its own part file, so a rerun resumes where a crashed
+    run stopped.  The chunk size adapts to the workers, starting at chunk_size.
 
-    candidate_columns: List[str] = list(pd.read_csv(candidate_filename, nrows=0).columns)
+    Each worker computes the ratios with scoring_threads native threads, if rapidfuzz
+    is installed, so keep workers times scoring_threads near the number of cores."""
+    simplefilter(action="ignore", category=pd.errors.PerformanceWarning)
+    candidate_columns: List[str] = columnar.columns(candidate_filename)
     scores_columns: List[str] = candidate_columns + NEW_SCORE_COLS
-    lib.write_header(scores_filename, scores_columns)
+    parts = checkpoint.Parts(scores_filename + '.parts',
+                             checkpoint.signature([candidate_filename, left_filename, right_filename],
+                                                  chunk_size=chunk_size, normalized=normalized,
+                                                  sort_merge=sort_merge, bucket_width=bucket_width,
+                                                  shared=shared, split_bytes=split_bytes),
+                             os.path.splitext(scores_filename)[1])
+
+    sizer = scheduler.ChunkSizer(chunk_size, parts)
 
+    metrics.start('rescore')
     ctx = multiprocessing.get_context('spawn')
-    with ctx.Pool(processes = 6) as pool:
-        # candidates is the driving table
+    with ctx.Pool(processes = scheduler.WORKERS, initializer = worker_init,
+                  initargs = (left_filename, right_filename, scoring_threads) if shared else
+                             (None, None, scoring_threads)) as pool:
+        sched = scheduler.Scheduler(pool, sizer)
+        if shared and split_bytes is not None:
+            header, candidate_splits = splits.plan(candidate_filename, split_bytes)
+            for split in candidate_splits:
+                if parts.is_done(*split):
+                    continue
+                sched.submit(split_worker_fn, (candidate_filename, header, split, scores_columns,
+                                               parts.tmp_file(*split), normalized), 0,
+                             callback=partial(parts.finish, *split),
+                             error_callback=partial(parts.fail, *split))
         rows_read = 0
-        for chunk in pd.read_csv(candidate_filename, chunksize=chunk_size, nrows=2000000):
-            rows_read += chunk_size
+        for chunk in ([] if shared and split_bytes is not None else
+                      decorated_chunks(candidate_filename, sizer, left_filename, right_filename,
+                                       scores_filename + '.buckets', sort_merge, bucket_width, shared)):
+            start, rows_read = rows_read, rows_read + len(chunk)
             print(f"parent rows {rows_read:10d}")
-            # decorate the candidates with left and right data
-            chunk = chunk.merge(left_table, left_on='left_index', right_index=True, how='left')
-            chunk = chunk.merge(right_table, left_on='right_index', right_index=True, how='left')
-            chunk = chunk[LEFT_COLS + RIGHT_COLS + candidate_columns]
-
-            pool.apply_async(worker_fn, (chunk, scores_columns, scores_filename),
-                             callback=lambda x: print(f"worker rows written: {x:10d}"),
-                             error_callback=lambda x: print(f"error: {x}"))
-            # avoid over-filling the queue
-            while pool._taskqueue.qsize() > 12: # type:ignore
-                time.sleep(1)
+            if parts.is_done(start, rows_read):
+                continue
+            sched.submit(worker_fn, (chunk, scores_columns, parts.tmp_file(start, rows_read), normalized), len(chunk),
+                         callback=partial(parts.finish, start, rows_read),
+                         error_callback=partial(parts.fail, start, rows_read))
         pool.close()
         pool.join()
+    parts.concat(scores_filename, scores_columns)
+    metrics.summary()
 
 if __name__ == '__main__':
     run('sample-data/sample-candidates.csv',
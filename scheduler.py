@@ -0,0 +1,97 @@
+"""
+Submit chunks to the worker pool, with a bounded number in flight, and adapt the
+chunk size to what the workers measure.
+
+Instead of polling the pool's task queue, the reader blocks on a semaphore that
+the result callbacks release, so it stays a few chunks ahead of the workers
+without stalling.
+
+Each task reports its latency and the worker's RSS.  The chunk sizer aims for
+chunks that take about TARGET_SECONDS, and shrinks them if the workers get near
+their share of the memory budget.  The chunk boundaries follow the finished
+checkpoint parts, so a rerun skips the same chunks whatever the sizes.
+
+The worker count and the memory budget can be set in the environment, with
+FUZZY_JOIN_WORKERS and FUZZY_JOIN_MEMORY_GB.
+"""
+import os
+import threading
+import time
+from multiprocessing.pool import Pool
+from typing import Any, Callable, Optional, Sequence, Tuple
+import psutil # type:ignore
+import checkpoint
+
+WORKERS = int(os.environ.get('FUZZY_JOIN_WORKERS', os.cpu_count() or 1))
+# for all the workers together, default is most of the machine
+MEMORY_BUDGET = float(os.environ.get('FUZZY_JOIN_MEMORY_GB',
+                                     0.75 * psutil.virtual_memory().total / 1e9)) * 1e9
+TARGET_SECONDS = 10.0
+# each step changes the size by at most this factor
+MAX_STEP = 2.0
+
+def timed(worker_fn: Callable[..., Any], *args: Any) -> Tuple[Any, float, int]:
+    """Runs in the worker: the result, seconds, and RSS after."""
+    start = time.perf_counter()
+    result = worker_fn(*args)
+    return result, time.perf_counter() - start, psutil.Process(os.getpid()).memory_info().rss
+
+class ChunkSizer:
+    """The size of the next chunk, adapted to the latency and memory of the previous ones.
+    Call it with the row position of the chunk start."""
+    def __init__(self, initial: int, parts: Optional[checkpoint.Parts] = None,
+                 workers: int = WORKERS, min_size: int = 100, max_size: Optional[int] = None) -> None:
+        self.size = initial
+        self.parts = parts
+        self.memory_budget = MEMORY_BUDGET / workers
+        self.min_size = min_size
+        self.max_size = max_size if max_size is not None else initial * 100
+        self.lock = threading.Lock()
+
+    def __call__(self, position: int) -> int:
+        with self.lock:
+            size = self.size
+        if self.parts is not None:
+            return self.parts.chunk_size(position, size)
+        return size
+
+    def update(self, rows: int, seconds: float, rss: int) -> None:
+        """Adjust the size given a finished chunk."""
+        if rows == 0:
+            return
+        with self.lock:
+            wanted = rows * TARGET_SECONDS / max(seconds, 1e-3)
+            if rss > self.memory_budget:
+                wanted = min(wanted, self.size * self.memory_budget / rss)
+            wanted = min(max(wanted, self.size / MAX_STEP), self.size * MAX_STEP)
+            self.size = int(min(max(wanted, self.min_size), self.max_size))
+
+class Scheduler:
+    """Submits tasks to the pool, blocking while too many are in flight."""
+    def __init__(self, pool: Pool, sizer: Optional[ChunkSizer] = None,
+                 max_in_flight: int = 2 * WORKERS) -> None:
+        self.pool = pool
+        self.sizer = sizer
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+
+    def submit(self, worker_fn: Callable[..., Any], args: Sequence[Any], rows: int,
+               callback: Callable[[Any], None], error_callback: Callable[[BaseException], None]) -> None:
+        """Like apply_async, once there's room.  rows is the chunk size, for the sizer."""
+        self.in_flight.acquire() # pylint: disable=consider-using-with
+
+        def done(timed_result: Tuple[Any, float, int]) -> None:
+            try:
+                result, seconds, rss = timed_result
+                if self.sizer is not None:
+                    self.sizer.update(rows, seconds, rss)
+                callback(result)
+            finally:
+                self.in_flight.release()
+
+        def failed(error: BaseException) -> None:
+            try:
+                error_callback(error)
+            finally:
+                self.in_flight.release()
+
+        self.pool.apply_async(timed, (worker_fn, *args), callback=done, error_callback=failed)
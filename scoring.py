@@ -0,0 +1,92 @@
+"""
+Batch scoring of the rescore similarity features.
+
+Scoring row by row rebuilds the shingle profile of each string for every pair,
+even though the same right strings appear in many pairs.  Instead, take whole
+columns: shingle each distinct string once, and compute the overlap coefficient
+from the cached shingle sets.
+
+The token set ratio is computed with rapidfuzz if it's installed, which runs
+in native threads without the GIL, on strings processed the way thefuzz does,
+and rounded the way thefuzz does, so the features are the same as before.
+Otherwise it uses thefuzz, once per distinct pair.
+
+The features must stay the same, since the model was trained on them.
+"""
+from typing import Dict, List, Sequence, Set, Tuple
+import numpy as np
+from strsimpy.overlap_coefficient import OverlapCoefficient # type:ignore
+from thefuzz import fuzz, utils # type:ignore
+try:
+    from rapidfuzz import fuzz as rapid_fuzz, process as rapid_process # type:ignore
+except ImportError:
+    rapid_fuzz = None # pylint: disable=invalid-name
+    rapid_process = None # pylint: disable=invalid-name
+import metrics
+
+SHINGLE_SIZE = 3
+
+def overlap_scores(lefts: Sequence[str], rights: Sequence[str]) -> np.ndarray:
+    """The same as OverlapCoefficient(k=3).similarity for each pair."""
+    overlap = OverlapCoefficient(k=SHINGLE_SIZE)
+    shingles: Dict[str, Set[str]] = {text: set(overlap.get_profile(text))
+                                     for text in set(lefts).union(rights)}
+    result = np.empty(len(lefts))
+    for idx, (left, right) in enumerate(zip(lefts, rights)):
+        left_shingles, right_shingles = shingles[left], shingles[right]
+        if left == right or len(left_shingles) == 0 or len(right_shingles) == 0:
+            # the edge cases are up to the library
+            result[idx] = overlap.similarity(left, right)
+        else:
+            result[idx] = len(left_shingles & right_shingles) / min(len(left_shingles), len(right_shingles))
+    return result
+
+def ratio_scores(lefts: Sequence[str], rights: Sequence[str], workers: int = 1) -> np.ndarray:
+    """The same as fuzz.token_set_ratio/100 for each pair."""
+    if len(lefts) == 0:
+        return np.empty(0)
+    if rapid_process is None or not hasattr(rapid_process, 'cpdist'):
+        ratios: Dict[Tuple[str, str], int] = {}
+        result = np.empty(len(lefts))
+        for idx, pair in enumerate(zip(lefts, rights)):
+            if pair not in ratios:
+                ratios[pair] = fuzz.token_set_ratio(*pair)
+            result[idx] = ratios[pair]
+        return result / 100
+    processed = {text: utils.full_process(text, force_ascii=True) for text in set(lefts).union(rights)}
+    left_processed = [processed[left] for left in lefts]
+    right_processed = [processed[right] for right in rights]
+    scores = rapid_process.cpdist(left_processed, right_processed, scorer=rapid_fuzz.token_set_ratio,
+                                  processor=None, workers=workers, dtype=np.float64)
+    # thefuzz rounds to an int, and calls it zero if either side is empty.
+    empty = np.array([len(left) == 0 or len(right) == 0
+                      for left, right in zip(left_processed, right_processed)], dtype=bool)
+    # np.rint rounds half to even, like int(round()).
+    return np.where(empty, 0, np.rint(scores)) / 100
+
+def check_ratio_scores(lefts: Sequence[str], rights: Sequence[str]) -> None:
+    """Raise if ratio_scores differs from fuzz.token_set_ratio on any pair."""
+    expected = np.array([fuzz.token_set_ratio(left, right) for left, right in zip(lefts, rights)]) / 100
+    actual = ratio_scores(lefts, rights)
+    mismatches = np.flatnonzero(actual != expected)
+    if len(mismatches) > 0:
+        idx = mismatches[0]
+        raise ValueError(f"{len(mismatches)} ratio mismatches, e.g. {lefts[idx]!r} {rights[idx]!r}: "
+                         f"{actual[idx]} != {expected[idx]}")
+
+def score(lefts: List[Sequence[str]], rights: List[Sequence[str]], workers: int = 1) -> Dict[str, np.ndarray]:
+    """All the features for the left and right columns: overlapIJ and ratioIJ,
+    for left column I and right column J, counting from 1."""
+    features: Dict[str, np.ndarray] = {}
+    for i, left in enumerate(lefts, start=1):
+        for j, right in enumerate(rights, start=1):
+            with metrics.phase('overlap'):
+                features[f'overlap{i}{j}'] = overlap_scores(left, right)
+            with metrics.phase('ratio'):
+                features[f'ratio{i}{j}'] = ratio_scores(left, right, workers)
+    return features
+
+if __name__ == '__main__':
+    check_ratio_scores(['acme corp', 'Acme Corp.', 'foo co', '', 'ab', 'caf\u00e9 inc', 'west coast supply'],
+                       ['acme', 'ACME corporation', 'bar', 'acme', 'abc', 'cafe', 'coast west supply co'])
+    print("ratio scores match")
@@ -0,0 +1,93 @@
+"""
+A table of text columns in memory-mapped files, for the workers to share.
+
+Instead of each worker parsing its own copy of a table, or the parent merging
+the text into every chunk and pickling it to a worker, the table is written
+once to a directory of flat binary files: for each column, the utf8 bytes of all
+the values end to end, and their offsets; and the index values, sorted, with
+their row positions, for lookups.  Each worker memory-maps the files, so the
+pages are shared by all the workers through the page cache, and looks up only
+the rows it needs.
+
+The table is written in one streaming pass, so it doesn't need to fit in RAM.
+"""
+import json
+import os
+from typing import Dict, List, Sequence
+import numpy as np
+import pandas as pd # type:ignore
+
+MANIFEST = 'manifest.json'
+
+def _path(table_dir: str, name: str) -> str:
+    return os.path.join(table_dir, name)
+
+def build(input_file: str, columns: List[str], table_dir: str, chunk_size: int = 100000) -> None:
+    """Scan the input and write its index and the columns to the table directory."""
+    os.makedirs(table_dir, exist_ok=True)
+    offsets: Dict[str, int] = dict.fromkeys(columns, 0)
+    index_parts: List[np.ndarray] = []
+    rows = 0
+    blob_files = {column: open(_path(table_dir, f'{column}.blob'), 'wb') for column in columns} # pylint: disable=consider-using-with
+    offset_files = {column: open(_path(table_dir, f'{column}.offsets'), 'wb') for column in columns} # pylint: disable=consider-using-with
+    try:
+        for column in columns:
+            np.zeros(1, dtype=np.int64).tofile(offset_files[column])
+        for df_chunk in pd.read_csv(input_file, engine='c', index_col=0, chunksize=chunk_size,
+                                    usecols=['Unnamed: 0'] + columns, dtype=dict.fromkeys(columns, 'str'),
+                                    low_memory=False):
+            df_chunk = df_chunk.fillna('')
+            index_parts.append(df_chunk.index.values.astype(np.int64))
+            rows += len(df_chunk)
+            for column in columns:
+                encoded = [value.encode('utf8') for value in df_chunk[column]]
+                lengths = np.fromiter((len(value) for value in encoded), dtype=np.int64, count=len(encoded))
+                (offsets[column] + np.cumsum(lengths)).tofile(offset_files[column])
+                offsets[column] += int(lengths.sum())
+                blob_files[column].write(b''.join(encoded))
+    finally:
+        for output_f in list(blob_files.values()) + list(offset_files.values()):
+            output_f.close()
+    index = np.concatenate(index_parts) if len(index_parts) > 0 else np.zeros(0, dtype=np.int64)
+    order = np.argsort(index, kind='stable')
+    index[order].tofile(_path(table_dir, 'sorted_index'))
+    order.astype(np.int64).tofile(_path(table_dir, 'order'))
+    # the manifest is written last, so its presence means the table is complete.
+    with open(_path(table_dir, MANIFEST), 'w', encoding='utf8') as manifest_f:
+        json.dump({'columns': columns, 'rows': rows}, manifest_f)
+
+def _memmap(filename: str, dtype: type) -> np.ndarray:
+    if os.path.getsize(filename) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r')
+
+class SharedTable:
+    """The memory-mapped table."""
+    def __init__(self, table_dir: str) -> None:
+        with open(_path(table_dir, MANIFEST), 'r', encoding='utf8') as manifest_f:
+            manifest = json.load(manifest_f)
+        self.columns: List[str] = manifest['columns']
+        self.sorted_index = _memmap(_path(table_dir, 'sorted_index'), np.int64)
+        self.order = _memmap(_path(table_dir, 'order'), np.int64)
+        self.blobs = {column: _memmap(_path(table_dir, f'{column}.blob'), np.uint8) for column in self.columns}
+        self.offsets = {column: _memmap(_path(table_dir, f'{column}.offsets'), np.int64)
+                        for column in self.columns}
+
+    def lookup(self, index_values: Sequence[int]) -> pd.DataFrame:
+        """The rows with these index values, in the same order, like a left join:
+        missing rows are NaN."""
+        index_values = np.asarray(index_values, dtype=np.int64)
+        if len(self.sorted_index) == 0:
+            found = np.zeros(len(index_values), dtype=bool)
+            rows = np.zeros(len(index_values), dtype=np.int64)
+        else:
+            positions = np.minimum(np.searchsorted(self.sorted_index, index_values), len(self.sorted_index) - 1)
+            found = self.sorted_index[positions] == index_values
+            rows = np.where(found, self.order[positions], 0)
+        result = {}
+        for column in self.columns:
+            blob, offsets = self.blobs[column], self.offsets[column]
+            starts, ends = offsets[rows], offsets[rows + 1]
+            result[column] = [bytes(blob[start:end]).decode('utf8') if is_found else np.nan
+                              for start, end, is_found in zip(starts, ends, found)]
+        return pd.DataFrame(result, columns=self.columns)
@@ -0,0 +1,78 @@
+"""
+Split a driving table into ranges that the workers read and parse themselves.
+
+Parsing the whole table in the parent, and pickling every chunk to a worker,
+caps the throughput once the workers get fast.  Instead, the parent only plans
+the splits, and hands each worker a (start, end) range to read.
+
+For CSV, the ranges are byte offsets, at the ends of lines, but not inside
+quoted fields, which can contain newlines: a quote-parity scan finds them,
+vectorized with numpy, which is much faster than parsing.  For Parquet, the
+ranges are row group numbers.
+"""
+import csv
+import io
+from typing import Any, List, Tuple
+import numpy as np
+import pandas as pd # type:ignore
+import columnar
+
+SPLIT_BYTES = 32 * 1024 * 1024
+SCAN_BYTES = 64 * 1024 * 1024
+QUOTE = ord('"')
+NEWLINE = ord('\n')
+
+Split = Tuple[int, int]
+
+def _line_ends(filename: str, targets: List[int]) -> List[int]:
+    """For each target offset, the offset after the first newline at or after it
+    that isn't inside quotes.  Or the end of the file."""
+    results: List[int] = []
+    in_quotes = False
+    offset = 0
+    with open(filename, 'rb') as input_f:
+        while len(results) < len(targets):
+            block = input_f.read(SCAN_BYTES)
+            if len(block) == 0:
+                break
+            data = np.frombuffer(block, dtype=np.uint8)
+            # doubled quotes inside a quoted field toggle twice, so parity still works.
+            parity = (np.cumsum(data == QUOTE) + in_quotes) % 2
+            ends = np.flatnonzero((data == NEWLINE) & (parity == 0)) + offset + 1
+            while len(results) < len(targets):
+                position = np.searchsorted(ends, targets[len(results)])
+                if position == len(ends):
+                    break
+                results.append(int(ends[position]))
+            in_quotes = bool(parity[-1])
+            offset += len(block)
+    results.extend([offset] * (len(targets) - len(results)))
+    return results
+
+def plan(filename: str, split_bytes: int = SPLIT_BYTES) -> Tuple[List[str], List[Split]]:
+    """The CSV header, and the byte ranges of about split_bytes, after the header.
+    For Parquet, the columns, and one range per row group."""
+    if columnar.is_columnar(filename):
+        num_row_groups = columnar.pq.ParquetFile(filename).num_row_groups
+        return columnar.columns(filename), [(group, group + 1) for group in range(num_row_groups)]
+    with open(filename, 'rb') as input_f:
+        size = input_f.seek(0, io.SEEK_END)
+    header_end = _line_ends(filename, [0])[0]
+    with open(filename, 'rb') as input_f:
+        header = next(csv.reader([input_f.read(header_end).decode('utf8')]))
+    targets = list(range(header_end + split_bytes, size, split_bytes))
+    bounds = [header_end] + sorted(set(_line_ends(filename, targets))) + [size]
+    return header, [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+def read(filename: str, header: List[str], split: Split, **csv_kwargs: Any) -> pd.DataFrame:
+    """Read and parse the range, like pd.read_csv with the csv_kwargs would.
+    The csv_kwargs only apply to CSV."""
+    start, end = split
+    if columnar.is_columnar(filename):
+        return columnar.pq.ParquetFile(filename).read_row_groups(list(range(start, end))).to_pandas()
+    with open(filename, 'rb') as input_f:
+        input_f.seek(start)
+        data = input_f.read(end - start)
+    # name the unnamed index column the way pandas does, so usecols can refer to it
+    return pd.read_csv(io.BytesIO(data), header=None, names=[name or 'Unnamed: 0' for name in header],
+                       **csv_kwargs)
@@ -0,0 +1,123 @@
+"""
+Generate synthetic left and right tables, shaped like the sample-data files, at any scale.
+
+The right table has a Partner_Name, and sometimes a DBA.  Each distinct left row
+either refers to a right partner, with the kinds of noise the real data has
+(case, punctuation, legal suffixes, abbreviations, typos), or to some other
+supplier.  The Invoice_Ship_to_Address is a name, usually the supplier's, then a
+street address, like "FooCo 1234 Fooco St. Foo CA".  The left table repeats its
+distinct rows, like an invoice table repeats its suppliers, so dedup has work to do,
+and each row has a Fiscal_Year, for the ingest partitions.
+
+Everything comes from a seeded generator, so the same parameters make the same files.
+"""
+# pylint: disable=too-many-arguments,too-many-locals
+from typing import List
+import numpy as np
+import pandas as pd # type:ignore
+
+SEED = 62
+SYLLABLES = ['ac', 'al', 'an', 'ar', 'bel', 'ber', 'cor', 'dan', 'del', 'den', 'fo', 'gar', 'har',
+             'ka', 'lin', 'mar', 'mon', 'nor', 'o', 'pen', 'ra', 'ro', 'san', 'ster', 'ta', 'ton',
+             'vel', 'ver', 'wes', 'win', 'x', 'zen']
+WORDS = ['Acme', 'Advanced', 'American', 'Associates', 'Bay', 'Brothers', 'Builders', 'Capital',
+         'Coastal', 'Consulting', 'Data', 'Design', 'Electric', 'Engineering', 'Environmental',
+         'Family', 'First', 'General', 'Global', 'Golden', 'Health', 'Industrial', 'Medical',
+         'Mountain', 'National', 'Pacific', 'Partners', 'Services', 'Solutions', 'Supply',
+         'Systems', 'Technologies', 'United', 'Valley', 'West']
+SUFFIXES = ['Inc', 'Inc.', 'Incorporated', 'LLC', 'L.L.C.', 'Corp', 'Corporation', 'Co', 'Company', 'Ltd', '']
+STREET_TYPES = ['St.', 'Street', 'Ave', 'Avenue', 'Blvd', 'Rd', 'Way', 'Dr']
+CITIES = ['Sacramento', 'Fresno', 'Oakland', 'San Diego', 'Los Angeles', 'Santa Monica', 'Eureka',
+          'Redding', 'Chico', 'Stockton']
+STATES = ['CA', 'CA', 'CA', 'NV', 'OR', 'AZ']
+FISCAL_YEARS = ['2018', '2019', '2020', '2021', '2022']
+
+def _pick(rng: np.random.Generator, values: List[str]) -> str:
+    return values[rng.integers(len(values))]
+
+def _coined(rng: np.random.Generator) -> str:
+    return ''.join(_pick(rng, SYLLABLES) for _ in range(rng.integers(2, 4))).capitalize()
+
+def _name(rng: np.random.Generator) -> str:
+    """A company name: a coined word and some common ones."""
+    words = [_coined(rng)] + [_pick(rng, WORDS) for _ in range(rng.integers(0, 3))]
+    return ' '.join(words + [_pick(rng, SUFFIXES)]).strip()
+
+def _typo(rng: np.random.Generator, text: str) -> str:
+    """Delete, insert, or swap a character."""
+    if len(text) < 3:
+        return text
+    pos = int(rng.integers(1, len(text) - 1))
+    kind = rng.integers(3)
+    if kind == 0:
+        return text[:pos] + text[pos + 1:]
+    if kind == 1:
+        return text[:pos] + chr(ord('a') + int(rng.integers(26))) + text[pos:]
+    return text[:pos - 1] + text[pos] + text[pos - 1] + text[pos + 1:]
+
+def _noisy(rng: np.random.Generator, name: str, noise: float) -> str:
+    """The name as some clerk might have typed it."""
+    words = name.split()
+    if len(words) > 1 and words[-1] in SUFFIXES and rng.random() < noise:
+        words[-1] = _pick(rng, SUFFIXES)
+    if len(words) > 2 and rng.random() < noise / 2:
+        del words[int(rng.integers(1, len(words) - 1))]
+    text = ' '.join(word for word in words if word != '')
+    if rng.random() < noise:
+        text = _typo(rng, text)
+    if rng.random() < noise:
+        text = text.upper()
+    if rng.random() < noise / 2:
+        text = text.replace(' ', '', 1)
+    return text
+
+def _address(rng: np.random.Generator, name: str) -> str:
+    street = _coined(rng)
+    return (f"{name} {rng.integers(1, 99999)} {street} {_pick(rng, STREET_TYPES)} "
+            f"{_pick(rng, CITIES)} {_pick(rng, STATES)}")
+
+def right_table(rows: int, dba_rate: float = 0.3, seed: int = SEED) -> pd.DataFrame:
+    """The right table, like sample-right.csv."""
+    rng = np.random.default_rng(seed)
+    names = [_name(rng) for _ in range(rows)]
+    dbas = [_noisy(rng, name, 0.5) if rng.random() < dba_rate else '' for name in names]
+    return pd.DataFrame({'Partner_Name': names, 'DBA': dbas,
+                         'Field1': 'Extra1', 'Field2': 'Extra2'})
+
+def left_table(rows: int, right_df: pd.DataFrame, match_rate: float = 0.7, duplicate_rate: float = 0.8,
+               noise: float = 0.3, seed: int = SEED + 1) -> pd.DataFrame:
+    """The left table, like sample-left.csv: about duplicate_rate of the rows repeat
+    earlier ones, and match_rate of the distinct rows refer to a right partner."""
+    rng = np.random.default_rng(seed)
+    distinct = max(int(rows * (1 - duplicate_rate)), 1)
+    suppliers: List[str] = []
+    addresses: List[str] = []
+    for _ in range(distinct):
+        if len(right_df) > 0 and rng.random() < match_rate:
+            partner = right_df.iloc[int(rng.integers(len(right_df)))]
+            name = partner['DBA'] if partner['DBA'] != '' and rng.random() < 0.5 else partner['Partner_Name']
+            supplier = _noisy(rng, name, noise)
+        else:
+            supplier = _name(rng)
+        suppliers.append(supplier)
+        # sometimes the ship-to name is abbreviated, or someone else, like "attn accounts payable"
+        ship_to = _pick(rng, [supplier, supplier, supplier.split()[0], 'Attn Accounts Payable'])
+        addresses.append(_address(rng, ship_to))
+    # the repeats follow a heavy tail, a few suppliers appear a lot.
+    choice = np.minimum(rng.zipf(1.5, rows - distinct) - 1, distinct - 1) if rows > distinct else []
+    order = np.concatenate([np.arange(distinct), rng.permutation(distinct)[choice]]).astype(np.int64)
+    rng.shuffle(order)
+    return pd.DataFrame({'Supplier': np.array(suppliers, dtype=object)[order],
+                         'Invoice_Ship_to_Address': np.array(addresses, dtype=object)[order],
+                         'Fiscal_Year': rng.choice(FISCAL_YEARS, rows),
+                         'Field1': 'Extra Bar', 'Field2': 'Extra Baz'})
+
+def run(left_file: str, right_file: str, left_rows: int, right_rows: int,
+        match_rate: float = 0.7, duplicate_rate: float = 0.8, noise: float = 0.3) -> None:
+    """Write the left and right CSV files."""
+    right_df = right_table(right_rows)
+    right_df.to_csv(right_file)
+    left_table(left_rows, right_df, match_rate, duplicate_rate, noise).to_csv(left_file)
+
+if __name__ == '__main__':
+    run('sample-data/synthetic-left.csv', 'sample-data/synthetic-right.csv', 100000, 6000)
@@ -0,0 +1,85 @@
+"""A rerun after a failed chunk must do only the unfinished chunks, and end with
+the same output as a run without the failure."""
+import os
+from typing import List, Optional, Set, Tuple
+import pandas as pd # type:ignore
+import pytest
+import checkpoint
+import columnar
+
+DATA = pd.DataFrame({'left_index': range(45), 'score': [idx / 45 for idx in range(45)]})
+CHUNK_SIZE = 10
+
+def scan(parts: checkpoint.Parts, fail_at: Optional[int] = None) -> Set[Tuple[int, int]]:
+    """Write each chunk of DATA to its part, as a worker would, failing the chunk
+    starting at fail_at after it's written some of it.  Returns the chunks done."""
+    done: Set[Tuple[int, int]] = set()
+    start = 0
+    while start < len(DATA):
+        end = min(start + parts.chunk_size(start, CHUNK_SIZE), len(DATA))
+        if not parts.is_done(start, end):
+            chunk = DATA.iloc[start:end]
+            try:
+                if start == fail_at:
+                    columnar.write_chunk(chunk.iloc[:3], parts.tmp_file(start, end), index=False)
+                    raise RuntimeError("worker died")
+                columnar.write_chunk(chunk, parts.tmp_file(start, end), index=False)
+                parts.finish(start, end, len(chunk))
+                done.add((start, end))
+            except RuntimeError as error:
+                parts.fail(start, end, error)
+        start = end
+    return done
+
+def output(output_file: str) -> pd.DataFrame:
+    """The concatenated output, with the types of DATA (Parquet has float32 scores)."""
+    return columnar.read(output_file).astype(DATA.dtypes.to_dict())
+
+@pytest.mark.parametrize('suffix', ['.csv', '.parquet'])
+def test_resume_after_failure(tmp_path, suffix):
+    if suffix == '.parquet':
+        pytest.importorskip('pyarrow')
+    parts_dir, output_file = str(tmp_path / 'out.parts'), str(tmp_path / ('out' + suffix))
+    sig = checkpoint.signature([], chunk_size=CHUNK_SIZE)
+
+    parts = checkpoint.Parts(parts_dir, sig, suffix)
+    assert scan(parts, fail_at=20) == {(0, 10), (10, 20), (30, 40), (40, 45)}
+    with pytest.raises(Exception, match="1 chunks failed"):
+        parts.concat(output_file, list(DATA))
+    assert not os.path.exists(output_file)
+    assert os.path.exists(parts.tmp_file(20, 30)) # the failed worker's partial part
+
+    resumed = checkpoint.Parts(parts_dir, sig, suffix)
+    assert not os.path.exists(resumed.tmp_file(20, 30))
+    assert scan(resumed) == {(20, 30)}
+    resumed.concat(output_file, list(DATA))
+    pd.testing.assert_frame_equal(output(output_file), DATA)
+    assert not os.path.exists(parts_dir)
+
+def test_partial_manifest_line(tmp_path):
+    parts_dir = str(tmp_path / 'out.parts')
+    sig = checkpoint.signature([], chunk_size=CHUNK_SIZE)
+    scan(checkpoint.Parts(parts_dir, sig), fail_at=20)
+    # a crash while appending the record of the last chunk
+    manifest_file = os.path.join(parts_dir, checkpoint.MANIFEST)
+    with open(manifest_file, 'r', encoding='utf8') as manifest_f:
+        lines: List[str] = manifest_f.read().splitlines()
+    with open(manifest_file, 'w', encoding='utf8') as manifest_f:
+        manifest_f.write("\n".join(lines[:-1] + [lines[-1][:10]]))
+    resumed = checkpoint.Parts(parts_dir, sig)
+    assert resumed.completed == {(0, 10), (10, 20), (30, 40)}
+
+def test_different_signature(tmp_path):
+    parts_dir = str(tmp_path / 'out.parts')
+    scan(checkpoint.Parts(parts_dir, checkpoint.signature([], chunk_size=CHUNK_SIZE)), fail_at=20)
+    other = checkpoint.Parts(parts_dir, checkpoint.signature([], chunk_size=CHUNK_SIZE + 1))
+    assert other.completed == set()
+    assert os.listdir(parts_dir) == [checkpoint.MANIFEST]
+
+def test_chunk_size_aligns_with_done(tmp_path):
+    parts = checkpoint.Parts(str(tmp_path / 'out.parts'), checkpoint.signature([]))
+    parts.finish(0, 7, 0)
+    parts.finish(12, 20, 0)
+    assert parts.chunk_size(0, 10) == 7 # the finished chunk
+    assert parts.chunk_size(7, 10) == 5 # up to the next finished chunk
+    assert parts.chunk_size(20, 10) == 10
@@ -0,0 +1,44 @@
+"""The compiled model must predict what the pickled pygam model does, since
+classify uses either one."""
+import pickle
+from typing import Any
+import numpy as np
+import pytest
+pygam = pytest.importorskip('pygam')
+import compiled_model
+import fit
+
+def fitted_model() -> Any:
+    """A small GAM on fixed data, shaped like the scores: eight features in [0, 1]."""
+    rng = np.random.default_rng(fit.SEED)
+    x_data = rng.random((400, 8))
+    logits = 6 * x_data[:, 0] + 4 * np.sin(3 * x_data[:, 3]) - 2 * x_data[:, 5] ** 2 - 3
+    y_data = (rng.random(400) < 1 / (1 + np.exp(-logits))).astype(int)
+    return pygam.LogisticGAM(lam=1.0, **fit.GAM_ARGS).fit(x_data, y_data)
+
+@pytest.fixture(name='models', scope='module')
+def fixture_models(tmp_path_factory):
+    model_file = tmp_path_factory.mktemp('model') / 'model.pkl'
+    with open(model_file, 'wb') as model_f:
+        pickle.dump(fitted_model(), model_f)
+    with open(model_file, 'rb') as model_f:
+        model = pickle.load(model_f)
+    compiled_file = str(model_file.with_suffix('.npz'))
+    compiled_model.export(model, compiled_file)
+    return model, compiled_model.CompiledModel(compiled_file)
+
+def test_predict_proba(models):
+    model, compiled = models
+    x_data = np.random.default_rng(1).random((1000, 8))
+    np.testing.assert_allclose(compiled.predict_proba(x_data), model.predict_proba(x_data), atol=1e-4)
+
+def test_predict_proba_edges(models):
+    model, compiled = models
+    # the ends of the grid, and a little past them, where both extrapolate
+    x_data = np.tile(np.array([[0.0], [1.0], [-0.05], [1.05]]), (1, 8))
+    np.testing.assert_allclose(compiled.predict_proba(x_data), model.predict_proba(x_data), atol=1e-4)
+
+def test_export_rejects_other_links():
+    model = pygam.LinearGAM(n_splines=5).fit(np.linspace(0, 1, 50)[:, None], np.linspace(0, 1, 50))
+    with pytest.raises(ValueError):
+        compiled_model.export(model, 'unused.npz')
@@ -0,0 +1,45 @@
+"""The declared matchers must plan to share their vectorizations, and still score
+the same as a TfidfVectorizer per matcher."""
+import json
+import pandas as pd # type:ignore
+import pytest
+import matcher_spec
+import normalize
+import tfidf_index
+from test_tfidf_index import check_match
+
+RIGHT_DF = pd.DataFrame({'Partner_Name': ['Acme Inc', 'Acme Supply Co', 'West Coast Widgets LLC', 'Widget World'],
+                         'DBA': ['ACME', None, 'WCW', 'Widget World West']}, index=[7, 8, 9, 10])
+LEFT_DF = pd.DataFrame({'Supplier': ['ACME INC.', 'West Coast Widget', 'Widget World Corp', 'Nobody'],
+                        'Invoice_Ship_to_Address': ['Acme Inc PO Box 1234 Santa Monica CA', '', None,
+                                                    'Widget World 12 Main St Springfield IL']},
+                       index=[2, 0, 1, 3])
+
+def test_load_plan():
+    matchers = matcher_spec.load(normalized=True)
+    assert len(matchers) == 8
+    assert all('preprocessor' not in config for _, _, _, config in matchers)
+    configs, vectorizations, _ = tfidf_index.plan(matchers)
+    assert len(configs) == 2
+    assert sorted(vectorizations) == [('DBA', 0), ('DBA', 1), ('Partner_Name', 0), ('Partner_Name', 1)]
+
+def test_load_preprocessor():
+    matchers = matcher_spec.load()
+    assert all(config['preprocessor'] is normalize.recipient for _, _, _, config in matchers)
+
+def test_match_normalized(tmp_path):
+    left_df = LEFT_DF.fillna('').apply(lambda column: column.map(normalize.recipient))
+    right_df = RIGHT_DF.fillna('').apply(lambda column: column.map(normalize.recipient))
+    check_match(left_df, right_df, matcher_spec.load(normalized=True), str(tmp_path))
+
+def test_match_preprocessor(tmp_path):
+    check_match(LEFT_DF, RIGHT_DF, matcher_spec.load(), str(tmp_path))
+
+@pytest.mark.parametrize('analyzer', [{'analyzer': 'word', 'ngram_size': [1, 1], 'preprocessor': 'nope'}, None])
+def test_load_unknown(tmp_path, analyzer):
+    spec_file = tmp_path / 'matchers.json'
+    spec_file.write_text(json.dumps({
+        'analyzers': {} if analyzer is None else {'words': analyzer},
+        'matchers': [{'left': 'Supplier', 'right': 'DBA', 'analyzer': 'words', 'weight': 1.0}]}))
+    with pytest.raises(ValueError):
+        matcher_spec.load(str(spec_file))
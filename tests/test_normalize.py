@@ -0,0 +1,37 @@
+"""The single pass stopword pattern must remove what the original loop of
+re.sub calls, one per stopword, did."""
+import random
+import re
+import pandas as pd # type:ignore
+import pytest
+import normalize
+import stopwords
+
+def sequential(text_field: str) -> str:
+    """The original removal, one stopword at a time."""
+    for stopword in stopwords.STOPWORDS:
+        text_field = re.sub(r'\b' + stopword + r'\b', ' ', text_field)
+    return text_field
+
+# multi-word and non-word stopwords, prefixes and suffixes of stopwords, and
+# words that contain them
+TEXTS = ['north america', 'north&america', 'north & america', 'north  america', 'acme north america inc',
+         'co&inc', 'co & inc', '&&', 'acme inc.', 'acme, inc', 'andy', 'onto', 'corporation', 'corp.',
+         'incorporated', 'services co', 'ag-co', 'by and by', '', ' ', 'acme']
+
+@pytest.mark.parametrize('text_field', TEXTS)
+def test_remove_stopwords(text_field):
+    assert normalize.remove_stopwords(text_field) == sequential(text_field)
+
+def test_remove_stopwords_random():
+    # stopwords, their pieces, and separators, strung together at random
+    pieces = stopwords.STOPWORDS + ['north', 'america', 'c', 'o', 'x', ' ', '  ', '&', '.', ',', '-']
+    rng = random.Random(0)
+    for _ in range(5000):
+        text_field = ''.join(rng.choice(pieces) for _ in range(rng.randint(1, 8)))
+        assert normalize.remove_stopwords(text_field) == sequential(text_field), text_field
+
+def test_recipients():
+    values = pd.Series(['ACME Corp', 'Acme Inc PO Box 1234 Santa Monica CA', 'ACME Corp', 'North&America LLC'])
+    expected = [normalize.recipient(value) for value in values]
+    assert normalize.recipients(values).tolist() == expected
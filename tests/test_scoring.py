@@ -0,0 +1,57 @@
+"""The batch scoring must give the same features as the per-row library calls
+of the original rescore worker, since the model was trained on them."""
+import numpy as np
+import pytest
+from strsimpy.overlap_coefficient import OverlapCoefficient # type:ignore
+from thefuzz import fuzz # type:ignore
+import scoring
+
+# the empty, whitespace and non-ascii edge cases, repeats, and ratios of exactly
+# 62.5 and 37.5, which round half to even
+LEFTS = ['acme corp', 'Acme Corp.', 'foo co', '', 'ab', 'café inc', 'west coast supply', 'a  b', '  ',
+         'x', 'acme', 'acme corp', 'acaba cca', 'bbbba bab']
+RIGHTS = ['acme', 'ACME corporation', 'bar', 'acme', 'abc', 'cafe', 'coast west supply co', 'b a', 'acme',
+          '', 'acme', 'acme', 'a c ccc', 'accbacd']
+
+def expected_ratios(lefts, rights):
+    return np.array([fuzz.token_set_ratio(left, right) for left, right in zip(lefts, rights)]) / 100
+
+def _or_nan(similarity, left, right):
+    """The similarity, or nan where it divides by zero, as strsimpy does for a string
+    shorter than a shingle, depending on its version."""
+    try:
+        return float(similarity(left, right))
+    except ZeroDivisionError:
+        return np.nan
+
+def test_overlap_scores():
+    overlap = OverlapCoefficient(k=3)
+    expected = np.array([_or_nan(overlap.similarity, left, right) for left, right in zip(LEFTS, RIGHTS)])
+    # pair by pair, the edge cases go to the library, and raise the same
+    actual = np.array([_or_nan(lambda left, right: scoring.overlap_scores([left], [right])[0], left, right)
+                       for left, right in zip(LEFTS, RIGHTS)])
+    np.testing.assert_array_equal(actual, expected)
+    # and in a batch, with the shingles shared
+    scored = ~np.isnan(expected)
+    np.testing.assert_array_equal(scoring.overlap_scores(np.array(LEFTS)[scored].tolist(),
+                                                         np.array(RIGHTS)[scored].tolist()),
+                                  expected[scored])
+
+def test_ratio_scores_rapidfuzz():
+    pytest.importorskip('rapidfuzz')
+    np.testing.assert_array_equal(scoring.ratio_scores(LEFTS, RIGHTS, workers=2), expected_ratios(LEFTS, RIGHTS))
+
+def test_ratio_scores_thefuzz(monkeypatch):
+    monkeypatch.setattr(scoring, 'rapid_process', None)
+    np.testing.assert_array_equal(scoring.ratio_scores(LEFTS, RIGHTS), expected_ratios(LEFTS, RIGHTS))
+
+def test_ratio_scores_empty():
+    assert len(scoring.ratio_scores([], [])) == 0
+
+def test_score_columns():
+    lefts = [['acme corp', 'foo co'], ['west coast supply', 'acme']]
+    rights = [['acme', 'bar'], ['coast west supply co', 'acme corporation']]
+    features = scoring.score(lefts, rights)
+    assert list(features) == ['overlap11', 'ratio11', 'overlap12', 'ratio12',
+                              'overlap21', 'ratio21', 'overlap22', 'ratio22']
+    np.testing.assert_array_equal(features['ratio21'], expected_ratios(lefts[1], rights[0]))
@@ -0,0 +1,98 @@
+"""The index must score the pairs the same as a TfidfVectorizer fit on each
+matcher's right field alone, as record_linkage did, though its term counts are
+shared between the matchers."""
+from typing import List
+import numpy as np
+import pandas as pd # type:ignore
+import pytest
+from sklearn.feature_extraction.text import TfidfVectorizer # type:ignore
+import stopwords
+import tfidf_index
+
+# normalized already, so without a preprocessor
+RIGHT_DF = pd.DataFrame({'Partner_Name': ['acme', 'acme supply', 'west coast widgets', 'widget world',
+                                          'northern lights', None, 'acme widgets west'],
+                         'DBA': ['acme', None, 'wcw', 'widget world west', '', 'lights out', 'acme west']},
+                        index=[10, 11, 12, 13, 14, 15, 16])
+LEFT_DF = pd.DataFrame({'Supplier': ['acme', 'acme  ', 'west coast widget', 'northern light', 'zzz', None],
+                        'Invoice_Ship_to_Address': ['acme widgets', 'west', '', 'lights', 'world widget', 'acme']},
+                       index=[3, 1, 4, 1000, 5, 9])
+WORDS = {'analyzer': 'word', 'ngram_size': [1, 2], 'min_similarity': 0.0}
+CHARS = {'analyzer': 'char_wb', 'ngram_size': [3, 4], 'min_similarity': 0.0}
+MATCHERS: List[tfidf_index.Matcher] = [('Supplier', 'Partner_Name', 1.0, WORDS), ('Supplier', 'Partner_Name', 0.5, CHARS),
+                                       ('Supplier', 'DBA', 0.8, CHARS),
+                                       ('Invoice_Ship_to_Address', 'Partner_Name', 0.3, WORDS),
+                                       ('Invoice_Ship_to_Address', 'DBA', 0.2, CHARS)]
+
+def baseline(left_df: pd.DataFrame, right_df: pd.DataFrame, matchers: List[tfidf_index.Matcher]) -> List[np.ndarray]:
+    """The dense similarities of each matcher, by a TfidfVectorizer fit on its right field."""
+    left_df, right_df = left_df.fillna(''), right_df.fillna('')
+    similarities = []
+    for left_field, right_field, _, config in matchers:
+        vectorizer = TfidfVectorizer(min_df=1, analyzer=config['analyzer'], ngram_range=tuple(config['ngram_size']),
+                                     preprocessor=config.get('preprocessor'),
+                                     stop_words=stopwords.STOPWORDS if config['analyzer'] == 'word' else None,
+                                     dtype=np.float64).fit(right_df[right_field])
+        similarity = (vectorizer.transform(left_df[left_field]) @ vectorizer.transform(right_df[right_field]).T).toarray()
+        similarity[similarity < config['min_similarity']] = 0
+        similarities.append(similarity)
+    return similarities
+
+def dense(result: pd.DataFrame, column: str, left_df: pd.DataFrame, right_df: pd.DataFrame) -> np.ndarray:
+    """The column of the match result, as a left by right array, zero where there's no pair."""
+    array = np.zeros((len(left_df), len(right_df)))
+    rows = left_df.index.get_indexer(result.index.get_level_values('left_index'))
+    cols = right_df.index.get_indexer(result.index.get_level_values('right_index'))
+    array[rows, cols] = result[column].values
+    return array
+
+def check_match(left_df: pd.DataFrame, right_df: pd.DataFrame, matchers: List[tfidf_index.Matcher],
+                index_dir: str) -> None:
+    """Build the index, match, and compare each matcher's scores and the weighted mean with the baseline."""
+    tfidf_index.build(right_df, matchers, stopwords.STOPWORDS, index_dir)
+    index = tfidf_index.TfidfIndex(index_dir)
+    result = index.match(left_df)
+    assert len(result) > 0
+    expected = baseline(left_df, right_df, matchers)
+    for column, similarity in zip(index.columns(), expected):
+        np.testing.assert_allclose(dense(result, column, left_df, right_df), similarity, atol=1e-12)
+    weights = np.array([weight for _, _, weight, _ in matchers])
+    np.testing.assert_allclose(dense(result, tfidf_index.SCORE_COL, left_df, right_df),
+                               sum(weight * similarity for weight, similarity in zip(weights, expected)) / weights.sum(),
+                               atol=1e-12)
+
+def test_plan():
+    configs, vectorizations, matcher_vectorizations = tfidf_index.plan(MATCHERS)
+    assert configs == [WORDS, CHARS]
+    assert vectorizations == [('Partner_Name', 0), ('Partner_Name', 1), ('DBA', 1)]
+    assert matcher_vectorizations == [0, 1, 2, 0, 2]
+
+def test_match(tmp_path):
+    # left index values that are out of order, and not the row positions
+    check_match(LEFT_DF, RIGHT_DF, MATCHERS, str(tmp_path))
+
+def test_match_min_similarity(tmp_path):
+    matchers = [(left, right, weight, dict(config, min_similarity=0.3)) for left, right, weight, config in MATCHERS]
+    check_match(LEFT_DF, RIGHT_DF, matchers, str(tmp_path))
+
+def test_match_pairs(tmp_path):
+    tfidf_index.build(RIGHT_DF, MATCHERS, stopwords.STOPWORDS, str(tmp_path))
+    index = tfidf_index.TfidfIndex(str(tmp_path))
+    full = index.match(LEFT_DF)
+    positions = (LEFT_DF.index.get_indexer(full.index.get_level_values('left_index')),
+                 RIGHT_DF.index.get_indexer(full.index.get_level_values('right_index')))
+    pd.testing.assert_frame_equal(index.match_pairs(LEFT_DF, *positions), full)
+
+def test_exact_pairs(tmp_path):
+    tfidf_index.build(RIGHT_DF, MATCHERS, stopwords.STOPWORDS, str(tmp_path))
+    rows, cols = tfidf_index.TfidfIndex(str(tmp_path)).exact_pairs(LEFT_DF, ['Supplier'])
+    # "acme" and "acme  " both equal the Partner_Name and DBA of the first right row
+    assert list(zip(rows, cols)) == [(0, 0), (1, 0)]
+
+@pytest.mark.parametrize('k', [1, 2])
+def test_top_k_mask(k):
+    matrix = np.array([[0.1, 0.5, 0.3], [0.0, 0.2, 0.0], [0.4, 0.0, 0.9]])
+    mask = tfidf_index.top_k_mask(matrix, k).toarray()
+    for row, mask_row in zip(matrix, mask):
+        nonzero = np.flatnonzero(row)
+        assert set(np.flatnonzero(mask_row)) == set(nonzero[np.argsort(-row[nonzero])[:k]])
@@ -0,0 +1,302 @@
+"""
+Prebuilt TF-IDF index of the right table.
+
+record_linkage refits every vectorizer on the right table for every left chunk,
+even though the right table is constant for the whole scan.  Instead, build the
+index once: fit one vectorizer per matcher on the right table, and save the
+vectorizers and the right-side sparse matrices in a directory.  The matrix arrays
+are saved as .npy files, so that the workers can memory-map them.
+
+Matching a left chunk then only transforms the left columns and does the sparse
+dot product, or, given candidate pairs from blocking, only the row-wise dot
+products of those pairs.
+
+The matchers share their work by a plan: each distinct analyzer config (analyzer,
+n-grams, preprocessor) has one term counter, with the vocabulary of all the right
+fields it's used on, and each distinct (right field, analyzer) has its idf weights
+and right matrix.  So each left field is preprocessed and counted once per
+analyzer, and each matcher only weighs and normalizes the shared counts, which
+gives the same vectors as a TfidfVectorizer fit on its right field alone: the terms
+that field doesn't have get no weight.
+
+Rows whose (preprocessed) value equals a right value exactly can be found first
+by a hash lookup, in a map from each right value to its rows, which is also saved.
+
+Optionally, only the best pairs for each left row are kept: the top_k by weighted
+score, and also the matcher_top_k by each matcher's score, by a partial sort of
+each sparse row, so the weak pairs for common words are never written.
+
+Note the vectorizers are fit on the right table alone, so the idf weights don't
+depend on the left chunk, unlike record_linkage, which fits both together.
+"""
+# pylint: disable=line-too-long
+import json
+import os
+import pickle
+from collections import defaultdict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import numpy as np
+import pandas as pd # type:ignore
+from scipy import sparse # type:ignore
+from sklearn.feature_extraction.text import CountVectorizer # type:ignore
+from sklearn.preprocessing import normalize # type:ignore
+import metrics
+
+# (left field, right field, weight, config), as in record_linkage
+Matcher = Tuple[str, str, float, Dict[str, Any]]
+
+MANIFEST = 'manifest.json'
+RIGHT_INDEX = 'right_index.npy'
+EXACT = 'exact.pkl'
+SCORE_COL = 'Weighted Mean Similarity Score'
+
+def score_cols(matchers: List[Matcher]) -> List[str]:
+    """Per-matcher column names, the same as record_linkage makes."""
+    return [f'{idx}:{left_field}/{right_field}'
+            for idx, (left_field, right_field, _, _) in enumerate(matchers)]
+
+def make_vectorizer(config: Dict[str, Any], stop_words: List[str]) -> CountVectorizer:
+    """A term counter like the vectorizer string_grouper makes for this matcher config,
+    without the idf weights."""
+    analyzer = config.get('analyzer', 'char')
+    return CountVectorizer(min_df=1,
+                           analyzer=analyzer,
+                           ngram_range=tuple(config.get('ngram_size', [3, 3])),
+                           preprocessor=config.get('preprocessor'),
+                           stop_words=stop_words if analyzer == 'word' else None,
+                           binary=False,
+                           dtype=np.float64)
+
+def analyzer_key(config: Dict[str, Any]) -> Tuple[Any, ...]:
+    """The parts of a matcher config that determine its term counts."""
+    return (config.get('analyzer', 'char'), tuple(config.get('ngram_size', [3, 3])), config.get('preprocessor'))
+
+Plan = Tuple[List[Dict[str, Any]], List[Tuple[str, int]], List[int]]
+
+def plan(matchers: List[Matcher]) -> Plan:
+    """The distinct analyzer configs, the distinct (right field, analyzer) vectorizations,
+    and the vectorization of each matcher."""
+    keys: List[Tuple[Any, ...]] = []
+    configs: List[Dict[str, Any]] = []
+    vectorizations: List[Tuple[str, int]] = []
+    matcher_vectorizations: List[int] = []
+    for _, right_field, _, config in matchers:
+        if analyzer_key(config) not in keys:
+            keys.append(analyzer_key(config))
+            configs.append(config)
+        vectorization = (right_field, keys.index(analyzer_key(config)))
+        if vectorization not in vectorizations:
+            vectorizations.append(vectorization)
+        matcher_vectorizations.append(vectorizations.index(vectorization))
+    return configs, vectorizations, matcher_vectorizations
+
+def idf(counts: sparse.csr_matrix) -> np.ndarray:
+    """The smoothed idf weights of TfidfTransformer, and zero for the terms the rows don't have."""
+    doc_freq = np.bincount(counts.indices, minlength=counts.shape[1])
+    return np.where(doc_freq > 0, np.log((1 + counts.shape[0]) / (1 + doc_freq)) + 1, 0.0)
+
+def weigh(counts: sparse.csr_matrix, weights: np.ndarray) -> sparse.csr_matrix:
+    """The counts times the idf weights, l2 normalized, like TfidfVectorizer.transform."""
+    matrix = sparse.csr_matrix(counts @ sparse.diags(weights))
+    matrix.eliminate_zeros()
+    return normalize(matrix, norm='l2', copy=False)
+
+def _save_matrix(matrix: sparse.csr_matrix, prefix: str) -> None:
+    np.save(prefix + '.data.npy', matrix.data)
+    np.save(prefix + '.indices.npy', matrix.indices)
+    np.save(prefix + '.indptr.npy', matrix.indptr)
+
+def _load_matrix(prefix: str, shape: Tuple[int, int]) -> sparse.csr_matrix:
+    return sparse.csr_matrix((np.load(prefix + '.data.npy', mmap_mode='r'),
+                              np.load(prefix + '.indices.npy', mmap_mode='r'),
+                              np.load(prefix + '.indptr.npy', mmap_mode='r')),
+                             shape=shape, copy=False)
+
+def build(right_df: pd.DataFrame, matchers: List[Matcher], stop_words: List[str],
+          index_dir: str) -> None:
+    """Fit a term counter per analyzer and the idf weights per vectorization on the
+    right table, see plan, and save everything in index_dir."""
+    os.makedirs(index_dir, exist_ok=True)
+    right_df = right_df.fillna('')
+    np.save(os.path.join(index_dir, RIGHT_INDEX), right_df.index.values)
+    configs, vectorizations, matcher_vectorizations = plan(matchers)
+    counters = []
+    for idx, config in enumerate(configs):
+        right_fields = sorted({right_field for right_field, analyzer in vectorizations if analyzer == idx})
+        counter = make_vectorizer(config, stop_words).fit(pd.concat([right_df[field] for field in right_fields]))
+        with open(os.path.join(index_dir, f'{idx}.analyzer.pkl'), 'wb') as counter_f:
+            pickle.dump(counter, counter_f)
+        counters.append(counter)
+    shapes: List[Tuple[int, int]] = []
+    for idx, (right_field, analyzer) in enumerate(vectorizations):
+        counts = sparse.csr_matrix(counters[analyzer].transform(right_df[right_field]))
+        weights = idf(counts)
+        right_matrix = weigh(counts, weights)
+        right_matrix.sort_indices()
+        np.save(os.path.join(index_dir, f'{idx}.idf.npy'), weights)
+        _save_matrix(right_matrix, os.path.join(index_dir, str(idx)))
+        shapes.append(right_matrix.shape)
+    exact: Dict[str, List[int]] = defaultdict(list)
+    for right_field, config in {right_field: config for _, right_field, _, config in matchers}.items():
+        preprocessor = config.get('preprocessor') or (lambda text: text)
+        for position, text in enumerate(right_df[right_field]):
+            key = exact_key(preprocessor(text))
+            if key != '':
+                exact[key].append(position)
+    with open(os.path.join(index_dir, EXACT), 'wb') as exact_f:
+        pickle.dump({key: np.unique(positions) for key, positions in exact.items()}, exact_f)
+    # the manifest is written last, so its presence means the index is complete.
+    with open(os.path.join(index_dir, MANIFEST), 'w', encoding='utf8') as manifest_f:
+        json.dump({
+            'matchers': [[left_field, right_field, weight, config.get('min_similarity', 0.8)]
+                         for left_field, right_field, weight, config in matchers],
+            'analyzers': len(configs),
+            'vectorizations': [[right_field, analyzer] for right_field, analyzer in vectorizations],
+            'matcher_vectorizations': matcher_vectorizations,
+            'shapes': shapes
+        }, manifest_f, indent=1)
+
+def exact_key(text: str) -> str:
+    """The key of a preprocessed value in the exact map: the stopword removal leaves
+    extra spaces, e.g. "acme inc" becomes "acme  ", which shouldn't keep it from
+    matching "acme"."""
+    return " ".join(text.split())
+
+def top_k_mask(matrix: sparse.csr_matrix, k: int) -> sparse.csr_matrix:
+    """Ones where the k largest values of each row are, by partial sort of the longer rows."""
+    matrix = sparse.csr_matrix(matrix)
+    mask = sparse.csr_matrix((np.ones(len(matrix.data)), matrix.indices, matrix.indptr), shape=matrix.shape)
+    for row in np.flatnonzero(np.diff(matrix.indptr) > k):
+        start, end = matrix.indptr[row], matrix.indptr[row + 1]
+        mask.data[start + np.argpartition(-matrix.data[start:end], k)[k:]] = 0
+    mask.eliminate_zeros()
+    return mask
+
+class TfidfIndex:
+    """The loaded index: term counters, idf weights, memory-mapped right matrices, and the right index values."""
+    def __init__(self, index_dir: str) -> None:
+        with open(os.path.join(index_dir, MANIFEST), 'r', encoding='utf8') as manifest_f:
+            manifest = json.load(manifest_f)
+        self.matchers: List[Tuple[str, str, float, float]] = [tuple(m) for m in manifest['matchers']] # type:ignore
+        self.right_index: np.ndarray = np.load(os.path.join(index_dir, RIGHT_INDEX), mmap_mode='r')
+        self.counters: List[CountVectorizer] = []
+        for idx in range(manifest['analyzers']):
+            with open(os.path.join(index_dir, f'{idx}.analyzer.pkl'), 'rb') as counter_f:
+                self.counters.append(pickle.load(counter_f))
+        self.vectorizations: List[Tuple[str, int]] = [tuple(v) for v in manifest['vectorizations']] # type:ignore
+        self.matcher_vectorizations: List[int] = manifest['matcher_vectorizations']
+        self.idfs: List[np.ndarray] = []
+        self.right_matrices: List[sparse.csr_matrix] = []
+        for idx, shape in enumerate(manifest['shapes']):
+            self.idfs.append(np.load(os.path.join(index_dir, f'{idx}.idf.npy')))
+            self.right_matrices.append(_load_matrix(os.path.join(index_dir, str(idx)), tuple(shape)))
+        with open(os.path.join(index_dir, EXACT), 'rb') as exact_f:
+            self.exact: Dict[str, np.ndarray] = pickle.load(exact_f)
+
+    def restrict(self, right_ids: List[int]) -> None:
+        """Match only the right rows with these index values, e.g. the changed ones in a delta run."""
+        positions = np.flatnonzero(np.isin(np.asarray(self.right_index), right_ids))
+        new_positions = np.full(len(self.right_index), -1, dtype=np.int64)
+        new_positions[positions] = np.arange(len(positions))
+        self.right_index = np.asarray(self.right_index)[positions]
+        self.right_matrices = [sparse.csr_matrix(right_matrix[positions]) for right_matrix in self.right_matrices]
+        self.exact = {key: new_positions[old][new_positions[old] >= 0] for key, old in self.exact.items()}
+        self.exact = {key: restricted for key, restricted in self.exact.items() if len(restricted) > 0}
+
+    def columns(self) -> List[str]:
+        """Per-matcher score column names."""
+        return score_cols([(left_field, right_field, weight, {})
+                           for left_field, right_field, weight, _ in self.matchers])
+
+    def exact_pairs(self, left_df: pd.DataFrame, left_fields: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """The distinct (left chunk row position, right table row position) pairs whose
+        preprocessed values are the same, in any of the left fields and the right fields."""
+        left_df = left_df.fillna('')
+        preprocessor = self.counters[0].preprocessor or (lambda text: text)
+        pairs = {(position, int(right_position))
+                 for left_field in left_fields
+                 for position, text in enumerate(left_df[left_field])
+                 for right_position in self.exact.get(exact_key(preprocessor(text)), [])}
+        if len(pairs) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        rows, cols = zip(*sorted(pairs))
+        return np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64)
+
+    def match(self, left_df: pd.DataFrame, top_k: Optional[int] = None,
+              matcher_top_k: Optional[int] = None) -> pd.DataFrame:
+        """Match the chunk against the whole right table.
+
+        Returns the same frame as non-hierarchical record_linkage: indexed by
+        (left_index, right_index), with the weighted mean score and one column per matcher.
+        If top_k or matcher_top_k are specified, keep only the best pairs for each left row."""
+        left_df = left_df.fillna('')
+        similarities: List[sparse.csr_matrix] = []
+        for min_similarity, left_matrix, right_matrix in self._vectorized(left_df):
+            with metrics.phase('matmul'):
+                similarity = sparse.csr_matrix(left_matrix @ right_matrix.T)
+            similarity.data[similarity.data < min_similarity] = 0
+            similarity.eliminate_zeros()
+            similarities.append(similarity)
+        return self._result(left_df, similarities, top_k, matcher_top_k)
+
+    def match_pairs(self, left_df: pd.DataFrame, rows: np.ndarray, cols: np.ndarray,
+                    top_k: Optional[int] = None, matcher_top_k: Optional[int] = None) -> pd.DataFrame:
+        """Like match, but only for the given pairs of left chunk row positions and
+        right table row positions."""
+        left_df = left_df.fillna('')
+        similarities: List[sparse.csr_matrix] = []
+        for min_similarity, left_matrix, right_matrix in self._vectorized(left_df):
+            with metrics.phase('pair_products'):
+                values = np.asarray(left_matrix[rows].multiply(right_matrix[cols]).sum(axis=1)).ravel()
+            values[values < min_similarity] = 0
+            similarity = sparse.csr_matrix((values, (rows, cols)), shape=(len(left_df), right_matrix.shape[0]))
+            similarity.eliminate_zeros()
+            similarities.append(similarity)
+        return self._result(left_df, similarities, top_k, matcher_top_k)
+
+    def _vectorized(self, left_df: pd.DataFrame) -> Iterator[Tuple[float, sparse.csr_matrix, sparse.csr_matrix]]:
+        """For each matcher: its min similarity, and its left and right matrices.
+        Each left field is counted once per analyzer, and weighed once per vectorization."""
+        counts: Dict[Tuple[str, int], sparse.csr_matrix] = {}
+        left_matrices: Dict[Tuple[str, int], sparse.csr_matrix] = {}
+        for (left_field, _, _, min_similarity), vectorization in zip(self.matchers, self.matcher_vectorizations):
+            analyzer = self.vectorizations[vectorization][1]
+            if (left_field, analyzer) not in counts:
+                with metrics.phase('vectorize'):
+                    counts[(left_field, analyzer)] = sparse.csr_matrix(
+                        self.counters[analyzer].transform(left_df[left_field]))
+            if (left_field, vectorization) not in left_matrices:
+                with metrics.phase('weigh'):
+                    left_matrices[(left_field, vectorization)] = weigh(counts[(left_field, analyzer)],
+                                                                       self.idfs[vectorization])
+            yield min_similarity, left_matrices[(left_field, vectorization)], self.right_matrices[vectorization]
+
+    def _result(self, left_df: pd.DataFrame, similarities: List[sparse.csr_matrix],
+                top_k: Optional[int], matcher_top_k: Optional[int]) -> pd.DataFrame:
+        weights = np.array([weight for _, _, weight, _ in self.matchers])
+        total = sparse.csr_matrix(sum(weight * similarity for weight, similarity in zip(weights, similarities)) / weights.sum())
+        if top_k is not None or matcher_top_k is not None:
+            masks = [top_k_mask(total, top_k)] if top_k is not None else []
+            if matcher_top_k is not None:
+                masks.extend(top_k_mask(similarity, matcher_top_k) for similarity in similarities)
+            keep = sparse.csr_matrix(sum(masks))
+            keep.data[:] = 1
+            total = total.multiply(keep)
+        total = sparse.coo_matrix(total)
+        rows, cols = total.row, total.col
+        metrics.count('pairs_scored', len(rows))
+
+        result = pd.DataFrame({SCORE_COL: total.data},
+                              index=pd.MultiIndex.from_arrays(
+                                  [left_df.index.values[rows], np.asarray(self.right_index)[cols]],
+                                  names=['left_index', 'right_index']))
+        for column, similarity in zip(self.columns(), similarities):
+            result[column] = np.asarray(similarity[rows, cols]).ravel()
+        return result.sort_index()
+
+def run(right_file: str, matchers: List[Matcher], stop_words: List[str], index_dir: str) -> None:
+    """Read the right file and build its index."""
+    right_fields = sorted({right_field for _, right_field, _, _ in matchers})
+    right_df = pd.read_csv(right_file, engine='c', index_col=0, usecols=['Unnamed: 0'] + right_fields,
+                           dtype=dict.fromkeys(right_fields, 'str'), low_memory=False)
+    build(right_df, matchers, stop_words, index_dir)